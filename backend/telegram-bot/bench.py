@@ -0,0 +1,1012 @@
+'''
+Business: нагрузочный бенчмарк webhook-обработчика на синтетических Telegram update
+Args: DATABASE_URL на локальную базу с применёнными миграциями, параметры сценария в argv
+Returns: p50/p95/p99, пропускная способность и SQL round trips на update, результат в JSON
+'''
+
+import argparse
+import http.server
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from decimal import Decimal
+from typing import Dict, Any, List, Tuple, Optional, Callable
+
+import index
+
+DEFAULT_MIX = {
+    'start': 10,
+    'browse': 25,
+    'buy_offer': 15,
+    'deals': 20,
+    'create_offer': 10,
+    'complete': 10,
+    'profile': 10
+}
+CALIBRATION_ROUNDS = 20
+ROW_MEMORY_SAMPLES = 200
+STRESS_DEAL_AMOUNT = Decimal('100')
+OUTBOX_STANDIN_TOKEN = 'bench'
+OUTBOX_CHAT_RATE = 5.0
+OUTBOX_GLOBAL_RATE = 20.0
+OUTBOX_PACED_CHATS = 20
+OUTBOX_PACED_PER_CHAT = 3
+OUTBOX_RETRY_AFTER = 7
+OUTBOX_CHAT_429 = -429
+OUTBOX_CHAT_500 = -500
+OUTBOX_CHAT_400 = -400
+OUTBOX_TIMING_SLACK = 0.02
+STARTUP_PROBE = '''
+import json, sys, time
+started = time.perf_counter()
+import index
+imported = time.perf_counter()
+index.handler({'httpMethod': 'OPTIONS'}, None)
+index.handler({'httpMethod': 'POST', 'body': '{"update_id": 1, "edited_message": {"text": "x"}}'}, None)
+done = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'first_request_ms': (done - imported) * 1000,
+    'lazy_loaded': sorted(name for name in ('psycopg2', 'asyncio', 'urllib.request', 'argparse') if name in sys.modules)
+}))
+'''
+INSTANCE_BODY_PREFIX = 'BODY '
+INSTANCE_PROBE = f'''
+import sys
+import index
+for line in sys.stdin:
+    print({INSTANCE_BODY_PREFIX!r} + index.handler({{'httpMethod': 'POST', 'body': line}}, None)['body'], flush=True)
+'''
+READ_YOUR_WRITES_SYNC_TIMEOUT = 30
+
+
+def message_update(update_id: int, telegram_id: int, text: str) -> Dict[str, Any]:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'from': {'id': telegram_id, 'username': f'bench{telegram_id}'},
+            'chat': {'id': telegram_id, 'type': 'private'},
+            'text': text
+        }
+    }
+
+
+def callback_update(update_id: int, telegram_id: int, data: str) -> Dict[str, Any]:
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': {'id': telegram_id, 'username': f'bench{telegram_id}'},
+            'message': {'message_id': 1, 'chat': {'id': telegram_id, 'type': 'private'}},
+            'data': data
+        }
+    }
+
+
+class Population:
+    def __init__(self, buyers: int, sellers: int, offers_per_seller: int, deals_per_buyer: int, seed: int):
+        self.rng = random.Random(seed)
+        self.base = int(time.time() * 1000) * 1000
+        self.buyers: List[int] = [self.base + i for i in range(buyers)]
+        self.sellers: List[int] = [self.base + buyers + i for i in range(sellers)]
+        self.offers: List[Tuple[int, str]] = []
+        self.open_deals: Dict[int, List[int]] = {}
+        self.offers_per_seller = offers_per_seller
+        self.deals_per_buyer = deals_per_buyer
+        self._next_update_id = self.base
+        self._lock = threading.Lock()
+    
+    def next_update_id(self) -> int:
+        with self._lock:
+            self._next_update_id += 1
+            return self._next_update_id
+    
+    def seed(self):
+        with index.db_cursor() as cursor:
+            cursor.execute(
+                """INSERT INTO users (telegram_id, username, role, balance)
+                   SELECT t, 'bench' || t, CASE WHEN t = ANY(%s) THEN 'seller' ELSE 'buyer' END, 1000000
+                   FROM unnest(%s::bigint[]) AS t
+                   RETURNING id, telegram_id, role""",
+                (self.sellers, self.buyers + self.sellers)
+            )
+            users = cursor.fetchall()
+            seller_ids = [user['id'] for user in users if user['role'] == 'seller']
+            buyer_ids = {user['telegram_id']: user['id'] for user in users if user['role'] == 'buyer'}
+            
+            cursor.execute(
+                """INSERT INTO offers (seller_id, price, min_amount, max_amount, currency)
+                   SELECT s, round((90 + random() * 10)::numeric, 2), 100, 10000000, (ARRAY['USDT', 'BTC', 'ETH'])[1 + (g %% 3)]
+                   FROM unnest(%s::int[]) AS s, generate_series(1, %s) AS g
+                   RETURNING id, min_amount""",
+                (seller_ids, self.offers_per_seller)
+            )
+            self.offers = [(offer['id'], str(offer['min_amount'])) for offer in cursor.fetchall()]
+            
+            for telegram_id, buyer_id in buyer_ids.items():
+                deals = []
+                for offer_id, _ in self.rng.sample(self.offers, min(self.deals_per_buyer, len(self.offers))):
+                    cursor.execute("SELECT * FROM escrow_open_deal(%s, %s, NULL)", (buyer_id, offer_id))
+                    deal = cursor.fetchone()
+                    if deal['result'] == 'created':
+                        deals.append(deal['deal_id'])
+                self.open_deals[telegram_id] = deals
+            cursor.connection.commit()
+        index.order_book.mark_stale()
+    
+    def scenario(self, kind: str) -> Tuple[int, List[Dict[str, Any]]]:
+        rng = self.rng
+        if kind == 'create_offer':
+            seller = rng.choice(self.sellers)
+            price = f"{rng.uniform(90, 100):.2f}"
+            return seller, [
+                callback_update(self.next_update_id(), seller, 'sell'),
+                message_update(self.next_update_id(), seller, f"{price} 100 50000 {rng.choice(index.BROWSE_CURRENCIES)}")
+            ]
+        
+        buyer = rng.choice(self.buyers)
+        if kind == 'start':
+            return buyer, [message_update(self.next_update_id(), buyer, '/start')]
+        if kind == 'profile':
+            return buyer, [callback_update(self.next_update_id(), buyer, 'profile')]
+        if kind == 'browse':
+            return buyer, [callback_update(self.next_update_id(), buyer, 'buy')]
+        if kind == 'deals':
+            return buyer, [callback_update(self.next_update_id(), buyer, 'deals')]
+        if kind == 'buy_offer':
+            offer_id, min_amount = rng.choice(self.offers)
+            return buyer, [
+                callback_update(self.next_update_id(), buyer, f'buy_{offer_id}'),
+                message_update(self.next_update_id(), buyer, min_amount)
+            ]
+        if kind == 'complete':
+            with self._lock:
+                deals = self.open_deals.get(buyer)
+                deal_id = deals.pop() if deals else 0
+            return buyer, [callback_update(self.next_update_id(), buyer, f'complete_{deal_id}')]
+        raise ValueError(f"unknown scenario: {kind}")
+
+
+def parse_mix(spec: Optional[str]) -> Dict[str, int]:
+    if not spec:
+        return dict(DEFAULT_MIX)
+    mix = {}
+    for part in spec.split(','):
+        kind, _, weight = part.partition('=')
+        if kind not in DEFAULT_MIX:
+            raise ValueError(f"unknown scenario in mix: {kind}")
+        mix[kind] = int(weight)
+    return mix
+
+
+def query_count() -> int:
+    return index.DB_QUERY_SECONDS.count()
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    values = sorted(latencies)
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 50) * 1000, 3),
+        'p95_ms': round(percentile(values, 95) * 1000, 3),
+        'p99_ms': round(percentile(values, 99) * 1000, 3),
+        'max_ms': round(values[-1] * 1000, 3) if values else 0.0,
+        'mean_ms': round(sum(values) / len(values) * 1000, 3) if values else 0.0
+    }
+
+
+def calibrate(population: Population, kinds: List[str]) -> Dict[str, float]:
+    round_trips = {}
+    for kind in kinds:
+        before = query_count()
+        updates = 0
+        for _ in range(CALIBRATION_ROUNDS):
+            _, batch = population.scenario(kind)
+            for update in batch:
+                index.handler({'httpMethod': 'POST', 'body': json.dumps(update)}, None)
+                updates += 1
+        round_trips[kind] = round((query_count() - before) / updates, 2)
+    return round_trips
+
+
+def run(population: Population, mix: Dict[str, int], total: int, concurrency: int) -> Dict[str, Any]:
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    latencies: Dict[str, List[float]] = {kind: [] for kind in kinds}
+    errors: Dict[str, int] = {}
+    lock = threading.Lock()
+    
+    def execute(kind: str, update: Dict[str, Any]):
+        event = {'httpMethod': 'POST', 'body': json.dumps(update)}
+        started = time.perf_counter()
+        response = index.handler(event, None)
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies[kind].append(elapsed)
+            if response['statusCode'] != 200:
+                errors[kind] = errors.get(kind, 0) + 1
+    
+    dispatcher = index.UpdateDispatcher(concurrency, max_pending=concurrency * 4)
+    futures = []
+    submitted = 0
+    before = query_count()
+    started = time.perf_counter()
+    while submitted < total:
+        kind = population.rng.choices(kinds, weights)[0]
+        chat_id, batch = population.scenario(kind)
+        for update in batch:
+            futures.append(dispatcher.submit(chat_id, execute, kind, update))
+            submitted += 1
+    for future in futures:
+        future.result()
+    wall = time.perf_counter() - started
+    dispatcher.shutdown()
+    
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        'overall': dict(
+            summarize(all_latencies),
+            throughput_per_s=round(len(all_latencies) / wall, 1),
+            wall_s=round(wall, 3),
+            db_round_trips_per_update=round((query_count() - before) / max(len(all_latencies), 1), 2),
+            errors=sum(errors.values())
+        ),
+        'kinds': {kind: dict(summarize(values), errors=errors.get(kind, 0)) for kind, values in latencies.items()}
+    }
+
+
+def probe_escrow_rounding() -> List[str]:
+    # Сумма с третьим знаком после запятой: эскроу должен списать, забронировать и
+    # вычесть из лимита одну и ту же округлённую сумму, иначе копейки появляются
+    # из ниоткуда или пропадают.
+    population = Population(1, 1, 0, 0, 0)
+    balance = STRESS_DEAL_AMOUNT * 3
+    capacity = STRESS_DEAL_AMOUNT * 10
+    with index.db_cursor() as cursor:
+        cursor.execute(
+            """INSERT INTO users (telegram_id, username, role, balance)
+               SELECT t, 'bench' || t, CASE WHEN t = %s THEN 'seller' ELSE 'buyer' END, %s
+               FROM unnest(%s::bigint[]) AS t
+               RETURNING id, role""",
+            (population.sellers[0], balance, population.buyers + population.sellers)
+        )
+        users = {user['role']: user['id'] for user in cursor.fetchall()}
+        cursor.execute(
+            """INSERT INTO offers (seller_id, price, min_amount, max_amount, currency)
+               VALUES (%s, 95, %s, %s, 'USDT') RETURNING id""",
+            (users['seller'], STRESS_DEAL_AMOUNT, capacity)
+        )
+        offer_id = cursor.fetchone()['id']
+        cursor.execute(
+            "SELECT * FROM escrow_open_deal(%s, %s, %s)",
+            (users['buyer'], offer_id, STRESS_DEAL_AMOUNT + Decimal('0.005'))
+        )
+        opened = cursor.fetchone()
+        cursor.execute(
+            """SELECT (SELECT sum(balance) FROM users WHERE id IN (%s, %s)) AS balances,
+                      (SELECT escrow_amount FROM deals WHERE id = %s) AS escrow,
+                      (SELECT amount FROM deals WHERE id = %s) AS booked,
+                      (SELECT max_amount FROM offers WHERE id = %s) AS remaining""",
+            (users['buyer'], users['seller'], opened['deal_id'], opened['deal_id'], offer_id)
+        )
+        escrowed = cursor.fetchone()
+        cursor.execute("SELECT * FROM escrow_transition(%s, %s, 'completed')", (opened['deal_id'], users['buyer']))
+        cursor.execute("SELECT sum(balance) AS balances FROM users WHERE id IN (%s, %s)", (users['buyer'], users['seller']))
+        completed = cursor.fetchone()
+        cursor.connection.commit()
+    
+    failures = []
+    if opened['result'] != 'created':
+        return [f"rounding probe: deal for {STRESS_DEAL_AMOUNT + Decimal('0.005')} not opened: {opened['result']}"]
+    if escrowed['balances'] + escrowed['escrow'] != balance * 2:
+        failures.append(f"rounding probe: balances {escrowed['balances']} + escrow {escrowed['escrow']} != {balance * 2}")
+    if escrowed['booked'] + escrowed['remaining'] != capacity:
+        failures.append(f"rounding probe: booked {escrowed['booked']} + remaining {escrowed['remaining']} != {capacity}")
+    if completed['balances'] != balance * 2:
+        failures.append(f"rounding probe: balances after completion {completed['balances']} != {balance * 2}")
+    return failures
+
+
+def bench_stress_offer(workers: int, rounds: int) -> Dict[str, Any]:
+    # Каждый покупатель достаётся двум воркерам, чтобы одновременные клики одного
+    # покупателя проверяли защиту от дублей. Лимита объявления хватает на половину
+    # покупателей; остаток меньше min_amount, и объявление должно сняться с публикации.
+    population = Population(max(workers // 2, 2), 1, 0, 0, 0)
+    buyers = population.buyers
+    expected_deals = len(buyers) // 2
+    capacity = STRESS_DEAL_AMOUNT * expected_deals + STRESS_DEAL_AMOUNT / 2
+    balance = STRESS_DEAL_AMOUNT * 3
+    with index.db_cursor() as cursor:
+        cursor.execute(
+            """INSERT INTO users (telegram_id, username, role, balance)
+               SELECT t, 'bench' || t, CASE WHEN t = %s THEN 'seller' ELSE 'buyer' END, %s
+               FROM unnest(%s::bigint[]) AS t
+               RETURNING id, role""",
+            (population.sellers[0], balance, buyers + population.sellers)
+        )
+        users = cursor.fetchall()
+        seller_id = next(user['id'] for user in users if user['role'] == 'seller')
+        buyer_ids = [user['id'] for user in users if user['role'] == 'buyer']
+        cursor.execute(
+            """INSERT INTO offers (seller_id, price, min_amount, max_amount, currency)
+               VALUES (%s, 95, %s, %s, 'USDT') RETURNING id""",
+            (seller_id, STRESS_DEAL_AMOUNT, capacity)
+        )
+        offer_id = cursor.fetchone()['id']
+        cursor.connection.commit()
+    index.order_book.mark_stale()
+    
+    statuses: Dict[int, int] = {}
+    lock = threading.Lock()
+    start = threading.Barrier(workers)
+    
+    def hammer(telegram_id: int):
+        start.wait()
+        for _ in range(rounds):
+            update = callback_update(population.next_update_id(), telegram_id, f'deal_{offer_id}:{STRESS_DEAL_AMOUNT}')
+            status = index.handler({'httpMethod': 'POST', 'body': json.dumps(update)}, None)['statusCode']
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+    
+    threads = [threading.Thread(target=hammer, args=(buyers[number % len(buyers)],)) for number in range(workers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    
+    with index.db_cursor() as cursor:
+        cursor.execute("SELECT max_amount, is_active FROM offers WHERE id = %s", (offer_id,))
+        offer = cursor.fetchone()
+        cursor.execute(
+            """SELECT count(*) AS deals, count(DISTINCT buyer_id) AS buyers,
+                      coalesce(sum(amount), 0) AS booked, coalesce(sum(escrow_amount), 0) AS escrow,
+                      count(*) FILTER (WHERE status <> 'escrow' OR amount <> %s OR escrow_amount <> amount) AS malformed
+               FROM deals WHERE offer_id = %s""",
+            (STRESS_DEAL_AMOUNT, offer_id)
+        )
+        deals = cursor.fetchone()
+        cursor.execute("SELECT coalesce(sum(balance), 0) AS total FROM users WHERE id = ANY(%s)", (buyer_ids,))
+        balances = cursor.fetchone()['total']
+    
+    failures = []
+    if deals['deals'] != expected_deals:
+        failures.append(f"booked {deals['deals']} deals, capacity allows exactly {expected_deals}")
+    if deals['deals'] != deals['buyers']:
+        failures.append(f"{deals['deals'] - deals['buyers']} duplicate deals for the same buyer")
+    if deals['malformed']:
+        failures.append(f"{deals['malformed']} deals not in escrow for the requested amount")
+    if deals['booked'] + offer['max_amount'] != capacity:
+        failures.append(f"offer capacity not conserved: booked {deals['booked']} + remaining {offer['max_amount']} != {capacity}")
+    if offer['is_active'] != (offer['max_amount'] >= STRESS_DEAL_AMOUNT):
+        failures.append(f"offer is_active={offer['is_active']} with {offer['max_amount']} remaining")
+    if balances + deals['escrow'] != balance * len(buyer_ids):
+        failures.append(f"buyer balances not conserved: {balances} + escrow {deals['escrow']} != {balance * len(buyer_ids)}")
+    failures.extend(probe_escrow_rounding())
+    
+    return {
+        'offer_id': offer_id,
+        'deals': deals['deals'],
+        'expected_deals': expected_deals,
+        'remaining': str(offer['max_amount']),
+        'statuses': statuses,
+        'wall_s': round(wall, 3),
+        'failures': failures
+    }
+
+
+def bench_render(rounds: int) -> Dict[str, Any]:
+    # Старый путь из истории репозитория: ответ и клавиатура собираются словарями
+    # на каждый запрос и целиком проходят через json.dumps с ASCII-экранированием.
+    chat_id = 1000000001
+    
+    def legacy_start() -> str:
+        keyboard = {'inline_keyboard': [
+            [{'text': '👤 Профиль', 'callback_data': 'profile'}],
+            [{'text': '🛒 Купить', 'callback_data': 'buy'}, {'text': '💼 Продать', 'callback_data': 'sell'}],
+            [{'text': '📋 Сделки', 'callback_data': 'deals'}, {'text': '💰 Баланс', 'callback_data': 'balance'}]
+        ]}
+        return json.dumps({
+            'method': 'sendMessage',
+            'chat_id': chat_id,
+            'text': f"""👋 <b>Добро пожаловать в P2P Exchange Bot!</b>
+
+Безопасная торговля виртуальной валютой с эскроу-защитой.
+
+Ваш текущий режим: <b>{index.ROLE_TEXTS['buyer']}</b>
+
+Выберите действие:""",
+            'parse_mode': 'HTML',
+            'reply_markup': keyboard
+        })
+    
+    def legacy_done() -> str:
+        keyboard = {'inline_keyboard': [[{'text': '🏠 Главное меню', 'callback_data': 'menu'}]]}
+        return json.dumps({
+            'method': 'sendMessage',
+            'chat_id': chat_id,
+            'text': f"✅ Снято с публикации: {rounds}",
+            'parse_mode': 'HTML',
+            'reply_markup': keyboard
+        })
+    
+    def render_start() -> str:
+        return index.encode_body(index.send_message(chat_id, index.WELCOME_TEXTS['buyer'], index.MAIN_MENU_KEYBOARD))
+    
+    def render_done() -> str:
+        return index.encode_body(index.send_message(chat_id, f"✅ Снято с публикации: {rounds}", index.MENU_KEYBOARD))
+    
+    result: Dict[str, Any] = {'json_backend': 'orjson' if index.orjson is not None else 'json'}
+    failures = []
+    for scenario, legacy, render in (('start', legacy_start, render_start), ('dynamic_text', legacy_done, render_done)):
+        if json.loads(legacy()) != json.loads(render()):
+            failures.append(f"{scenario}: rendered body differs from the legacy one")
+        result[scenario] = {}
+        for mode, build in (('legacy', legacy), ('render', render)):
+            build()
+            started = time.perf_counter()
+            for _ in range(rounds):
+                build()
+            result[scenario][mode] = {
+                'us_per_response': round((time.perf_counter() - started) / rounds * 1e6, 2),
+                'bytes': len(build().encode('utf-8'))
+            }
+    result['failures'] = failures
+    return result
+
+
+class Instance:
+    # Отдельный процесс с index.handler, как соседний serverless-инстанс: свои пулы,
+    # свой кеш пользователей и своя память о недавних записях.
+    def __init__(self):
+        env = dict(os.environ)
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        self.process = subprocess.Popen(
+            [sys.executable, '-c', INSTANCE_PROBE], cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
+        )
+    
+    def handle(self, update: Dict[str, Any]) -> Dict[str, Any]:
+        self.process.stdin.write(json.dumps(update) + '\n')
+        self.process.stdin.flush()
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise RuntimeError('bench instance exited')
+            if line.startswith(INSTANCE_BODY_PREFIX):
+                return json.loads(line[len(INSTANCE_BODY_PREFIX):])
+    
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+def bench_read_your_writes(rounds: int) -> Dict[str, Any]:
+    # Покупатель открывает сделку на одном инстансе и сразу открывает «Мои сделки»
+    # на другом. Реплика при этом должна реально отставать (например, из-за
+    # recovery_min_apply_delay), иначе проверка ничего не доказывает.
+    population = Population(rounds * 2, 1, 0, 0, 0)
+    with index.db_cursor() as cursor:
+        cursor.execute(
+            """INSERT INTO users (telegram_id, username, role, balance)
+               SELECT t, 'bench' || t, CASE WHEN t = %s THEN 'seller' ELSE 'buyer' END, %s
+               FROM unnest(%s::bigint[]) AS t
+               RETURNING id, telegram_id""",
+            (population.sellers[0], STRESS_DEAL_AMOUNT, population.buyers + population.sellers)
+        )
+        user_ids = {user['telegram_id']: user['id'] for user in cursor.fetchall()}
+        cursor.execute(
+            """INSERT INTO offers (seller_id, price, min_amount, max_amount, currency)
+               VALUES (%s, 95, %s, %s, 'USDT') RETURNING id""",
+            (user_ids[population.sellers[0]], STRESS_DEAL_AMOUNT, STRESS_DEAL_AMOUNT * (rounds * 2 + 1))
+        )
+        offer_id = cursor.fetchone()['id']
+        cursor.connection.commit()
+    
+    replica = index.psycopg2.connect(index.DATABASE_READ_URLS[0])
+    replica.autocommit = True
+    
+    def on_replica(query: str, params: Tuple) -> bool:
+        with replica.cursor() as cursor:
+            cursor.execute(query, params)
+            return cursor.fetchone() is not None
+    
+    deadline = time.monotonic() + READ_YOUR_WRITES_SYNC_TIMEOUT
+    while not on_replica("SELECT 1 FROM offers WHERE id = %s", (offer_id,)):
+        if time.monotonic() > deadline:
+            raise SystemExit(f"replica did not receive the seeded offer within {READ_YOUR_WRITES_SYNC_TIMEOUT} s")
+        time.sleep(0.1)
+    
+    def check(buyers: List[int], write: Callable, read: Callable) -> Dict[str, Any]:
+        missed = behind = 0
+        for telegram_id in buyers:
+            write(callback_update(population.next_update_id(), telegram_id, f'deal_{offer_id}:{STRESS_DEAL_AMOUNT}'))
+            with index.db_cursor() as cursor:
+                cursor.execute("SELECT id FROM deals WHERE buyer_id = %s AND offer_id = %s", (user_ids[telegram_id], offer_id))
+                deal_id = cursor.fetchone()['id']
+            body = read(callback_update(population.next_update_id(), telegram_id, 'deals'))
+            if f"Сделка #{deal_id}\n" not in body.get('text', ''):
+                missed += 1
+            if not on_replica("SELECT 1 FROM deal_feed WHERE deal_id = %s", (deal_id,)):
+                behind += 1
+        return {'rounds': len(buyers), 'missed': missed, 'replica_behind': behind}
+    
+    def local(update: Dict[str, Any]) -> Dict[str, Any]:
+        return json.loads(index.handler({'httpMethod': 'POST', 'body': json.dumps(update)}, None)['body'])
+    
+    first, second = Instance(), Instance()
+    try:
+        scenarios = {'two_instances': check(population.buyers[:rounds], first.handle, second.handle)}
+    finally:
+        first.close()
+        second.close()
+    # poll/serve: один процесс, реплики включены, привязка к primary общая
+    index.enable_read_replicas()
+    scenarios['one_process'] = check(population.buyers[rounds:], local, local)
+    replica.close()
+    
+    failures = []
+    for scenario, outcome in scenarios.items():
+        if outcome['missed']:
+            failures.append(f"{scenario}: {outcome['missed']} of {outcome['rounds']} reads missed the deal just opened")
+        if not outcome['replica_behind']:
+            failures.append(f"{scenario}: the replica was never behind, so the check is inconclusive")
+    return {'offer_id': offer_id, 'scenarios': scenarios, 'failures': failures}
+
+
+def bench_match(offers: int, rounds: int, seed: int) -> Dict[str, Any]:
+    rng = random.Random(seed)
+    sellers = max(offers // 5, 1)
+    book_rows = []
+    for offer_id in range(1, offers + 1):
+        min_amount = Decimal(rng.choice((100, 500, 1000)))
+        book_rows.append(index.Offer(
+            id=offer_id,
+            seller_id=rng.randint(1, sellers),
+            price=Decimal(rng.randint(8000, 10000)) / 100,
+            min_amount=min_amount,
+            max_amount=min_amount + rng.randint(0, 50000),
+            currency=rng.choice(index.BROWSE_CURRENCIES),
+            username=f'seller{offer_id}',
+            rating=Decimal('5.0'),
+            completed_deals=0
+        ))
+    
+    book = index.OrderBook(float('inf'))
+    started = time.perf_counter()
+    book.load(book_rows)
+    load_s = time.perf_counter() - started
+    
+    match_latencies, churn_latencies, fills = [], [], 0
+    started = time.perf_counter()
+    for _ in range(rounds):
+        currency = rng.choice(index.BROWSE_CURRENCIES)
+        amount = Decimal(rng.randint(1000, 200000))
+        began = time.perf_counter()
+        fills += len(book.match(currency, amount, rng.randint(1, sellers)))
+        match_latencies.append(time.perf_counter() - began)
+    wall = time.perf_counter() - started
+    
+    for _ in range(rounds):
+        offer = rng.choice(book_rows)._replace(price=Decimal(rng.randint(8000, 10000)) / 100)
+        began = time.perf_counter()
+        book.add(offer)
+        churn_latencies.append(time.perf_counter() - began)
+    
+    return {
+        'overall': dict(summarize(match_latencies), throughput_per_s=round(rounds / wall, 1), fills_per_match=round(fills / rounds, 2)),
+        'load_ms': round(load_s * 1000, 1),
+        'reprice': summarize(churn_latencies)
+    }
+
+
+def bench_rows(population: Population, rounds: int) -> Dict[str, Any]:
+    with index.db_cursor() as cursor:
+        cursor.execute("SELECT id FROM users WHERE telegram_id = %s", (population.buyers[0],))
+        user_id = cursor.fetchone()['id']
+    
+    deal_feed = """SELECT deal_id AS id, buyer_id, seller_id, buyer_name, seller_name, amount, currency, status, created_at
+                   FROM deal_feed WHERE user_id = %s ORDER BY created_at DESC, deal_id DESC LIMIT %s"""
+    offers_page = f"SELECT {index.OFFER_READ_COLUMNS} FROM offer_book b ORDER BY b.price, b.offer_id LIMIT %s"
+    shapes = {
+        'user': ("SELECT * FROM users WHERE id = %s", f"SELECT {index.USER_COLUMNS} FROM users WHERE id = %s", index.User, (user_id,)),
+        'offers_page': (offers_page, offers_page, index.Offer, (index.OFFERS_PAGE_SIZE + 1,)),
+        'deals_page': (deal_feed, deal_feed, index.DealSummary, (user_id, index.DEALS_PAGE_SIZE + 1))
+    }
+    
+    def fetch_dicts(query: str, record: Any, params: Tuple) -> List[Any]:
+        with index.db_cursor() as cursor:
+            cursor.execute(query, params)
+            return [dict(row) for row in cursor.fetchall()]
+    
+    def fetch_records(query: str, record: Any, params: Tuple) -> List[Any]:
+        with index.db_cursor(tuples=True) as cursor:
+            cursor.execute(query, params)
+            return list(map(record._make, cursor.fetchall()))
+    
+    result: Dict[str, Any] = {}
+    with index.db_request():
+        for shape, (dict_query, record_query, record, params) in shapes.items():
+            result[shape] = {}
+            for mode, fetch, query in (('dict', fetch_dicts, dict_query), ('record', fetch_records, record_query)):
+                latencies = []
+                for _ in range(rounds):
+                    started = time.perf_counter()
+                    fetch(query, record, params)
+                    latencies.append(time.perf_counter() - started)
+                
+                tracemalloc.start()
+                kept = [fetch(query, record, params) for _ in range(ROW_MEMORY_SAMPLES)]
+                retained = tracemalloc.get_traced_memory()[0]
+                tracemalloc.stop()
+                result[shape][mode] = {
+                    'p50_us': round(percentile(sorted(latencies), 50) * 1e6, 1),
+                    'retained_bytes': retained // ROW_MEMORY_SAMPLES,
+                    'rows': len(kept[0])
+                }
+    return result
+
+
+def bench_startup(runs: int) -> Dict[str, Any]:
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    for attempt in range(runs + 1):
+        started = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, '-c', STARTUP_PROBE], cwd=cwd, env=env, capture_output=True, text=True, check=True
+        ).stdout
+        sample = dict(json.loads(output), process_ms=(time.perf_counter() - started) * 1000)
+        if attempt:
+            samples.append(sample)
+    
+    def median(key: str) -> float:
+        return round(statistics.median(sample[key] for sample in samples), 2)
+    
+    return {
+        'import_ms': median('import_ms'),
+        'first_request_ms': median('first_request_ms'),
+        'process_ms': median('process_ms'),
+        'lazy_loaded': sorted({name for sample in samples for name in sample['lazy_loaded']})
+    }
+
+
+class TelegramStandIn(http.server.ThreadingHTTPServer):
+    # Подставной Bot API: записывает время каждого sendMessage по чатам и отвечает
+    # 429 с retry_after, 500 или 400 для служебных chat_id.
+    daemon_threads = True
+    
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), TelegramStandInHandler)
+        self.calls: Dict[int, List[float]] = {}
+        self.lock = threading.Lock()
+    
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class TelegramStandInHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        chat_id = payload['chat_id']
+        with self.server.lock:
+            self.server.calls.setdefault(chat_id, []).append(time.monotonic())
+        if chat_id == OUTBOX_CHAT_429:
+            status, body = 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+                                 'parameters': {'retry_after': OUTBOX_RETRY_AFTER}}
+        elif chat_id == OUTBOX_CHAT_500:
+            status, body = 500, {'ok': False, 'error_code': 500, 'description': 'Internal Server Error'}
+        elif chat_id == OUTBOX_CHAT_400:
+            status, body = 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: chat not found'}
+        else:
+            status, body = 200, {'ok': True, 'result': {'message_id': 1, 'chat': {'id': chat_id}}}
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def log_message(self, format: str, *args: Any):
+        pass
+
+
+def bench_outbox() -> Dict[str, Any]:
+    server = TelegramStandIn()
+    threading.Thread(target=server.serve_forever, name='telegram-standin', daemon=True).start()
+    saved = index.TELEGRAM_API_URL, index.TELEGRAM_BOT_TOKEN
+    index.TELEGRAM_API_URL, index.TELEGRAM_BOT_TOKEN = server.url, OUTBOX_STANDIN_TOKEN
+    sender = index.OutboxSender(index.OUTBOX_WORKERS, index.OUTBOX_BATCH_SIZE)
+    sender.limiter = index.RateLimiter(OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE)
+    next_id = iter(range(1, 1000000))
+    
+    def message(chat_id: int, attempts: int = 1) -> Dict[str, Any]:
+        return {'id': next(next_id), 'chat_id': chat_id, 'method': 'sendMessage',
+                'payload': {'text': 'bench', 'parse_mode': 'HTML'}, 'attempts': attempts}
+    
+    def deliver(lanes: List[List[Dict[str, Any]]]) -> Dict[int, Tuple[str, Optional[str], float]]:
+        return {
+            message_id: (status, error, delay)
+            for lane in sender.executor.map(sender._deliver_lane, lanes)
+            for message_id, status, error, delay in lane
+        }
+    
+    failures: List[str] = []
+    try:
+        lanes = [[message(chat_id) for _ in range(OUTBOX_PACED_PER_CHAT)] for chat_id in range(1, OUTBOX_PACED_CHATS + 1)]
+        started = time.monotonic()
+        results = deliver(lanes)
+        wall = time.monotonic() - started
+        sent = sum(1 for status, _, _ in results.values() if status == 'sent')
+        total = OUTBOX_PACED_CHATS * OUTBOX_PACED_PER_CHAT
+        if sent != total:
+            failures.append(f"pacing: {sent} of {total} messages sent")
+        min_chat_gap = min(
+            later - earlier
+            for chat_id in range(1, OUTBOX_PACED_CHATS + 1)
+            for earlier, later in zip(server.calls[chat_id], server.calls[chat_id][1:])
+        )
+        if min_chat_gap < 1 / OUTBOX_CHAT_RATE - OUTBOX_TIMING_SLACK:
+            failures.append(f"pacing: chat gap {min_chat_gap:.3f} s below 1/{OUTBOX_CHAT_RATE} s")
+        # Глобальное ведро стартует полным (OUTBOX_GLOBAL_RATE токенов), остальное идёт по темпу.
+        min_wall = (total - OUTBOX_GLOBAL_RATE) / OUTBOX_GLOBAL_RATE
+        if wall < min_wall - OUTBOX_TIMING_SLACK:
+            failures.append(f"pacing: {total} messages in {wall:.3f} s, global rate allows no less than {min_wall:.3f} s")
+        
+        throttled = [message(OUTBOX_CHAT_429) for _ in range(3)]
+        results = deliver([throttled])
+        if len(server.calls.get(OUTBOX_CHAT_429, [])) != 1:
+            failures.append(f"429: lane kept sending after retry_after ({len(server.calls[OUTBOX_CHAT_429])} calls)")
+        if any(results[queued['id']][0] != 'pending' or results[queued['id']][2] != OUTBOX_RETRY_AFTER for queued in throttled):
+            failures.append(f"429: expected the whole lane rescheduled after {OUTBOX_RETRY_AFTER} s, got {sorted(results.values())}")
+        
+        transient = [message(OUTBOX_CHAT_500, attempts) for attempts in range(1, index.OUTBOX_MAX_ATTEMPTS + 1)]
+        rejected = message(OUTBOX_CHAT_400)
+        results = deliver([transient, [rejected]])
+        for queued in transient:
+            status, _, delay = results[queued['id']]
+            expected = ('pending', float(2 ** queued['attempts'])) if queued['attempts'] < index.OUTBOX_MAX_ATTEMPTS else ('failed', 0.0)
+            if (status, delay) != expected:
+                failures.append(f"5xx: attempt {queued['attempts']} gave {status}/{delay}, expected {expected[0]}/{expected[1]}")
+        if len(server.calls.get(OUTBOX_CHAT_500, [])) != len(transient):
+            failures.append('5xx: lane stopped after a transient error')
+        if results[rejected['id']][0] != 'failed':
+            failures.append(f"4xx: expected failed without retry, got {results[rejected['id']][0]}")
+    finally:
+        index.TELEGRAM_API_URL, index.TELEGRAM_BOT_TOKEN = saved
+        sender.executor.shutdown(wait=True)
+        server.shutdown()
+        server.server_close()
+    
+    return {
+        'paced': {'messages': total, 'wall_s': round(wall, 3), 'min_wall_s': round(min_wall, 3), 'min_chat_gap_s': round(min_chat_gap, 3)},
+        'failures': failures
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline: Dict[str, Any], result: Dict[str, Any]):
+    print(f"\ncompared with {baseline.get('commit')}:")
+    for key in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_per_s', 'db_round_trips_per_update'):
+        old, new = baseline['overall'].get(key), result['overall'].get(key)
+        if old and new is not None:
+            print(f"  {key:<28} {old:>10} -> {new:<10} ({(new - old) / old * 100:+.1f}%)")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Replay synthetic Telegram updates through handler')
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=index.DB_POOL_MAX_SIZE)
+    parser.add_argument('--buyers', type=int, default=200)
+    parser.add_argument('--sellers', type=int, default=50)
+    parser.add_argument('--offers-per-seller', type=int, default=4)
+    parser.add_argument('--deals-per-buyer', type=int, default=3)
+    parser.add_argument('--mix', help='scenario weights, e.g. browse=50,deals=50')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench-result.json')
+    parser.add_argument('--compare', help='previous result JSON to diff against')
+    parser.add_argument('--match-offers', type=int, help='benchmark the in-memory matching engine at this book depth instead (no database)')
+    parser.add_argument('--match-rounds', type=int, default=2000)
+    parser.add_argument('--rows', type=int, help='compare dict and tuple-record row fetching over this many rounds per query shape')
+    parser.add_argument('--startup', action='store_true', help='measure cold import and first DB-free request in fresh interpreters')
+    parser.add_argument('--startup-runs', type=int, default=15)
+    parser.add_argument('--startup-budget-ms', type=float, default=float(os.environ.get('STARTUP_BUDGET_MS', '75')))
+    parser.add_argument('--stress-offer', type=int, metavar='WORKERS', help='hammer one offer from this many concurrent workers and check escrow invariants')
+    parser.add_argument('--stress-rounds', type=int, default=5, help='deal attempts per stress worker')
+    parser.add_argument('--render', type=int, metavar='ROUNDS', help='compare per-request dict building with BotMessage/Keyboard serialization (no database)')
+    parser.add_argument('--read-your-writes', type=int, metavar='ROUNDS', help='open a deal on one instance and list deals on another, against DATABASE_READ_URL')
+    parser.add_argument('--outbox', action='store_true', help='check outbox pacing, 429 and 5xx handling against a local Bot API stand-in (no database)')
+    args = parser.parse_args(argv)
+    
+    if args.outbox:
+        result = {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'config': {'chat_rate': OUTBOX_CHAT_RATE, 'global_rate': OUTBOX_GLOBAL_RATE, 'max_attempts': index.OUTBOX_MAX_ATTEMPTS},
+            **bench_outbox()
+        }
+        paced = result['paced']
+        print(f"{paced['messages']} messages paced in {paced['wall_s']} s (global floor {paced['min_wall_s']} s), "
+              f"min per-chat gap {paced['min_chat_gap_s']} s; 429 and 5xx checks "
+              f"{'failed' if result['failures'] else 'passed'}")
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        if result['failures']:
+            raise SystemExit('\n'.join(result['failures']))
+        return
+    
+    if args.startup:
+        result = {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'config': {'startup_runs': args.startup_runs, 'budget_ms': args.startup_budget_ms},
+            **bench_startup(args.startup_runs)
+        }
+        cold_ms = round(result['import_ms'] + result['first_request_ms'], 1)
+        print(f"import {result['import_ms']} ms + first request {result['first_request_ms']} ms = {cold_ms} ms "
+              f"(budget {args.startup_budget_ms} ms), interpreter total {result['process_ms']} ms")
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        if result['lazy_loaded']:
+            raise SystemExit(f"DB-free requests imported {', '.join(result['lazy_loaded'])}")
+        if cold_ms > args.startup_budget_ms:
+            raise SystemExit(f"cold start {cold_ms} ms exceeds budget {args.startup_budget_ms} ms")
+        return
+    
+    if args.render:
+        result = {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'config': {'rounds': args.render},
+            **bench_render(args.render)
+        }
+        for scenario in ('start', 'dynamic_text'):
+            old, new = result[scenario]['legacy'], result[scenario]['render']
+            print(f"  {scenario:<12} legacy {old['us_per_response']:>6} us {old['bytes']:>5} B  "
+                  f"render {new['us_per_response']:>6} us {new['bytes']:>5} B  ({result['json_backend']})")
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        if result['failures']:
+            raise SystemExit('\n'.join(result['failures']))
+        return
+    
+    if args.match_offers:
+        result = {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'config': {'match_offers': args.match_offers, 'match_rounds': args.match_rounds, 'max_fills': index.MATCH_MAX_FILLS},
+            **bench_match(args.match_offers, args.match_rounds, args.seed)
+        }
+        overall = result['overall']
+        print(f"{args.match_offers} resting offers loaded in {result['load_ms']} ms; match p50 {overall['p50_ms']} ms, "
+              f"p95 {overall['p95_ms']} ms, p99 {overall['p99_ms']} ms, {overall['throughput_per_s']}/s, "
+              f"{overall['fills_per_match']} fills/match; reprice p99 {result['reprice']['p99_ms']} ms")
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        if args.compare:
+            with open(args.compare) as f:
+                compare(json.load(f), result)
+        return
+    
+    if not os.environ.get('DATABASE_URL'):
+        parser.error('DATABASE_URL must point to a local database with db_migrations applied')
+    
+    if args.read_your_writes:
+        if not index.DATABASE_READ_URLS:
+            parser.error('--read-your-writes needs DATABASE_READ_URL pointing at a lagging replica')
+        result = {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'config': {'rounds': args.read_your_writes, 'sticky_seconds': index.READ_YOUR_WRITES_SECONDS},
+            **bench_read_your_writes(args.read_your_writes)
+        }
+        for scenario, outcome in result['scenarios'].items():
+            print(f"  {scenario:<14} {outcome['rounds']} rounds, {outcome['missed']} missed writes, "
+                  f"replica behind in {outcome['replica_behind']}")
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        if result['failures']:
+            raise SystemExit('\n'.join(result['failures']))
+        return
+    
+    if args.stress_offer:
+        result = {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'config': {'workers': args.stress_offer, 'rounds': args.stress_rounds, 'pool_max_size': index.DB_POOL_MAX_SIZE},
+            **bench_stress_offer(args.stress_offer, args.stress_rounds)
+        }
+        print(f"{args.stress_offer} workers x {args.stress_rounds} attempts on offer #{result['offer_id']} in {result['wall_s']} s: "
+              f"{result['deals']} deals (expected {result['expected_deals']}), {result['remaining']} left, "
+              f"HTTP statuses {result['statuses']}")
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        if result['failures']:
+            raise SystemExit('\n'.join(result['failures']))
+        return
+    
+    mix = parse_mix(args.mix)
+    population = Population(args.buyers, args.sellers, args.offers_per_seller, args.deals_per_buyer, args.seed)
+    population.seed()
+    
+    if args.rows:
+        result = {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'config': {'rounds': args.rows},
+            'shapes': bench_rows(population, args.rows)
+        }
+        for shape, modes in result['shapes'].items():
+            old, new = modes['dict'], modes['record']
+            print(f"  {shape:<12} rows {new['rows']:<3} dict {old['p50_us']:>7} us {old['retained_bytes']:>6} B  "
+                  f"record {new['p50_us']:>7} us {new['retained_bytes']:>6} B")
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        return
+    
+    round_trips = calibrate(population, list(mix))
+    outcome = run(population, mix, args.updates, args.concurrency)
+    for kind, value in round_trips.items():
+        outcome['kinds'][kind]['db_round_trips'] = value
+    
+    result = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {
+            'updates': args.updates,
+            'concurrency': args.concurrency,
+            'buyers': args.buyers,
+            'sellers': args.sellers,
+            'offers': len(population.offers),
+            'mix': mix,
+            'pool_max_size': index.DB_POOL_MAX_SIZE,
+            'order_book_snapshot': index.ORDER_BOOK_SNAPSHOT,
+            'read_replicas': len(index.read_router.replicas),
+            'session_store': index.SESSION_STORE
+        },
+        **outcome
+    }
+    
+    overall = result['overall']
+    print(f"{overall['count']} updates in {overall['wall_s']} s, {overall['throughput_per_s']}/s, "
+          f"p50 {overall['p50_ms']} ms, p95 {overall['p95_ms']} ms, p99 {overall['p99_ms']} ms, "
+          f"{overall['db_round_trips_per_update']} queries/update, {overall['errors']} errors")
+    for kind, stats in result['kinds'].items():
+        print(f"  {kind:<14} n={stats['count']:<6} p50 {stats['p50_ms']:>8} ms  p95 {stats['p95_ms']:>8} ms  "
+              f"p99 {stats['p99_ms']:>8} ms  queries {stats.get('db_round_trips', '-')}")
+    
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), result)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,141 @@
+import bisect
+import csv
+import functools
+import heapq
+import hmac
+import importlib
+import itertools
 import json
 import os
-from typing import Dict, Any, Optional, List
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import sys
+import threading
+import time
+import traceback
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+from typing import Dict, Any, Optional, List, Iterator, Tuple, Callable, NamedTuple
+
+
+class LazyModule:
+    # Импорт откладывается до первого обращения к атрибуту, после чего имя
+    # в модуле перепривязывается к настоящему модулю: холодный старт функции
+    # не платит за драйвер БД, asyncio и HTTP-клиент на путях, где они не нужны.
+    def __init__(self, name: str, submodules: Tuple[str, ...] = ()):
+        self._name = name
+        self._submodules = submodules
+    
+    def __getattr__(self, attr: str) -> Any:
+        module = importlib.import_module(self._name)
+        for submodule in self._submodules:
+            importlib.import_module(f"{self._name}.{submodule}")
+        globals()[self._name] = module
+        return getattr(module, attr)
+
+
+argparse = LazyModule('argparse')
+asyncio = LazyModule('asyncio')
+psycopg2 = LazyModule('psycopg2', ('extensions', 'extras', 'pool'))
+urllib = LazyModule('urllib', ('error', 'request'))
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '5'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+DB_HEALTHCHECK_INTERVAL = float(os.environ.get('DB_HEALTHCHECK_INTERVAL', '30'))
+DATABASE_READ_URLS = [url.strip() for url in os.environ.get('DATABASE_READ_URL', '').split(',') if url.strip()]
+DB_REPLICA_RETRY_INTERVAL = float(os.environ.get('DB_REPLICA_RETRY_INTERVAL', '30'))
+READ_YOUR_WRITES_SECONDS = float(os.environ.get('READ_YOUR_WRITES_SECONDS', '5'))
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '10000'))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', '60'))
+ORDER_BOOK_SNAPSHOT = os.environ.get('ORDER_BOOK_SNAPSHOT', '0') == '1'
+ORDER_BOOK_REFRESH_INTERVAL = float(os.environ.get('ORDER_BOOK_REFRESH_INTERVAL', '30'))
+OFFERS_PAGE_SIZE = 5
+BROWSE_CURRENCIES = ('USDT', 'BTC', 'ETH')
+DEALS_PAGE_SIZE = 10
+TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '')
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+OUTBOX_GLOBAL_RATE = float(os.environ.get('OUTBOX_GLOBAL_RATE', '30'))
+OUTBOX_CHAT_RATE = float(os.environ.get('OUTBOX_CHAT_RATE', '1'))
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '50'))
+OUTBOX_WORKERS = int(os.environ.get('OUTBOX_WORKERS', '4'))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '5'))
+OUTBOX_LEASE_SECONDS = 60
+UPDATE_DEDUP_WINDOW = int(os.environ.get('UPDATE_DEDUP_WINDOW', '10000'))
+UPDATE_LEDGER_RETENTION_HOURS = int(os.environ.get('UPDATE_LEDGER_RETENTION_HOURS', '24'))
+UPDATE_LEDGER_PRUNE_INTERVAL = float(os.environ.get('UPDATE_LEDGER_PRUNE_INTERVAL', '600'))
+UPDATE_LEDGER_PRUNE_BATCH = 5000
+ROUTE_SEPARATORS = '_:'
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', '8'))
+POLL_TIMEOUT = int(os.environ.get('POLL_TIMEOUT', '30'))
+DISPATCH_MAX_PENDING = int(os.environ.get('DISPATCH_MAX_PENDING', '1000'))
+DISPATCH_MAX_LANE_DEPTH = int(os.environ.get('DISPATCH_MAX_LANE_DEPTH', '50'))
+DISPATCH_SUBMIT_TIMEOUT = float(os.environ.get('DISPATCH_SUBMIT_TIMEOUT', '5'))
+CHAT_ADVISORY_LOCKS = os.environ.get('CHAT_ADVISORY_LOCKS', '0') == '1'
+DB_PREPARED_STATEMENTS = os.environ.get('DB_PREPARED_STATEMENTS', '1') == '1'
+SESSION_STORE = os.environ.get('SESSION_STORE', 'memory')
+SESSION_TTL = int(os.environ.get('SESSION_TTL', '900'))
+SESSION_MAX_SIZE = int(os.environ.get('SESSION_MAX_SIZE', '1000000'))
+SESSION_PRUNE_INTERVAL = float(os.environ.get('SESSION_PRUNE_INTERVAL', '600'))
+SESSION_PRUNE_BATCH = 5000
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILE_SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', '0'))
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', '0.005'))
+PROFILE_TOP_STACKS = 20
+BULK_MAX_ROWS = int(os.environ.get('BULK_MAX_ROWS', '1000'))
+BULK_CSV_MAX_BYTES = int(os.environ.get('BULK_CSV_MAX_BYTES', '262144'))
+BULK_ERRORS_SHOWN = 10
+OFFER_CSV_COLUMNS = ('price', 'min_amount', 'max_amount', 'currency')
+OFFER_PRICE_LIMIT = Decimal('1e8')
+OFFER_AMOUNT_LIMIT = Decimal('1e13')
+RATING_LIMIT = Decimal('10')
+OFFER_CURRENCY_MAX_LENGTH = 10
+DB_INT_MAX = 2 ** 31 - 1
+MONEY_QUANTUM = Decimal('0.01')
+DEAL_ESCROW_TTL_HOURS = int(os.environ.get('DEAL_ESCROW_TTL_HOURS', '72'))
+OFFER_STALE_DAYS = int(os.environ.get('OFFER_STALE_DAYS', '14'))
+DEAL_ARCHIVE_AFTER_DAYS = int(os.environ.get('DEAL_ARCHIVE_AFTER_DAYS', '30'))
+MAINTENANCE_INTERVAL = float(os.environ.get('MAINTENANCE_INTERVAL', '300'))
+MAINTENANCE_BATCH_SIZE = int(os.environ.get('MAINTENANCE_BATCH_SIZE', '500'))
+MAINTENANCE_MAX_BATCHES = int(os.environ.get('MAINTENANCE_MAX_BATCHES', '20'))
+MATCH_MAX_FILLS = int(os.environ.get('MATCH_MAX_FILLS', '10'))
+MATCH_QUOTE_DEPTH = 200
+ADMIN_TELEGRAM_IDS = frozenset(int(value) for value in os.environ.get('ADMIN_TELEGRAM_IDS', '').split(',') if value.strip())
+DISPUTES_PAGE_SIZE = 10
+REPORT_DAYS = int(os.environ.get('REPORT_DAYS', '30'))
+REPORT_MAX_DAYS = 36500
+REPORT_TOP_USERS = 10
+DATABASE_REPORT_URL = os.environ.get('DATABASE_REPORT_URL') or (DATABASE_READ_URLS or [os.environ.get('DATABASE_URL')])[0]
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '5000'))
+DEAL_STATUS_FILTERS = (('escrow', '🔒'), ('completed', '✅'), ('dispute', '⚠️'))
+DEAL_TRANSITION_NOTIFICATIONS = {
+    'completed': "✅ <b>Сделка #{deal_id} завершена</b>\n\nСредства зачислены на баланс.",
+    'cancelled': "❌ <b>Сделка #{deal_id} отменена продавцом</b>\n\nСредства возвращены на баланс.",
+    'dispute': "⚠️ <b>По сделке #{deal_id} открыт спор</b>\n\nАдминистратор свяжется с вами."
+}
+DISPUTE_ADMIN_NOTIFICATION = "🛎 <b>Новый спор по сделке #{deal_id}</b>\n\n💵 {amount:.0f}₽ • {currency}"
+DISPUTE_RESOLVED_NOTIFICATIONS = {
+    'completed': "⚖️ <b>Спор по сделке #{deal_id} решён в пользу продавца</b>\n\nСредства из эскроу переведены продавцу.",
+    'cancelled': "⚖️ <b>Спор по сделке #{deal_id} решён в пользу покупателя</b>\n\nСредства из эскроу возвращены покупателю."
+}
+DEAL_EXPIRED_NOTIFICATION = "⌛ <b>Сделка #{deal_id} отменена по истечении срока</b>\n\nСредства из эскроу возвращены покупателю."
+OFFERS_EXPIRED_NOTIFICATION = "📭 <b>Объявления сняты с публикации</b>\n\nНе обновлялись {days} дн.: {offer_ids}"
+DEAL_ERROR_TEXTS = {
+    'offer_unavailable': "❌ Предложение недоступно",
+    'own_offer': "❌ Нельзя купить у самого себя",
+    'invalid_amount': "❌ Сумма вне лимитов объявления",
+    'insufficient_funds': "❌ Недостаточно средств на балансе",
+    'not_found': "❌ Сделка не найдена",
+    'invalid_transition': "❌ Действие недоступно для этой сделки"
+}
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -25,6 +158,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
+    if method == 'GET' and METRICS_TOKEN:
+        return metrics_response(event)
+    
     if method != 'POST':
         return {
             'statusCode': 405,
@@ -35,589 +171,3046 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     try:
         update = json.loads(event.get('body', '{}'))
-        
-        if 'message' in update:
-            message = update['message']
-            chat_id = message['chat']['id']
-            text = message.get('text', '')
-            username = message.get('from', {}).get('username', 'Anonymous')
-            telegram_id = message['from']['id']
-            
-            response_data = handle_message(telegram_id, username, text, chat_id)
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json'},
-                'body': json.dumps(response_data),
-                'isBase64Encoded': False
-            }
-        
-        elif 'callback_query' in update:
-            callback = update['callback_query']
-            chat_id = callback['message']['chat']['id']
-            data = callback['data']
-            telegram_id = callback['from']['id']
-            username = callback['from'].get('username', 'Anonymous')
-            
-            response_data = handle_callback(telegram_id, username, data, chat_id)
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json'},
-                'body': json.dumps(response_data),
-                'isBase64Encoded': False
-            }
-        
+        return webhook_response(process_update(update))
+    except Exception as e:
+        UPDATE_ERRORS.inc(type(e).__name__)
+        traceback.print_exc()
         return {
-            'statusCode': 200,
+            'statusCode': 500,
             'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps({'ok': True}),
+            'body': json.dumps({'error': 'Internal error'}),
             'isBase64Encoded': False
         }
-        
-    except Exception as e:
+
+
+def metrics_response(event: Dict[str, Any]) -> Dict[str, Any]:
+    # У функции один URL, поэтому GET отдаёт метрики, только если задан METRICS_TOKEN
+    # и запрос передал его в заголовке X-Metrics-Token или параметре token.
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+    token = headers.get('x-metrics-token') or (event.get('queryStringParameters') or {}).get('token') or ''
+    if not hmac.compare_digest(token.encode('utf-8'), METRICS_TOKEN.encode('utf-8')):
         return {
-            'statusCode': 500,
+            'statusCode': 403,
             'headers': {'Content-Type': 'application/json'},
-            'body': json.dumps({'error': str(e)}),
+            'body': json.dumps({'error': 'Forbidden'}),
             'isBase64Encoded': False
         }
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'text/plain; version=0.0.4'},
+        'body': metrics.render(),
+        'isBase64Encoded': False
+    }
 
 
-def get_db_connection():
-    database_url = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(database_url, cursor_factory=RealDictCursor)
+def timed_encode_body(response_data: Dict[str, Any]) -> str:
+    started = time.perf_counter()
+    body = encode_body(response_data)
+    RENDER_SECONDS.observe(time.perf_counter() - started)
+    return body
 
 
-def get_or_create_user(telegram_id: int, username: str) -> Dict[str, Any]:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        "SELECT * FROM users WHERE telegram_id = %s",
-        (telegram_id,)
-    )
-    user = cursor.fetchone()
+def webhook_response(response_data: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json'},
+        'body': timed_encode_body(response_data) if response_data is not None else OK_BODY,
+        'isBase64Encoded': False
+    }
+
+
+def process_update(update: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    kind = 'message' if 'message' in update else 'callback_query' if 'callback_query' in update else None
+    if kind is None:
+        return None
     
-    if not user:
-        cursor.execute(
-            """INSERT INTO users (telegram_id, username) 
-               VALUES (%s, %s) RETURNING *""",
-            (telegram_id, username)
-        )
-        user = cursor.fetchone()
-        conn.commit()
+    update_id: Optional[int] = update.get('update_id')
+    if update_id is not None and update_ledger.seen(update_id):
+        return None
     
-    cursor.close()
-    conn.close()
+    started = time.perf_counter()
+    try:
+        chat_id = get_update_chat_id(update) if CHAT_ADVISORY_LOCKS else None
+        user_key = update[kind].get('from', {}).get('id') if read_router.replicas else None
+        with slow_request_profiler.profile(f"{kind} {update_id}"), db_request(update_id, chat_id, user_key) as request:
+            response_data = route_update(update)
+    except DuplicateUpdate:
+        return None
+    except Exception:
+        if update_id is not None:
+            update_ledger.forget(update_id)
+        raise
+    finally:
+        UPDATE_SECONDS.observe(time.perf_counter() - started, kind)
     
-    return dict(user)
-
-
-def create_keyboard(buttons: List[List[Dict[str, str]]]) -> Dict[str, Any]:
-    return {
-        'inline_keyboard': buttons
-    }
+    if request['notified']:
+        outbox_sender.wake()
+    update_ledger.maybe_prune()
+    session_store.maybe_prune()
+    return response_data
 
 
-def handle_message(telegram_id: int, username: str, text: str, chat_id: int) -> Dict[str, Any]:
-    user = get_or_create_user(telegram_id, username)
+def route_update(update: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    if 'message' in update:
+        message = update['message']
+        chat_id = message['chat']['id']
+        text = message.get('text', '')
+        username = message.get('from', {}).get('username', 'Anonymous')
+        telegram_id = message['from']['id']
+        
+        if 'document' in message:
+            return handle_document(telegram_id, username, message['document'], chat_id)
+        return handle_message(telegram_id, username, text, chat_id)
     
-    if text == '/start':
-        keyboard = create_keyboard([
-            [{'text': '👤 Профиль', 'callback_data': 'profile'}],
-            [{'text': '🛒 Купить', 'callback_data': 'buy'}, {'text': '💼 Продать', 'callback_data': 'sell'}],
-            [{'text': '📋 Сделки', 'callback_data': 'deals'}, {'text': '💰 Баланс', 'callback_data': 'balance'}]
-        ])
+    elif 'callback_query' in update:
+        callback = update['callback_query']
+        chat_id = callback['message']['chat']['id']
+        data = callback['data']
+        telegram_id = callback['from']['id']
+        username = callback['from'].get('username', 'Anonymous')
         
-        return {
-            'method': 'sendMessage',
-            'chat_id': chat_id,
-            'text': f"""👋 <b>Добро пожаловать в P2P Exchange Bot!</b>
+        return handle_callback(telegram_id, username, data, chat_id)
+    
+    return None
 
-Безопасная торговля виртуальной валютой с эскроу-защитой.
 
-Ваш текущий режим: <b>{get_role_text(user['role'])}</b>
+def get_update_chat_id(update: Dict[str, Any]) -> Optional[int]:
+    if 'message' in update:
+        return update['message'].get('chat', {}).get('id')
+    if 'callback_query' in update:
+        return update['callback_query'].get('message', {}).get('chat', {}).get('id')
+    return None
 
-Выберите действие:""",
-            'parse_mode': 'HTML',
-            'reply_markup': keyboard
-        }
-    
-    elif text == '/profile':
-        return format_profile(user, chat_id)
-    
-    elif text == '/buy':
-        if user['role'] != 'buyer':
-            return {
-                'method': 'sendMessage',
-                'chat_id': chat_id,
-                'text': "⚠️ Переключитесь в режим покупателя через Профиль",
-                'parse_mode': 'HTML'
-            }
-        return format_offers(chat_id)
-    
-    elif text == '/sell':
-        if user['role'] != 'seller':
-            return {
-                'method': 'sendMessage',
-                'chat_id': chat_id,
-                'text': "⚠️ Переключитесь в режим продавца через Профиль",
-                'parse_mode': 'HTML'
-            }
-        return format_sell_form(chat_id)
+
+def format_labels(names: Tuple[str, ...], values: Tuple[Any, ...]) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series: Dict[Tuple, List[Any]] = {}
+        self._lock = threading.Lock()
     
-    elif text == '/deals':
-        return format_deals(user['id'], chat_id)
+    def observe(self, value: float, *labels: Any):
+        slot = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][slot] += 1
+            series[1] += value
     
-    elif text == '/balance':
-        return format_balance(user, chat_id)
+    def count(self) -> int:
+        with self._lock:
+            return sum(sum(counts) for counts, _ in self._series.values())
     
-    elif user['role'] == 'seller' and ' ' in text:
-        parts = text.split()
-        if len(parts) == 4:
-            try:
-                price, min_amt, max_amt, currency = float(parts[0]), float(parts[1]), float(parts[2]), parts[3]
-                create_offer(user['id'], price, min_amt, max_amt, currency)
-                
-                keyboard = create_keyboard([[{'text': '🏠 Главное меню', 'callback_data': 'menu'}]])
-                
-                return {
-                    'method': 'sendMessage',
-                    'chat_id': chat_id,
-                    'text': f"""✅ <b>Объявление создано!</b>
+    def render(self) -> List[str]:
+        with self._lock:
+            snapshot = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, counts, total in sorted(snapshot, key=lambda item: tuple(map(str, item[0]))):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{self.name}_bucket{format_labels(self.label_names + ('le',), labels + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {cumulative}")
+        return lines
 
-💵 Цена: {price:.2f}₽
-📊 Лимит: {min_amt:.0f}₽ - {max_amt:.0f}₽
-💎 Валюта: {currency}
 
-Ваше объявление теперь видно покупателям.""",
-                    'parse_mode': 'HTML',
-                    'reply_markup': keyboard
-                }
-            except:
-                pass
+class Counter:
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
     
-    keyboard = create_keyboard([
-        [{'text': '👤 Профиль', 'callback_data': 'profile'}],
-        [{'text': '🛒 Купить', 'callback_data': 'buy'}, {'text': '💼 Продать', 'callback_data': 'sell'}],
-        [{'text': '📋 Сделки', 'callback_data': 'deals'}, {'text': '💰 Баланс', 'callback_data': 'balance'}]
-    ])
+    def inc(self, *labels: Any, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
     
-    return {
-        'method': 'sendMessage',
-        'chat_id': chat_id,
-        'text': "ℹ️ Выберите действие:",
-        'parse_mode': 'HTML',
-        'reply_markup': keyboard
-    }
+    def render(self) -> List[str]:
+        with self._lock:
+            snapshot = sorted(self._values.items(), key=lambda item: tuple(map(str, item[0])))
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{format_labels(self.label_names, labels)} {value}" for labels, value in snapshot)
+        return lines
 
 
-def handle_callback(telegram_id: int, username: str, data: str, chat_id: int) -> Dict[str, Any]:
-    user = get_or_create_user(telegram_id, username)
+class Gauge:
+    def __init__(self, name: str, help_text: str, read: Callable[[], float], kind: str = 'gauge'):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+        self.kind = kind
     
-    if data == 'menu':
-        keyboard = create_keyboard([
-            [{'text': '👤 Профиль', 'callback_data': 'profile'}],
-            [{'text': '🛒 Купить', 'callback_data': 'buy'}, {'text': '💼 Продать', 'callback_data': 'sell'}],
-            [{'text': '📋 Сделки', 'callback_data': 'deals'}, {'text': '💰 Баланс', 'callback_data': 'balance'}]
-        ])
-        
-        return {
-            'method': 'sendMessage',
-            'chat_id': chat_id,
-            'text': f"Главное меню\n\nВаш режим: <b>{get_role_text(user['role'])}</b>",
-            'parse_mode': 'HTML',
-            'reply_markup': keyboard
-        }
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}", f"{self.name} {self.read()}"]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Any] = {}
     
-    elif data == 'profile':
-        return format_profile(user, chat_id)
+    def register(self, metric: Any) -> Any:
+        self._metrics[metric.name] = metric
+        return metric
     
-    elif data == 'buy':
-        if user['role'] != 'buyer':
-            keyboard = create_keyboard([[{'text': '🏠 Главное меню', 'callback_data': 'menu'}]])
-            return {
-                'method': 'sendMessage',
-                'chat_id': chat_id,
-                'text': "⚠️ Переключитесь в режим покупателя через Профиль",
-                'parse_mode': 'HTML',
-                'reply_markup': keyboard
-            }
-        return format_offers(chat_id)
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+UPDATE_SECONDS = metrics.register(Histogram('bot_update_seconds', 'Time spent processing one Telegram update.', ('kind',)))
+ROUTE_SECONDS = metrics.register(Histogram('bot_route_seconds', 'Time spent in a routed handler.', ('router', 'route')))
+DB_QUERY_SECONDS = metrics.register(Histogram('bot_db_query_seconds', 'SQL statement execution time by calling function.', ('query',)))
+DB_STATEMENT_SECONDS = metrics.register(Histogram('bot_db_statement_seconds', 'EXECUTE time of registered prepared statements.', ('statement',)))
+DB_STATEMENT_PREPARES = metrics.register(Histogram('bot_db_statement_prepare_seconds', 'PREPARE time, paid once per statement and pooled connection.', ('statement',)))
+DB_ACQUIRE_SECONDS = metrics.register(Histogram('bot_db_acquire_seconds', 'Time spent waiting for a pooled connection.', ('target',)))
+DB_READ_FALLBACKS = metrics.register(Counter('bot_db_read_fallbacks_total', 'Replica reads served by the primary because no replica was available.'))
+RENDER_SECONDS = metrics.register(Histogram('bot_render_seconds', 'Time spent serializing a webhook reply.'))
+MAINTENANCE_ROWS = metrics.register(Counter('bot_maintenance_rows_total', 'Rows processed by maintenance jobs.', ('job',)))
+DISPUTES_RESOLVED = metrics.register(Counter('bot_disputes_resolved_total', 'Disputes resolved by administrators.', ('resolution',)))
+UPDATE_ERRORS = metrics.register(Counter('bot_update_errors_total', 'Updates that failed with an exception.', ('error',)))
+
+
+class SlowRequestProfiler:
+    def __init__(self, threshold_ms: float, interval: float):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval
+        self._active: Dict[int, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
     
-    elif data == 'sell':
-        if user['role'] != 'seller':
-            keyboard = create_keyboard([[{'text': '🏠 Главное меню', 'callback_data': 'menu'}]])
-            return {
-                'method': 'sendMessage',
-                'chat_id': chat_id,
-                'text': "⚠️ Переключитесь в режим продавца через Профиль",
-                'parse_mode': 'HTML',
-                'reply_markup': keyboard
-            }
-        return format_sell_form(chat_id)
+    @contextmanager
+    def profile(self, label: str) -> Iterator[None]:
+        if self.threshold <= 0:
+            yield
+            return
+        thread_id = threading.get_ident()
+        samples: Dict[str, int] = {}
+        with self._lock:
+            self._active[thread_id] = samples
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+                self._thread.start()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._active.pop(thread_id, None)
+            if elapsed >= self.threshold:
+                self.report(label, elapsed, samples)
     
-    elif data == 'deals':
-        return format_deals(user['id'], chat_id)
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, samples in self._active.items():
+                    frame = frames.get(thread_id)
+                    stack = []
+                    while frame is not None:
+                        stack.append(f"{frame.f_code.co_name}:{frame.f_lineno}")
+                        frame = frame.f_back
+                    key = ';'.join(reversed(stack))
+                    samples[key] = samples.get(key, 0) + 1
     
-    elif data == 'balance':
-        return format_balance(user, chat_id)
+    def report(self, label: str, elapsed: float, samples: Dict[str, int]):
+        print(f"slow request {label}: {elapsed * 1000:.1f} ms, {sum(samples.values())} samples")
+        for stack, count in sorted(samples.items(), key=lambda item: -item[1])[:PROFILE_TOP_STACKS]:
+            print(f"  {stack} {count}")
+
+
+slow_request_profiler = SlowRequestProfiler(PROFILE_SLOW_MS, PROFILE_SAMPLE_INTERVAL)
+
+
+class TimedCursor:
+    def execute(self, query: Any, vars: Any = None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            frame = sys._getframe(1)
+            if frame.f_globals.get('__name__') == 'psycopg2.extras' or frame.f_code is StatementRegistry.execute.__code__:
+                frame = frame.f_back
+            code = frame.f_code
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, getattr(code, 'co_qualname', code.co_name))
+
+
+@functools.lru_cache(maxsize=None)
+def timed_cursor_class(tuples: bool) -> type:
+    base = psycopg2.extensions.cursor if tuples else psycopg2.extras.RealDictCursor
+    return type('TimedCursor', (TimedCursor, base), {})
+
+
+class DatabasePool:
+    def __init__(self, name: str, dsn: Optional[str]):
+        self.name = name
+        self.dsn = dsn
+        self.down_until = 0.0
+        self._pool: Optional['psycopg2.pool.ThreadedConnectionPool'] = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(DB_POOL_MAX_SIZE)
     
-    elif data == 'switch_buyer':
-        update_user_role(user['id'], 'buyer')
-        return format_profile(get_user_by_id(user['id']), chat_id)
+    def get_pool(self) -> 'psycopg2.pool.ThreadedConnectionPool':
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    pool = psycopg2.pool.ThreadedConnectionPool(
+                        DB_POOL_MIN_SIZE,
+                        DB_POOL_MAX_SIZE,
+                        self.dsn,
+                        cursor_factory=timed_cursor_class(False)
+                    )
+                    # ThreadedConnectionPool закрывает возвращённое соединение, если
+                    # свободных уже minconn. DB_POOL_MIN_SIZE задаёт только число
+                    # соединений, открытых заранее; держим тёплыми до DB_POOL_MAX_SIZE,
+                    # чтобы параллельные запросы не переподключались и не теряли PREPARE.
+                    pool.minconn = DB_POOL_MAX_SIZE
+                    self._pool = pool
+        return self._pool
     
-    elif data == 'switch_seller':
-        update_user_role(user['id'], 'seller')
-        return format_profile(get_user_by_id(user['id']), chat_id)
+    def acquire(self):
+        started = time.perf_counter()
+        try:
+            if not self._slots.acquire(timeout=DB_POOL_TIMEOUT):
+                raise psycopg2.pool.PoolError('connection pool exhausted')
+            try:
+                pool = self.get_pool()
+                conn = pool.getconn()
+                if not is_connection_alive(conn):
+                    discard_connection_state(conn)
+                    pool.putconn(conn, close=True)
+                    conn = pool.getconn()
+                return conn
+            except Exception:
+                self._slots.release()
+                raise
+        finally:
+            DB_ACQUIRE_SECONDS.observe(time.perf_counter() - started, self.name)
     
-    elif data.startswith('buy_'):
-        offer_id = int(data.replace('buy_', ''))
-        return initiate_deal(user['id'], offer_id, chat_id)
+    def release(self, conn):
+        pool = self.get_pool()
+        try:
+            if conn.closed:
+                discard_connection_state(conn)
+                pool.putconn(conn, close=True)
+                return
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard_connection_state(conn)
+                pool.putconn(conn, close=True)
+                return
+            _last_used[id(conn)] = time.monotonic()
+            pool.putconn(conn)
+        finally:
+            self._slots.release()
+
+
+class ReadRouter:
+    # Чтения без побочных эффектов уходят на реплики по кругу. Пользователь,
+    # только что записавший что-то на primary, READ_YOUR_WRITES_SECONDS читает
+    # с primary, чтобы не увидеть отставшую реплику. Недоступная реплика
+    # выключается на DB_REPLICA_RETRY_INTERVAL, чтения идут на primary.
+    def __init__(self, replicas: List[DatabasePool], sticky_seconds: float):
+        self.replicas = replicas
+        self.sticky_seconds = sticky_seconds
+        self._pinned: OrderedDict = OrderedDict()
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
     
-    elif data.startswith('complete_'):
-        deal_id = int(data.replace('complete_', ''))
-        return complete_deal(deal_id, user['id'], chat_id)
+    def pin(self, user_key: Any):
+        now = time.monotonic()
+        with self._lock:
+            self._pinned[user_key] = now + self.sticky_seconds
+            self._pinned.move_to_end(user_key)
+            while next(iter(self._pinned.values())) < now:
+                self._pinned.popitem(last=False)
     
-    elif data.startswith('dispute_'):
-        deal_id = int(data.replace('dispute_', ''))
-        return open_dispute(deal_id, user['id'], chat_id)
+    def is_pinned(self, user_key: Any) -> bool:
+        with self._lock:
+            deadline = self._pinned.get(user_key)
+        return deadline is not None and deadline > time.monotonic()
     
-    return {
-        'method': 'sendMessage',
-        'chat_id': chat_id,
-        'text': "Действие выполнено",
-        'parse_mode': 'HTML'
+    def acquire(self) -> Tuple[Optional[DatabasePool], Any]:
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[next(self._turn) % len(self.replicas)]
+            if replica.down_until > time.monotonic():
+                continue
+            try:
+                return replica, replica.acquire()
+            except psycopg2.pool.PoolError:
+                continue
+            except psycopg2.Error as e:
+                print(f"read replica {replica.name} failed: {e}")
+                replica.down_until = time.monotonic() + DB_REPLICA_RETRY_INTERVAL
+        DB_READ_FALLBACKS.inc()
+        return None, None
+
+
+_last_used: Dict[int, float] = {}
+_request_conn: ContextVar[Optional[Dict[str, Any]]] = ContextVar('request_conn', default=None)
+primary_db = DatabasePool('primary', os.environ.get('DATABASE_URL'))
+read_router = ReadRouter([], READ_YOUR_WRITES_SECONDS)
+
+
+def enable_read_replicas():
+    # Привязка пользователя к primary после записи живёт в памяти процесса. В
+    # serverless-режиме соседний запрос того же пользователя может попасть в другой
+    # инстанс и прочитать отставшую реплику, поэтому DATABASE_READ_URL включается
+    # только в poll/serve, где все апдейты бота проходят через один процесс.
+    read_router.replicas = [DatabasePool(f'replica{number}', dsn) for number, dsn in enumerate(DATABASE_READ_URLS, 1)]
+
+
+def is_connection_alive(conn) -> bool:
+    if conn.closed:
+        return False
+    last_used = _last_used.get(id(conn))
+    if last_used is None or time.monotonic() - last_used < DB_HEALTHCHECK_INTERVAL:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def discard_connection_state(conn):
+    _last_used.pop(id(conn), None)
+    statements.forget(conn)
+
+
+@contextmanager
+def db_request(update_id: Optional[int] = None, chat_id: Optional[int] = None, user_key: Any = None) -> Iterator[Dict[str, Any]]:
+    current = _request_conn.get()
+    if current is not None:
+        yield current
+        return
+    slot: Dict[str, Any] = {
+        'conn': None, 'update_id': update_id, 'chat_id': chat_id, 'locked': False,
+        'read_conn': None, 'read_pool': None, 'user_key': user_key, 'wrote': False, 'notified': False
     }
+    token = _request_conn.set(slot)
+    try:
+        yield slot
+    finally:
+        _request_conn.reset(token)
+        if slot['read_conn'] is not None:
+            slot['read_pool'].release(slot['read_conn'])
+        if slot['conn'] is not None:
+            if slot['locked']:
+                unlock_chat(slot['conn'], slot['chat_id'])
+            primary_db.release(slot['conn'])
+        if slot['wrote'] and user_key is not None and read_router.replicas:
+            read_router.pin(user_key)
 
 
-def get_role_text(role: str) -> str:
-    return "🛒 Покупатель" if role == 'buyer' else "💼 Продавец"
+def get_db_connection():
+    slot = _request_conn.get()
+    if slot is None:
+        raise RuntimeError('get_db_connection() called outside of db_request()')
+    if slot['conn'] is None:
+        slot['conn'] = primary_db.acquire()
+        if slot['chat_id'] is not None:
+            lock_chat(slot['conn'], slot['chat_id'])
+            slot['locked'] = True
+        if slot['update_id'] is not None and not update_ledger.claim(slot['conn'], slot['update_id']):
+            raise DuplicateUpdate(slot['update_id'])
+    return slot['conn']
+
+
+def get_read_connection():
+    slot = _request_conn.get()
+    if slot is None:
+        raise RuntimeError('get_read_connection() called outside of db_request()')
+    # Запрос, уже взявший primary, читает только с него: реплика могла ещё не получить
+    # его запись, даже если раньше в этом запросе чтение шло с реплики.
+    if not read_router.replicas or slot['conn'] is not None or read_router.is_pinned(slot['user_key']):
+        return get_db_connection()
+    if slot['read_conn'] is not None:
+        return slot['read_conn']
+    slot['read_pool'], slot['read_conn'] = read_router.acquire()
+    return slot['read_conn'] or get_db_connection()
+
+
+def lock_chat(conn, chat_id: int):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_lock(%s)", (chat_id,))
+
+
+def unlock_chat(conn, chat_id: int):
+    try:
+        conn.rollback()
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (chat_id,))
+    except psycopg2.Error:
+        conn.close()
 
 
-def get_user_by_id(user_id: int) -> Dict[str, Any]:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-    user = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    return dict(user)
+@contextmanager
+def db_cursor(tuples: bool = False, read: bool = False) -> Iterator[Any]:
+    with db_request():
+        if read:
+            conn = get_read_connection()
+        else:
+            conn = get_db_connection()
+            _request_conn.get()['wrote'] = True
+        cursor = conn.cursor(cursor_factory=timed_cursor_class(tuples))
+        try:
+            yield cursor
+        finally:
+            cursor.close()
 
 
-def format_profile(user: Dict[str, Any], chat_id: int) -> Dict[str, Any]:
-    opposite_role = 'seller' if user['role'] == 'buyer' else 'buyer'
-    opposite_text = '💼 Стать продавцом' if user['role'] == 'buyer' else '🛒 Стать покупателем'
+class StatementRegistry:
+    # Горячие запросы готовятся один раз на соединение пула (PREPARE) и дальше
+    # выполняются через EXECUTE с кэшированным планом. Запрос пишется с %s, как
+    # обычно; разные варианты динамического SQL получают свои имена под одной меткой.
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._names: Dict[str, str] = {}
+        self._prepared: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
     
-    keyboard = create_keyboard([
-        [{'text': opposite_text, 'callback_data': f'switch_{opposite_role}'}],
-        [{'text': '💰 Баланс', 'callback_data': 'balance'}],
-        [{'text': '🏠 Главное меню', 'callback_data': 'menu'}]
-    ])
+    def execute(self, cursor, label: str, query: str, params: Tuple = ()):
+        if not self.enabled:
+            cursor.execute(query, params)
+            return
+        with self._lock:
+            name = self._names.get(query)
+            if name is None:
+                name = self._names[query] = f"{label}_{len(self._names) + 1}"
+            prepared = self._prepared.setdefault(cursor.connection, set())
+        
+        if name not in prepared:
+            parts = query.split('%s')
+            started = time.perf_counter()
+            cursor.execute(f"PREPARE {name} AS " + parts[0] + ''.join(f"${number}{part}" for number, part in enumerate(parts[1:], 1)))
+            DB_STATEMENT_PREPARES.observe(time.perf_counter() - started, label)
+            prepared.add(name)
+        
+        started = time.perf_counter()
+        if params:
+            cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+        else:
+            cursor.execute(f"EXECUTE {name}")
+        DB_STATEMENT_SECONDS.observe(time.perf_counter() - started, label)
     
-    return {
-        'method': 'sendMessage',
-        'chat_id': chat_id,
-        'text': f"""👤 <b>Ваш профиль</b>
+    def forget(self, conn):
+        with self._lock:
+            self._prepared.pop(conn, None)
 
-<b>Режим:</b> {get_role_text(user['role'])}
 
-💰 <b>Баланс:</b> {user['balance']:.2f}₽
+statements = StatementRegistry(DB_PREPARED_STATEMENTS)
 
-📊 <b>Статистика:</b>
-• Куплено: {user['total_bought']:.2f}₽
-• Продано: {user['total_sold']:.2f}₽
-• Сделок завершено: {user['completed_deals']}
-• Рейтинг: {'⭐' * int(user['rating'])} ({user['rating']:.1f})""",
-        'parse_mode': 'HTML',
-        'reply_markup': keyboard
-    }
 
+class DuplicateUpdate(Exception):
+    pass
 
-def format_balance(user: Dict[str, Any], chat_id: int) -> Dict[str, Any]:
-    keyboard = create_keyboard([
-        [{'text': '➕ Пополнить', 'callback_data': 'deposit'}, {'text': '➖ Вывести', 'callback_data': 'withdraw'}],
-        [{'text': '🏠 Главное меню', 'callback_data': 'menu'}]
-    ])
+
+class UpdateLedger:
+    def __init__(self, window: int, retention_hours: int, prune_interval: float):
+        self.window = window
+        self.retention_hours = retention_hours
+        self.prune_interval = prune_interval
+        self._recent: OrderedDict = OrderedDict()
+        self._pruned_at = time.monotonic()
+        self._lock = threading.Lock()
     
-    return {
-        'method': 'sendMessage',
-        'chat_id': chat_id,
-        'text': f"""💰 <b>Ваш баланс</b>
+    def seen(self, update_id: int) -> bool:
+        with self._lock:
+            if update_id in self._recent:
+                return True
+            self._recent[update_id] = None
+            if len(self._recent) > self.window:
+                self._recent.popitem(last=False)
+            return False
+    
+    def claim(self, conn, update_id: int) -> bool:
+        with conn.cursor() as cursor:
+            statements.execute(
+                cursor,
+                'claim_update',
+                """INSERT INTO processed_updates (update_id) VALUES (%s)
+                   ON CONFLICT (update_id) DO NOTHING
+                   RETURNING update_id""",
+                (update_id,)
+            )
+            return cursor.fetchone() is not None
+    
+    def forget(self, update_id: int):
+        with self._lock:
+            self._recent.pop(update_id, None)
+        try:
+            with db_cursor() as cursor:
+                cursor.execute("DELETE FROM processed_updates WHERE update_id = %s", (update_id,))
+                cursor.connection.commit()
+        except Exception as e:
+            print(f"update ledger cleanup failed: {e}")
+    
+    def maybe_prune(self):
+        with self._lock:
+            if time.monotonic() - self._pruned_at < self.prune_interval:
+                return
+            self._pruned_at = time.monotonic()
+        try:
+            with db_cursor() as cursor:
+                cursor.execute("""
+                    DELETE FROM processed_updates
+                    WHERE update_id IN (
+                        SELECT update_id FROM processed_updates
+                        WHERE processed_at < CURRENT_TIMESTAMP - make_interval(hours => %s)
+                        LIMIT %s
+                    )
+                """, (self.retention_hours, UPDATE_LEDGER_PRUNE_BATCH))
+                cursor.connection.commit()
+        except Exception as e:
+            print(f"update ledger prune failed: {e}")
 
-Доступно: <b>{user['balance']:.2f}₽</b>
 
-Выберите действие:""",
-        'parse_mode': 'HTML',
-        'reply_markup': keyboard
-    }
+update_ledger = UpdateLedger(UPDATE_DEDUP_WINDOW, UPDATE_LEDGER_RETENTION_HOURS, UPDATE_LEDGER_PRUNE_INTERVAL)
 
 
-def format_offers(chat_id: int) -> Dict[str, Any]:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT o.*, u.username, u.rating, u.completed_deals
-        FROM offers o
-        JOIN users u ON o.seller_id = u.id
-        WHERE o.is_active = true
-        ORDER BY o.price ASC
-        LIMIT 5
-    """)
+# Строки горячих запросов читаются кортежами (db_cursor(tuples=True)) прямо в
+# неизменяемые записи: только нужные колонки, без промежуточных dict и копий.
+# NUMERIC приходит из драйвера уже Decimal и дальше не преобразуется.
+class User(NamedTuple):
+    id: int
+    telegram_id: int
+    username: Optional[str]
+    role: str
+    balance: Decimal
+    total_bought: Decimal
+    total_sold: Decimal
+    completed_deals: int
+    rating: Decimal
+
+
+class Offer(NamedTuple):
+    id: int
+    seller_id: int
+    price: Decimal
+    min_amount: Decimal
+    max_amount: Decimal
+    currency: str
+    username: Optional[str]
+    rating: Decimal
+    completed_deals: int
+
+
+class DealSummary(NamedTuple):
+    id: int
+    buyer_id: int
+    seller_id: int
+    buyer_name: Optional[str]
+    seller_name: Optional[str]
+    amount: Decimal
+    currency: str
+    status: str
+    created_at: Any
+
+
+USER_COLUMNS = ', '.join(User._fields)
+
+
+class UserCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: OrderedDict = OrderedDict()
+        self._telegram_ids: Dict[int, int] = {}
+        self._lock = threading.Lock()
     
-    offers = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    def get(self, telegram_id: int) -> Optional[User]:
+        with self._lock:
+            item = self._items.get(telegram_id)
+            if item is None:
+                return None
+            expires_at, user = item
+            if expires_at < time.monotonic():
+                self._drop(telegram_id)
+                return None
+            self._items.move_to_end(telegram_id)
+            return user
     
-    if not offers:
-        keyboard = create_keyboard([[{'text': '🏠 Главное меню', 'callback_data': 'menu'}]])
-        return {
-            'method': 'sendMessage',
-            'chat_id': chat_id,
-            'text': "📭 Нет доступных предложений",
-            'parse_mode': 'HTML',
-            'reply_markup': keyboard
-        }
+    def put(self, user: User):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items[user.telegram_id] = (time.monotonic() + self.ttl, user)
+            self._items.move_to_end(user.telegram_id)
+            self._telegram_ids[user.id] = user.telegram_id
+            while len(self._items) > self.max_size:
+                self._drop(next(iter(self._items)))
     
-    text = "💎 <b>Лучшие предложения</b>\n\n"
-    buttons = []
+    def invalidate(self, telegram_id: int):
+        with self._lock:
+            self._drop(telegram_id)
     
-    for offer in offers:
-        text += f"""━━━━━━━━━━━━━━━
-👤 {offer['username']}
-⭐ {offer['rating']:.1f} • {offer['completed_deals']} сделок
-💵 Цена: {offer['price']:.2f}₽
-📊 Лимит: {offer['min_amount']:.0f}₽ - {offer['max_amount']:.0f}₽
-💎 {offer['currency']}
-
-"""
-        buttons.append([{'text': f"Купить у {offer['username']}", 'callback_data': f"buy_{offer['id']}"}])
+    def invalidate_user_id(self, user_id: int):
+        with self._lock:
+            telegram_id = self._telegram_ids.get(user_id)
+            if telegram_id is not None:
+                self._drop(telegram_id)
     
-    buttons.append([{'text': '🏠 Главное меню', 'callback_data': 'menu'}])
-    keyboard = create_keyboard(buttons)
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._telegram_ids.clear()
     
-    return {
-        'method': 'sendMessage',
-        'chat_id': chat_id,
-        'text': text,
-        'parse_mode': 'HTML',
-        'reply_markup': keyboard
-    }
+    def _drop(self, telegram_id: int):
+        item = self._items.pop(telegram_id, None)
+        if item is not None:
+            self._telegram_ids.pop(item[1].id, None)
 
 
-def format_sell_form(chat_id: int) -> Dict[str, Any]:
-    keyboard = create_keyboard([[{'text': '🏠 Главное меню', 'callback_data': 'menu'}]])
-    
-    return {
-        'method': 'sendMessage',
-        'chat_id': chat_id,
-        'text': """📝 <b>Создание объявления о продаже</b>
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
 
-Отправьте данные в формате:
-<code>цена минсумма макссумма валюта</code>
 
-Пример: <code>95.50 1000 50000 USDT</code>""",
-        'parse_mode': 'HTML',
-        'reply_markup': keyboard
-    }
+def get_or_create_user(telegram_id: int, username: str) -> User:
+    cached = user_cache.get(telegram_id)
+    if cached is not None and cached.username == username:
+        return cached
+    
+    with db_cursor(tuples=True, read=True) as cursor:
+        statements.execute(cursor, 'user_by_telegram_id', f"SELECT {USER_COLUMNS} FROM users WHERE telegram_id = %s", (telegram_id,))
+        row = cursor.fetchone()
+    if row is not None:
+        user = User._make(row)
+        if user.username == username:
+            user_cache.put(user)
+            return user
+    
+    with db_cursor(tuples=True) as cursor:
+        statements.execute(
+            cursor,
+            'upsert_user',
+            f"""INSERT INTO users (telegram_id, username) 
+                VALUES (%s, %s)
+                ON CONFLICT (telegram_id) DO UPDATE SET username = EXCLUDED.username
+                RETURNING {USER_COLUMNS}""",
+            (telegram_id, username)
+        )
+        user = User._make(cursor.fetchone())
+        cursor.connection.commit()
+    
+    user_cache.put(user)
+    return user
 
 
-def format_deals(user_id: int, chat_id: int) -> Dict[str, Any]:
-    conn = get_db_connection()
-    cursor = conn.cursor()
+class Session:
+    __slots__ = ('state', 'data', 'expires_at')
     
-    cursor.execute("""
-        SELECT d.*, 
-               buyer.username as buyer_name,
-               seller.username as seller_name
-        FROM deals d
-        JOIN users buyer ON d.buyer_id = buyer.id
-        JOIN users seller ON d.seller_id = seller.id
-        WHERE d.buyer_id = %s OR d.seller_id = %s
-        ORDER BY d.created_at DESC
-        LIMIT 10
-    """, (user_id, user_id))
+    def __init__(self, state: str, data: Any, expires_at: float):
+        self.state = state
+        self.data = data
+        self.expires_at = expires_at
+
+
+class MemorySessionStore:
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
     
-    deals = cursor.fetchall()
-    cursor.close()
-    conn.close()
+    def get(self, user_id: int) -> Optional[Session]:
+        with self._lock:
+            session = self._items.get(user_id)
+            if session is not None and session.expires_at < time.monotonic():
+                del self._items[user_id]
+                return None
+            return session
     
-    if not deals:
-        keyboard = create_keyboard([[{'text': '🏠 Главное меню', 'callback_data': 'menu'}]])
-        return {
-            'method': 'sendMessage',
-            'chat_id': chat_id,
-            'text': "📭 У вас пока нет сделок",
-            'parse_mode': 'HTML',
-            'reply_markup': keyboard
-        }
+    def set(self, user_id: int, state: str, data: Any = None):
+        now = time.monotonic()
+        with self._lock:
+            self._items.pop(user_id, None)
+            self._items[user_id] = Session(state, data, now + self.ttl)
+            # Every session gets the same TTL, so insertion order is expiry order.
+            while self._items:
+                oldest = next(iter(self._items.values()))
+                if oldest.expires_at >= now and len(self._items) <= self.max_size:
+                    break
+                self._items.popitem(last=False)
     
-    text = "📋 <b>Ваши сделки</b>\n\n"
-    buttons = []
+    def clear(self, user_id: int):
+        with self._lock:
+            self._items.pop(user_id, None)
     
-    for deal in deals:
-        status_emoji = {'pending': '⏳', 'escrow': '🔒', 'completed': '✅', 'cancelled': '❌', 'dispute': '⚠️'}
-        
-        text += f"""━━━━━━━━━━━━━━━
-{status_emoji.get(deal['status'], '•')} Сделка #{deal['id']}
-💵 {deal['amount']:.0f}₽ • {deal['currency']}
-👤 {deal['buyer_name']} ↔ {deal['seller_name']}
-📅 {deal['created_at'].strftime('%d.%m.%Y %H:%M')}
-Статус: {get_status_text(deal['status'])}
+    def maybe_prune(self):
+        pass
 
-"""
-        
-        if deal['status'] == 'escrow':
-            buttons.append([
-                {'text': f"✅ Завершить #{deal['id']}", 'callback_data': f"complete_{deal['id']}"},
-                {'text': f"⚠️ Спор #{deal['id']}", 'callback_data': f"dispute_{deal['id']}"}
-            ])
+
+class PostgresSessionStore:
+    def __init__(self, ttl: float, prune_interval: float):
+        self.ttl = ttl
+        self.prune_interval = prune_interval
+        self._pruned_at = time.monotonic()
+        self._lock = threading.Lock()
     
-    buttons.append([{'text': '🏠 Главное меню', 'callback_data': 'menu'}])
-    keyboard = create_keyboard(buttons)
+    def get(self, user_id: int) -> Optional[Session]:
+        with db_cursor() as cursor:
+            cursor.execute(
+                """SELECT state, data, EXTRACT(EPOCH FROM expires_at - CURRENT_TIMESTAMP) AS ttl
+                   FROM sessions
+                   WHERE user_id = %s AND expires_at > CURRENT_TIMESTAMP""",
+                (user_id,)
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return Session(row['state'], row['data'], time.monotonic() + float(row['ttl']))
     
-    return {
-        'method': 'sendMessage',
-        'chat_id': chat_id,
-        'text': text,
-        'parse_mode': 'HTML',
-        'reply_markup': keyboard
-    }
+    def set(self, user_id: int, state: str, data: Any = None):
+        with db_cursor() as cursor:
+            cursor.execute(
+                """INSERT INTO sessions (user_id, state, data, expires_at)
+                   VALUES (%s, %s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s))
+                   ON CONFLICT (user_id) DO UPDATE
+                   SET state = EXCLUDED.state, data = EXCLUDED.data, expires_at = EXCLUDED.expires_at""",
+                (user_id, state, json_dumps(data), self.ttl)
+            )
+            cursor.connection.commit()
+    
+    def clear(self, user_id: int):
+        with db_cursor() as cursor:
+            cursor.execute("DELETE FROM sessions WHERE user_id = %s", (user_id,))
+            cursor.connection.commit()
+    
+    def maybe_prune(self):
+        with self._lock:
+            if time.monotonic() - self._pruned_at < self.prune_interval:
+                return
+            self._pruned_at = time.monotonic()
+        try:
+            with db_cursor() as cursor:
+                cursor.execute("""
+                    DELETE FROM sessions
+                    WHERE user_id IN (
+                        SELECT user_id FROM sessions
+                        WHERE expires_at < CURRENT_TIMESTAMP
+                        LIMIT %s
+                    )
+                """, (SESSION_PRUNE_BATCH,))
+                cursor.connection.commit()
+        except Exception as e:
+            print(f"session prune failed: {e}")
 
 
-def get_status_text(status: str) -> str:
-    statuses = {
-        'pending': 'Ожидание',
-        'escrow': 'В эскроу',
-        'completed': 'Завершена',
-        'cancelled': 'Отменена',
-        'dispute': 'Спор'
-    }
-    return statuses.get(status, status)
+def create_session_store() -> Any:
+    if SESSION_STORE == 'postgres':
+        return PostgresSessionStore(SESSION_TTL, SESSION_PRUNE_INTERVAL)
+    if SESSION_STORE == 'memory':
+        return MemorySessionStore(SESSION_TTL, SESSION_MAX_SIZE)
+    raise ValueError(f"unknown SESSION_STORE: {SESSION_STORE!r}")
 
 
-def update_user_role(user_id: int, role: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE users SET role = %s WHERE id = %s", (role, user_id))
-    conn.commit()
-    cursor.close()
-    conn.close()
+session_store = create_session_store()
 
 
-def create_offer(seller_id: int, price: float, min_amount: float, max_amount: float, currency: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        """INSERT INTO offers (seller_id, price, min_amount, max_amount, currency)
-           VALUES (%s, %s, %s, %s, %s)""",
-        (seller_id, price, min_amount, max_amount, currency)
-    )
-    conn.commit()
-    cursor.close()
-    conn.close()
+OFFER_BOOK_COLUMNS = """
+    o.id, o.seller_id, o.price, o.min_amount, o.max_amount, o.currency,
+    u.username, u.rating, u.completed_deals
+"""
+OFFER_READ_COLUMNS = """
+    b.offer_id AS id, b.seller_id, b.price, b.min_amount, b.max_amount, b.currency,
+    b.username, b.rating, b.completed_deals
+"""
 
 
-def initiate_deal(buyer_id: int, offer_id: int, chat_id: int) -> Dict[str, Any]:
-    conn = get_db_connection()
-    cursor = conn.cursor()
+class OrderBook:
+    def __init__(self, refresh_interval: float):
+        self.refresh_interval = refresh_interval
+        self._keys: Dict[str, List[Any]] = {}
+        self._offers: Dict[int, Offer] = {}
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.RLock()
     
-    cursor.execute("SELECT * FROM offers WHERE id = %s AND is_active = true", (offer_id,))
-    offer = cursor.fetchone()
+    def is_stale(self) -> bool:
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.refresh_interval
     
-    if not offer:
-        cursor.close()
-        conn.close()
-        keyboard = create_keyboard([[{'text': '🏠 Главное меню', 'callback_data': 'menu'}]])
-        return {
-            'method': 'sendMessage',
-            'chat_id': chat_id,
-            'text': "❌ Предложение недоступно",
-            'parse_mode': 'HTML',
-            'reply_markup': keyboard
-        }
+    def load(self, offers: List[Offer]):
+        keys: Dict[str, List[Any]] = {}
+        for offer in offers:
+            keys.setdefault(offer.currency, []).append((offer.price, offer.id))
+        for currency_keys in keys.values():
+            currency_keys.sort()
+        with self._lock:
+            self._keys = keys
+            self._offers = {offer.id: offer for offer in offers}
+            self._loaded_at = time.monotonic()
     
-    cursor.execute(
-        """INSERT INTO deals (offer_id, buyer_id, seller_id, amount, price, currency, status)
-           VALUES (%s, %s, %s, %s, %s, %s, 'escrow')""",
-        (offer_id, buyer_id, offer['seller_id'], offer['min_amount'], offer['price'], offer['currency'])
-    )
+    def add(self, offer: Offer):
+        with self._lock:
+            self.remove(offer.id)
+            bisect.insort(self._keys.setdefault(offer.currency, []), (offer.price, offer.id))
+            self._offers[offer.id] = offer
     
-    conn.commit()
-    cursor.close()
-    conn.close()
+    def update_limit(self, offer_id: int, max_amount: Decimal):
+        with self._lock:
+            offer = self._offers.get(offer_id)
+            if offer is not None:
+                self._offers[offer_id] = offer._replace(max_amount=max_amount)
     
-    keyboard = create_keyboard([
-        [{'text': '📋 Мои сделки', 'callback_data': 'deals'}],
-        [{'text': '🏠 Главное меню', 'callback_data': 'menu'}]
-    ])
+    def mark_stale(self):
+        self._loaded_at = None
     
-    return {
-        'method': 'sendMessage',
-        'chat_id': chat_id,
-        'text': f"""✅ <b>Сделка создана!</b>
+    def remove(self, offer_id: int):
+        with self._lock:
+            offer = self._offers.pop(offer_id, None)
+            if offer is None:
+                return
+            currency_keys = self._keys[offer.currency]
+            index = bisect.bisect_left(currency_keys, (offer.price, offer.id))
+            if index < len(currency_keys) and currency_keys[index][1] == offer_id:
+                del currency_keys[index]
+    
+    def match(
+        self,
+        currency: str,
+        amount: Decimal,
+        buyer_id: int,
+        max_price: Optional[Decimal] = None,
+        max_fills: int = MATCH_MAX_FILLS
+    ) -> List[Tuple[Offer, Decimal]]:
+        with self._lock:
+            keys = self._keys.get(currency, [])
+            return plan_fills(map(self._offers.__getitem__, (offer_id for _, offer_id in keys)), amount, buyer_id, max_price, max_fills)
+    
+    def select(
+        self,
+        currency: Optional[str] = None,
+        amount: Optional[Decimal] = None,
+        min_rating: Optional[Decimal] = None,
+        cursor: Optional[Tuple[Decimal, int]] = None,
+        backward: bool = False,
+        limit: int = OFFERS_PAGE_SIZE
+    ) -> List[Offer]:
+        with self._lock:
+            books = [self._keys.get(currency, [])] if currency is not None else list(self._keys.values())
+            # map() связывает список ключей сразу; генератор по keys читал бы
+            # ключи последней валюты во всех диапазонах при слиянии.
+            ranges = []
+            for keys in books:
+                if backward:
+                    end = bisect.bisect_left(keys, cursor) if cursor else len(keys)
+                    ranges.append(map(keys.__getitem__, range(end - 1, -1, -1)))
+                else:
+                    start = bisect.bisect_right(keys, cursor) if cursor else 0
+                    ranges.append(map(keys.__getitem__, range(start, len(keys))))
+            
+            result = []
+            for _, offer_id in heapq.merge(*ranges, reverse=backward):
+                offer = self._offers[offer_id]
+                if amount is not None and not (offer.min_amount <= amount <= offer.max_amount):
+                    continue
+                if min_rating is not None and offer.rating < min_rating:
+                    continue
+                result.append(offer)
+                if len(result) >= limit:
+                    break
+            return result
 
-💰 Сумма: {offer['min_amount']:.0f}₽
-💵 Цена: {offer['price']:.2f}₽
-🔒 Средства в эскроу
 
-Ожидайте подтверждения продавца.""",
-        'parse_mode': 'HTML',
-        'reply_markup': keyboard
-    }
+def plan_fills(
+    offers: Iterator[Offer],
+    amount: Decimal,
+    buyer_id: int,
+    max_price: Optional[Decimal] = None,
+    max_fills: int = MATCH_MAX_FILLS
+) -> List[Tuple[Offer, Decimal]]:
+    fills = []
+    remaining = amount
+    for offer in offers:
+        if remaining <= 0 or len(fills) >= max_fills:
+            break
+        if max_price is not None and offer.price > max_price:
+            break
+        if offer.seller_id == buyer_id:
+            continue
+        take = min(remaining, offer.max_amount)
+        if take < offer.min_amount:
+            continue
+        fills.append((offer, take))
+        remaining -= take
+    return fills
 
 
-def complete_deal(deal_id: int, user_id: int, chat_id: int) -> Dict[str, Any]:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        "UPDATE deals SET status = 'completed' WHERE id = %s AND (buyer_id = %s OR seller_id = %s)",
-        (deal_id, user_id, user_id)
-    )
-    
-    conn.commit()
-    cursor.close()
-    conn.close()
+order_book = OrderBook(ORDER_BOOK_REFRESH_INTERVAL)
+
+
+def refresh_order_book():
+    with db_cursor(tuples=True, read=True) as cursor:
+        cursor.execute(f"SELECT {OFFER_READ_COLUMNS} FROM offer_book b")
+        order_book.load(list(map(Offer._make, cursor.fetchall())))
+
+
+def get_best_offers(
+    currency: Optional[str] = None,
+    amount: Optional[Decimal] = None,
+    min_rating: Optional[Decimal] = None,
+    cursor: Optional[Tuple[Decimal, int]] = None,
+    backward: bool = False,
+    limit: int = OFFERS_PAGE_SIZE
+) -> List[Offer]:
+    if ORDER_BOOK_SNAPSHOT:
+        if order_book.is_stale():
+            refresh_order_book()
+        return order_book.select(currency, amount, min_rating, cursor, backward, limit)
     
-    keyboard = create_keyboard([
-        [{'text': '📋 Мои сделки', 'callback_data': 'deals'}],
-        [{'text': '🏠 Главное меню', 'callback_data': 'menu'}]
-    ])
+    conditions = []
+    params: List[Any] = []
+    if currency is not None:
+        conditions.append("b.currency = %s")
+        params.append(currency)
+    if amount is not None:
+        conditions.append("b.min_amount <= %s AND b.max_amount >= %s")
+        params.extend([amount, amount])
+    if min_rating is not None:
+        conditions.append("b.rating >= %s")
+        params.append(min_rating)
+    if cursor is not None:
+        conditions.append("(b.price, b.offer_id) < (%s, %s)" if backward else "(b.price, b.offer_id) > (%s, %s)")
+        params.extend(cursor)
+    order = "DESC" if backward else "ASC"
+    params.append(limit)
     
+    with db_cursor(tuples=True, read=True) as cursor_:
+        statements.execute(cursor_, 'offers_page', f"""
+            SELECT {OFFER_READ_COLUMNS}
+            FROM offer_book b
+            {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+            ORDER BY b.price {order}, b.offer_id {order}
+            LIMIT %s
+        """, params)
+        return list(map(Offer._make, cursor_.fetchall()))
+
+
+def encode_offers_cursor(
+    currency: Optional[str],
+    amount: Optional[Decimal],
+    min_rating: Optional[Decimal],
+    direction: str = '',
+    position: Optional[Tuple[Decimal, int]] = None
+) -> str:
+    price, offer_id = position if position else ('', '')
+    return f"of:{currency or ''}:{amount or ''}:{min_rating or ''}:{direction}:{price}:{offer_id}"
+
+
+def bounded_decimal(value: str, limit: Decimal) -> Decimal:
+    # Postgres отвергает numeric с порядком больше 1000 (DataError), поэтому числа
+    # из текста и callback_data ограничиваются диапазоном колонок ещё до SQL.
+    number = Decimal(value)
+    if not number.is_finite() or not 0 <= number < limit:
+        raise ValueError(f"{value!r} is outside [0, {limit})")
+    return number
+
+
+def decode_offers_cursor(data: str) -> Dict[str, Any]:
+    currency, amount, min_rating, direction, price, offer_id = data.split(':')
     return {
-        'method': 'sendMessage',
-        'chat_id': chat_id,
-        'text': "✅ Сделка успешно завершена!",
-        'parse_mode': 'HTML',
-        'reply_markup': keyboard
+        'currency': currency or None,
+        'amount': bounded_decimal(amount, OFFER_AMOUNT_LIMIT) if amount else None,
+        'min_rating': bounded_decimal(min_rating, RATING_LIMIT) if min_rating else None,
+        'cursor': (bounded_decimal(price, OFFER_PRICE_LIMIT), parse_offer_id(offer_id)) if direction else None,
+        'backward': direction == 'p'
     }
 
 
-def open_dispute(deal_id: int, user_id: int, chat_id: int) -> Dict[str, Any]:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        "UPDATE deals SET status = 'dispute' WHERE id = %s AND (buyer_id = %s OR seller_id = %s)",
-        (deal_id, user_id, user_id)
-    )
+def parse_market_order(args: List[str]) -> Optional[Tuple[str, Decimal, Optional[Decimal]]]:
+    currency = None
+    numbers = []
+    for arg in args:
+        try:
+            value = Decimal(arg.replace(',', '.'))
+        except InvalidOperation:
+            currency = arg.upper()
+            continue
+        numbers.append(value)
+    if currency is None or not 1 <= len(numbers) <= 2:
+        return None
+    amount = quantize_money(numbers[0], OFFER_AMOUNT_LIMIT)
+    max_price = quantize_money(numbers[1], OFFER_PRICE_LIMIT) if len(numbers) > 1 else None
+    if amount is None or (len(numbers) > 1 and max_price is None):
+        return None
+    return currency, amount, max_price
+
+
+def parse_offer_filters(args: List[str]) -> Dict[str, Any]:
+    filters: Dict[str, Any] = {}
+    numbers = []
+    for arg in args:
+        try:
+            Decimal(arg.replace(',', '.'))
+        except InvalidOperation:
+            filters['currency'] = arg.upper()
+            continue
+        numbers.append(arg.replace(',', '.'))
+    try:
+        if numbers:
+            filters['amount'] = bounded_decimal(numbers[0], OFFER_AMOUNT_LIMIT)
+        if len(numbers) > 1:
+            filters['min_rating'] = bounded_decimal(numbers[1], RATING_LIMIT)
+    except ValueError as e:
+        raise RouteError(f"offer filter out of range: {e}")
+    return filters
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
     
-    conn.commit()
-    cursor.close()
-    conn.close()
+    def delay(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
     
-    keyboard = create_keyboard([
-        [{'text': '📋 Мои сделки', 'callback_data': 'deals'}],
-        [{'text': '🏠 Главное меню', 'callback_data': 'menu'}]
-    ])
+    def take(self):
+        self.tokens -= 1
+
+
+class RateLimiter:
+    def __init__(self, global_rate: float, chat_rate: float):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self._lock = threading.Lock()
     
-    return {
-        'method': 'sendMessage',
-        'chat_id': chat_id,
-        'text': "⚠️ Спор открыт. Администратор свяжется с вами.",
-        'parse_mode': 'HTML',
-        'reply_markup': keyboard
-    }
+    def wait(self, chat_id: int):
+        # Токены списываются из обоих вёдер только в момент отправки: если списывать
+        # их заранее, ожидание глобального ведра засчитывается как пауза в чате.
+        while True:
+            with self._lock:
+                bucket = self.chat_buckets.get(chat_id)
+                if bucket is None:
+                    if len(self.chat_buckets) > 10000:
+                        self.chat_buckets.clear()
+                    bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, 1)
+                delay = max(bucket.delay(), self.global_bucket.delay())
+                if delay <= 0:
+                    bucket.take()
+                    self.global_bucket.take()
+                    return
+            time.sleep(delay)
+
+
+class TelegramError(Exception):
+    def __init__(self, status: int, description: str, retry_after: Optional[float] = None):
+        super().__init__(f"{status}: {description}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+def call_telegram(method: str, payload: Dict[str, Any], timeout: float = 10) -> Dict[str, Any]:
+    request = urllib.request.Request(
+        f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/{method}",
+        data=json.dumps(payload).encode('utf-8'),
+        headers={'Content-Type': 'application/json'}
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        try:
+            body = json.loads(e.read())
+        except ValueError:
+            body = {}
+        retry_after = body.get('parameters', {}).get('retry_after')
+        raise TelegramError(e.code, body.get('description', e.reason), retry_after)
+
+
+def download_telegram_file(file_id: str, max_bytes: int = BULK_CSV_MAX_BYTES) -> bytes:
+    file_path = call_telegram('getFile', {'file_id': file_id})['result']['file_path']
+    with urllib.request.urlopen(f"{TELEGRAM_API_URL}/file/bot{TELEGRAM_BOT_TOKEN}/{file_path}", timeout=10) as response:
+        content = response.read(max_bytes + 1)
+    if len(content) > max_bytes:
+        raise ValueError('file is too large')
+    return content
+
+
+def mark_outbox_pending():
+    slot = _request_conn.get()
+    if slot is not None:
+        slot['notified'] = True
+
+
+def enqueue_notification(cursor, user_id: int, text: str, reply_markup: Optional[Dict[str, Any]] = None):
+    payload: Dict[str, Any] = {'text': text, 'parse_mode': 'HTML'}
+    if reply_markup is not None:
+        payload['reply_markup'] = reply_markup
+    cursor.execute(
+        """INSERT INTO outbox (chat_id, payload)
+           SELECT telegram_id, %s FROM users WHERE id = %s""",
+        (json.dumps(payload), user_id)
+    )
+    mark_outbox_pending()
+
+
+def enqueue_admin_notification(cursor, text: str, reply_markup: Optional[Dict[str, Any]] = None):
+    payload: Dict[str, Any] = {'text': text, 'parse_mode': 'HTML'}
+    if reply_markup is not None:
+        payload['reply_markup'] = reply_markup
+    cursor.execute(
+        "INSERT INTO outbox (chat_id, payload) SELECT unnest(%s::bigint[]), %s",
+        (sorted(ADMIN_TELEGRAM_IDS), json.dumps(payload))
+    )
+    mark_outbox_pending()
+
+
+def enqueue_notifications(cursor, notifications: List[Tuple[int, str, Optional[Dict[str, Any]]]]):
+    rows = []
+    for user_id, text, reply_markup in notifications:
+        payload: Dict[str, Any] = {'text': text, 'parse_mode': 'HTML'}
+        if reply_markup is not None:
+            payload['reply_markup'] = reply_markup
+        rows.append((user_id, json.dumps(payload)))
+    psycopg2.extras.execute_values(
+        cursor,
+        """INSERT INTO outbox (chat_id, payload)
+           SELECT u.telegram_id, v.payload::jsonb
+           FROM (VALUES %s) AS v (user_id, payload)
+           JOIN users u ON u.id = v.user_id""",
+        rows,
+        template='(%s::int, %s)',
+        page_size=max(len(rows), 1)
+    )
+    mark_outbox_pending()
+
+
+class OutboxSender:
+    def __init__(self, workers: int, batch_size: int):
+        self.batch_size = batch_size
+        self.limiter = RateLimiter(OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='outbox')
+        self._running = False
+        self._pending_wake = False
+        self._lock = threading.Lock()
+    
+    def wake(self):
+        if not TELEGRAM_BOT_TOKEN:
+            return
+        with self._lock:
+            if self._running:
+                self._pending_wake = True
+                return
+            self._running = True
+        threading.Thread(target=self._run, name='outbox-flush', daemon=True).start()
+    
+    def _run(self):
+        while True:
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"outbox flush failed: {e}")
+            with self._lock:
+                if not self._pending_wake:
+                    self._running = False
+                    return
+                self._pending_wake = False
+    
+    def claim(self) -> List[Dict[str, Any]]:
+        with db_cursor() as cursor:
+            cursor.execute("""
+                UPDATE outbox
+                SET status = 'sending',
+                    attempts = attempts + 1,
+                    next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                WHERE id IN (
+                    SELECT id FROM outbox
+                    WHERE status IN ('pending', 'sending') AND next_attempt_at <= CURRENT_TIMESTAMP
+                    ORDER BY next_attempt_at, id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, chat_id, method, payload, attempts
+            """, (OUTBOX_LEASE_SECONDS, self.batch_size))
+            messages = cursor.fetchall()
+            cursor.connection.commit()
+        return sorted(messages, key=lambda message: message['id'])
+    
+    def flush(self) -> int:
+        total = 0
+        while True:
+            messages = self.claim()
+            if not messages:
+                return total
+            lanes: Dict[int, List[Dict[str, Any]]] = {}
+            for message in messages:
+                lanes.setdefault(message['chat_id'], []).append(message)
+            results = []
+            for lane in self.executor.map(self._deliver_lane, lanes.values()):
+                results.extend(lane)
+            self._record(results)
+            total += len(messages)
+    
+    def _deliver_lane(self, messages: List[Dict[str, Any]]) -> List[Tuple[int, str, Optional[str], float]]:
+        results = []
+        for index, message in enumerate(messages):
+            self.limiter.wait(message['chat_id'])
+            try:
+                call_telegram(message['method'], {'chat_id': message['chat_id'], **message['payload']})
+                results.append((message['id'], 'sent', None, 0.0))
+            except TelegramError as e:
+                if e.status == 429:
+                    delay = float(e.retry_after or 1)
+                    results.extend((queued['id'], 'pending', str(e), delay) for queued in messages[index:])
+                    break
+                results.append(self._failure(message, str(e), retryable=e.status >= 500))
+            except (urllib.error.URLError, OSError) as e:
+                results.append(self._failure(message, str(e), retryable=True))
+        return results
+    
+    def _failure(self, message: Dict[str, Any], error: str, retryable: bool) -> Tuple[int, str, Optional[str], float]:
+        if retryable and message['attempts'] < OUTBOX_MAX_ATTEMPTS:
+            return (message['id'], 'pending', error, float(2 ** message['attempts']))
+        return (message['id'], 'failed', error, 0.0)
+    
+    def _record(self, results: List[Tuple[int, str, Optional[str], float]]):
+        with db_cursor() as cursor:
+            cursor.executemany("""
+                UPDATE outbox
+                SET status = %s,
+                    last_error = %s,
+                    next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s),
+                    sent_at = CASE WHEN %s = 'sent' THEN CURRENT_TIMESTAMP END
+                WHERE id = %s
+            """, [(status, error, delay, status, message_id) for message_id, status, error, delay in results])
+            cursor.connection.commit()
+
+
+outbox_sender = OutboxSender(OUTBOX_WORKERS, OUTBOX_BATCH_SIZE)
+
+
+def json_dumps(value: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(value).decode('utf-8')
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+def _frozen(self, *args, **kwargs):
+    raise TypeError('keyboard is frozen')
+
+
+class Keyboard(dict):
+    __setitem__ = __delitem__ = update = pop = popitem = clear = setdefault = _frozen
+    
+    def __init__(self, buttons: List[List[Dict[str, str]]]):
+        super().__init__(inline_keyboard=tuple(tuple(row) for row in buttons))
+        self.json = json_dumps(self)
+
+
+class StaticText(str):
+    def __new__(cls, value: str):
+        text = super().__new__(cls, value)
+        text.json = json_dumps(value)
+        return text
+
+
+class BotMessage(dict):
+    def to_json(self) -> str:
+        text = self['text']
+        parts = [
+            '{"method":"sendMessage","chat_id":', str(self['chat_id']),
+            ',"text":', getattr(text, 'json', None) or json_dumps(text),
+            ',"parse_mode":"HTML"'
+        ]
+        keyboard = self.get('reply_markup')
+        if keyboard is not None:
+            parts.append(',"reply_markup":')
+            parts.append(keyboard.json if isinstance(keyboard, Keyboard) else json_dumps(keyboard))
+        parts.append('}')
+        return ''.join(parts)
+
+
+def send_message(chat_id: int, text: str, keyboard: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    message = BotMessage(method='sendMessage', chat_id=chat_id, text=text, parse_mode='HTML')
+    if keyboard is not None:
+        message['reply_markup'] = keyboard
+    return message
+
+
+def encode_body(response: Dict[str, Any]) -> str:
+    if isinstance(response, BotMessage):
+        return response.to_json()
+    return json_dumps(response)
+
+
+def create_keyboard(buttons: List[List[Dict[str, str]]]) -> Dict[str, Any]:
+    return Keyboard(buttons)
+
+
+MAIN_MENU_KEYBOARD = Keyboard([
+    [{'text': '👤 Профиль', 'callback_data': 'profile'}],
+    [{'text': '🛒 Купить', 'callback_data': 'buy'}, {'text': '💼 Продать', 'callback_data': 'sell'}],
+    [{'text': '📋 Сделки', 'callback_data': 'deals'}, {'text': '💰 Баланс', 'callback_data': 'balance'}]
+])
+MENU_KEYBOARD = Keyboard([[{'text': '🏠 Главное меню', 'callback_data': 'menu'}]])
+DEALS_MENU_KEYBOARD = Keyboard([
+    [{'text': '📋 Мои сделки', 'callback_data': 'deals'}],
+    [{'text': '🏠 Главное меню', 'callback_data': 'menu'}]
+])
+DEAL_NOTIFICATION_KEYBOARD = Keyboard([[{'text': '📋 Мои сделки', 'callback_data': 'deals'}]])
+DISPUTES_KEYBOARD = Keyboard([[{'text': '⚖️ Открытые споры', 'callback_data': 'disputes'}]])
+BALANCE_KEYBOARD = Keyboard([
+    [{'text': '➕ Пополнить', 'callback_data': 'deposit'}, {'text': '➖ Вывести', 'callback_data': 'withdraw'}],
+    [{'text': '🏠 Главное меню', 'callback_data': 'menu'}]
+])
+PROFILE_KEYBOARDS = {
+    role: Keyboard([
+        [{'text': opposite_text, 'callback_data': f'switch_{opposite_role}'}],
+        [{'text': '💰 Баланс', 'callback_data': 'balance'}],
+        [{'text': '🏠 Главное меню', 'callback_data': 'menu'}]
+    ])
+    for role, opposite_role, opposite_text in (
+        ('buyer', 'seller', '💼 Стать продавцом'),
+        ('seller', 'buyer', '🛒 Стать покупателем')
+    )
+}
+
+ROLE_TEXTS = {'buyer': "🛒 Покупатель", 'seller': "💼 Продавец"}
+WELCOME_TEXTS = {
+    role: StaticText(f"""👋 <b>Добро пожаловать в P2P Exchange Bot!</b>
+
+Безопасная торговля виртуальной валютой с эскроу-защитой.
+
+Ваш текущий режим: <b>{role_text}</b>
+
+Выберите действие:""")
+    for role, role_text in ROLE_TEXTS.items()
+}
+MAIN_MENU_TEXTS = {
+    role: StaticText(f"Главное меню\n\nВаш режим: <b>{role_text}</b>")
+    for role, role_text in ROLE_TEXTS.items()
+}
+CHOOSE_ACTION_TEXT = StaticText("ℹ️ Выберите действие:")
+SWITCH_TO_BUYER_TEXT = StaticText("⚠️ Переключитесь в режим покупателя через Профиль")
+SWITCH_TO_SELLER_TEXT = StaticText("⚠️ Переключитесь в режим продавца через Профиль")
+ADMIN_ONLY_TEXT = StaticText("⛔ Команда доступна только администраторам")
+ROLE_DENIED_TEXTS = {'buyer': SWITCH_TO_BUYER_TEXT, 'seller': SWITCH_TO_SELLER_TEXT, 'admin': ADMIN_ONLY_TEXT}
+ACTION_DONE_TEXT = StaticText("Действие выполнено")
+INVALID_REQUEST_TEXT = StaticText("⚠️ Некорректный запрос")
+NO_OFFERS_TEXT = StaticText("📭 Нет доступных предложений")
+NO_DEALS_TEXT = StaticText("📭 У вас пока нет сделок")
+NO_FILTERED_DEALS_TEXT = StaticText("📭 Нет сделок с таким статусом")
+SELL_FORM_TEXT = StaticText("""📝 <b>Создание объявления о продаже</b>
+
+Отправьте данные в формате:
+<code>цена минсумма макссумма валюта</code>
+
+Пример: <code>95.50 1000 50000 USDT</code>
+
+Можно отправить несколько строк сразу или CSV-файл с колонками
+<code>price,min_amount,max_amount,currency</code>""")
+OFFER_LIMITS_ERROR_TEXT = StaticText("❌ Значения вне допустимых пределов — ничего не было сохранено")
+BULK_USAGE_TEXT = StaticText("""📦 <b>Массовые операции</b>
+
+<code>/reprice</code> и строки <code>id цена</code> — обновить цены
+<code>/deactivate 12 15</code>, <code>/deactivate USDT</code> или <code>/deactivate all</code> — снять объявления
+
+CSV-файл с колонками <code>id,price</code> обновляет цены, с колонками
+<code>price,min_amount,max_amount,currency</code> — создаёт объявления.""")
+OFFER_FORMAT_ERROR_TEXT = StaticText("""❌ <b>Не удалось разобрать объявление</b>
+
+Отправьте данные в формате:
+<code>цена минсумма макссумма валюта</code>
+
+Пример: <code>95.50 1000 50000 USDT</code>""")
+DEAL_AMOUNT_ERROR_TEXT = StaticText("❌ Введите сумму числом, например <code>5000</code>")
+CANCEL_KEYBOARD = create_keyboard([[{'text': '✖️ Отмена', 'callback_data': 'menu'}]])
+MARKET_USAGE_TEXT = StaticText("""🎯 <b>Покупка по лучшей цене</b>
+
+Отправьте <code>/market валюта сумма [макс. цена]</code>, например <code>/market USDT 50000 96.5</code>.
+Заявка будет исполнена по нескольким лучшим предложениям не дороже указанной цены.""")
+DEAL_COMPLETED_TEXT = StaticText("✅ Сделка успешно завершена!")
+DEAL_CANCELLED_TEXT = StaticText("❌ Сделка отменена, средства возвращены покупателю.")
+DISPUTE_OPENED_TEXT = StaticText("⚠️ Спор открыт. Администратор свяжется с вами.")
+NO_DISPUTES_TEXT = StaticText("✅ Открытых споров нет")
+DISPUTE_RESOLVED_TEXTS = {'completed': "✅ Спор #{deal_id} решён в пользу продавца", 'cancelled': "↩️ Спор #{deal_id} решён в пользу покупателя"}
+DEAL_STATUS_EMOJI = {'pending': '⏳', 'escrow': '🔒', 'completed': '✅', 'cancelled': '❌', 'dispute': '⚠️'}
+DEAL_STATUS_TEXTS = {
+    'pending': 'Ожидание',
+    'escrow': 'В эскроу',
+    'completed': 'Завершена',
+    'cancelled': 'Отменена',
+    'dispute': 'Спор'
+}
+OK_BODY = json_dumps({'ok': True})
+
+
+class RouteError(ValueError):
+    pass
+
+
+def optional(parse: Callable[[str], Any]) -> Callable[[str], Any]:
+    return lambda value: parse(value) if value else None
+
+
+def dispute_resolution(value: str) -> str:
+    if value not in DISPUTE_RESOLVED_NOTIFICATIONS:
+        raise ValueError(f"unknown dispute resolution: {value}")
+    return value
+
+
+class Router:
+    def __init__(self, name: str, role_denied: Callable[[int, str], Dict[str, Any]]):
+        self.name = name
+        self.role_denied = role_denied
+        self.routes: Dict[str, Tuple[Callable, Tuple, Optional[str]]] = {}
+        self.prefixes: Dict[str, Tuple[Callable, Tuple, Optional[str]]] = {}
+        self.fallback: Optional[Callable] = None
+    
+    def route(self, *names: str, role: Optional[str] = None):
+        def register(handler: Callable) -> Callable:
+            for name in names:
+                self.routes[name] = (handler, (), role)
+            return handler
+        return register
+    
+    def prefix(self, prefix: str, *arg_types: Callable[[str], Any], role: Optional[str] = None):
+        if prefix[-1] not in ROUTE_SEPARATORS or any(sep in prefix[:-1] for sep in ROUTE_SEPARATORS):
+            raise ValueError(f"route prefix must contain exactly one separator from {ROUTE_SEPARATORS!r}, at the end: {prefix}")
+        def register(handler: Callable) -> Callable:
+            self.prefixes[prefix] = (handler, arg_types, role)
+            return handler
+        return register
+    
+    def default(self, handler: Callable) -> Callable:
+        self.fallback = handler
+        return handler
+    
+    def resolve(self, key: str) -> Tuple[Optional[Callable], Tuple, Optional[str]]:
+        route = self.routes.get(key)
+        if route is not None:
+            return route
+        
+        end = min((i for i in (key.find(sep) for sep in ROUTE_SEPARATORS) if i >= 0), default=-1)
+        route = self.prefixes.get(key[:end + 1]) if end >= 0 else None
+        if route is None:
+            return self.fallback, (), None
+        
+        handler, arg_types, role = route
+        raw = key[end + 1:]
+        values = raw.split(':') if len(arg_types) > 1 else [raw]
+        if len(values) != len(arg_types):
+            raise RouteError(f"expected {len(arg_types)} arguments in {key!r}")
+        try:
+            args = tuple(parse(value) for parse, value in zip(arg_types, values))
+        except (ValueError, TypeError, InvalidOperation) as e:
+            raise RouteError(f"malformed arguments in {key!r}: {e}")
+        return handler, args, role
+    
+    def dispatch(self, key: str, user: User, chat_id: int, *extra: Any) -> Dict[str, Any]:
+        started = time.perf_counter()
+        route = 'invalid'
+        try:
+            handler, args, role = self.resolve(key)
+            if handler is None:
+                route = 'unhandled'
+                return send_message(chat_id, ACTION_DONE_TEXT)
+            route = handler.__name__
+            if role is not None and not has_role(user, role):
+                return self.role_denied(chat_id, role)
+            return handler(user, chat_id, *args, *extra)
+        except RouteError:
+            return send_message(chat_id, INVALID_REQUEST_TEXT, MENU_KEYBOARD)
+        finally:
+            ROUTE_SECONDS.observe(time.perf_counter() - started, self.name, route)
+
+
+def has_role(user: User, role: str) -> bool:
+    if role == 'admin':
+        return user.telegram_id in ADMIN_TELEGRAM_IDS
+    return user.role == role
+
+
+def message_role_denied(chat_id: int, role: str) -> Dict[str, Any]:
+    return send_message(chat_id, ROLE_DENIED_TEXTS[role])
+
+
+def callback_role_denied(chat_id: int, role: str) -> Dict[str, Any]:
+    return send_message(chat_id, ROLE_DENIED_TEXTS[role], MENU_KEYBOARD)
+
+
+message_router = Router('message', message_role_denied)
+callback_router = Router('callback', callback_role_denied)
+
+
+def handle_message(telegram_id: int, username: str, text: str, chat_id: int) -> Dict[str, Any]:
+    user = get_or_create_user(telegram_id, username)
+    command = text.split(maxsplit=1)[0] if text.startswith('/') else ''
+    return message_router.dispatch(command, user, chat_id, text)
+
+
+def handle_callback(telegram_id: int, username: str, data: str, chat_id: int) -> Dict[str, Any]:
+    user = get_or_create_user(telegram_id, username)
+    return callback_router.dispatch(data, user, chat_id)
+
+
+def handle_document(telegram_id: int, username: str, document: Dict[str, Any], chat_id: int) -> Dict[str, Any]:
+    user = get_or_create_user(telegram_id, username)
+    if user.role != 'seller':
+        return send_message(chat_id, SWITCH_TO_SELLER_TEXT)
+    if not document.get('file_name', '').lower().endswith('.csv') or document.get('file_size', 0) > BULK_CSV_MAX_BYTES:
+        return send_message(chat_id, f"❌ Поддерживаются CSV-файлы до {BULK_CSV_MAX_BYTES // 1024} КБ", MENU_KEYBOARD)
+    
+    try:
+        content = download_telegram_file(document['file_id']).decode('utf-8-sig')
+    except (TelegramError, OSError, ValueError) as e:
+        print(f"document download failed: {e}")
+        return send_message(chat_id, "❌ Не удалось загрузить файл", MENU_KEYBOARD)
+    
+    rows = [row for row in csv.reader(content.splitlines()) if any(cell.strip() for cell in row)]
+    header = [cell.strip().lower() for cell in rows[0]] if rows else []
+    if header and header[0] in ('id', 'price'):
+        rows = rows[1:]
+    else:
+        header = ['id', 'price'] if rows and len(rows[0]) == 2 else list(OFFER_CSV_COLUMNS)
+    numbered = [(number, row) for number, row in enumerate(rows, 1)]
+    
+    if header == ['id', 'price']:
+        return apply_reprice(user, chat_id, numbered)
+    if header != list(OFFER_CSV_COLUMNS):
+        return send_message(chat_id, BULK_USAGE_TEXT, MENU_KEYBOARD)
+    return apply_offer_rows(user, chat_id, numbered)
+
+
+@message_router.route('/start')
+def on_start(user: User, chat_id: int, text: str) -> Dict[str, Any]:
+    return send_message(chat_id, WELCOME_TEXTS[user.role], MAIN_MENU_KEYBOARD)
+
+
+@message_router.route('/profile')
+def on_profile_command(user: User, chat_id: int, text: str) -> Dict[str, Any]:
+    return format_profile(user, chat_id)
+
+
+@message_router.route('/buy', role='buyer')
+def on_buy_command(user: User, chat_id: int, text: str) -> Dict[str, Any]:
+    return format_offers(chat_id, **parse_offer_filters(text.split()[1:]))
+
+
+@message_router.route('/market', role='buyer')
+def on_market_command(user: User, chat_id: int, text: str) -> Dict[str, Any]:
+    order = parse_market_order(text.split()[1:])
+    if order is None:
+        return send_message(chat_id, MARKET_USAGE_TEXT, MENU_KEYBOARD)
+    return format_market_quote(user, chat_id, *order)
+
+
+@message_router.route('/sell', role='seller')
+def on_sell_command(user: User, chat_id: int, text: str) -> Dict[str, Any]:
+    session_store.set(user.id, 'offer_input')
+    return format_sell_form(chat_id)
+
+
+@message_router.route('/deals')
+def on_deals_command(user: User, chat_id: int, text: str) -> Dict[str, Any]:
+    return format_deals(user.id, chat_id)
+
+
+@message_router.route('/balance')
+def on_balance_command(user: User, chat_id: int, text: str) -> Dict[str, Any]:
+    return format_balance(user, chat_id)
+
+
+@message_router.route('/reprice', role='seller')
+def on_reprice_command(user: User, chat_id: int, text: str) -> Dict[str, Any]:
+    lines = text.splitlines()[1:]
+    if not lines:
+        return send_message(chat_id, BULK_USAGE_TEXT, MENU_KEYBOARD)
+    return apply_reprice(user, chat_id, [(number, line.split()) for number, line in enumerate(lines, 1) if line.strip()])
+
+
+@message_router.route('/deactivate', role='seller')
+def on_deactivate_command(user: User, chat_id: int, text: str) -> Dict[str, Any]:
+    args = text.split()[1:]
+    if not args:
+        return send_message(chat_id, BULK_USAGE_TEXT, MENU_KEYBOARD)
+    try:
+        if args == ['all']:
+            removed = deactivate_offers(user.id)
+        elif all(arg.isdecimal() for arg in args):
+            removed = deactivate_offers(user.id, offer_ids=[parse_offer_id(arg) for arg in args])
+        elif len(args) == 1:
+            removed = deactivate_offers(user.id, currency=args[0].upper())
+        else:
+            return send_message(chat_id, BULK_USAGE_TEXT, MENU_KEYBOARD)
+    except (ValueError, psycopg2.DataError):
+        return send_message(chat_id, BULK_USAGE_TEXT, MENU_KEYBOARD)
+    return send_message(chat_id, f"✅ Снято с публикации: {len(removed)}", MENU_KEYBOARD)
+
+
+@message_router.route('/disputes', role='admin')
+def on_disputes_command(user: User, chat_id: int, text: str) -> Dict[str, Any]:
+    return format_disputes(chat_id)
+
+
+@message_router.route('/report', role='admin')
+def on_report_command(user: User, chat_id: int, text: str) -> Dict[str, Any]:
+    args = text.split()[1:]
+    return format_volume_report(chat_id, parse_report_days(args[0]) if args else REPORT_DAYS)
+
+
+def parse_report_days(value: str) -> int:
+    # isdigit() пропускает надстрочные цифры, на которых int() падает. Период
+    # ограничен REPORT_MAX_DAYS: уже при int4-максимуме дней CURRENT_TIMESTAMP -
+    # make_interval(days => ...) выходит за диапазон timestamp. Длинная строка цифр
+    # сразу даёт максимум, не доходя до лимита длины int().
+    digits = value.lstrip('0')
+    if not value.isdecimal() or not digits:
+        return REPORT_DAYS
+    if len(digits) > len(str(REPORT_MAX_DAYS)):
+        return REPORT_MAX_DAYS
+    return min(int(digits), REPORT_MAX_DAYS)
+
+
+@message_router.default
+def on_text(user: User, chat_id: int, text: str) -> Dict[str, Any]:
+    session = session_store.get(user.id)
+    step = conversation_steps.get(session.state) if session is not None else None
+    if step is None:
+        return send_message(chat_id, CHOOSE_ACTION_TEXT, MAIN_MENU_KEYBOARD)
+    return step(user, chat_id, text, session)
+
+
+conversation_steps: Dict[str, Callable] = {}
+
+
+def conversation_step(state: str) -> Callable:
+    def register(handler: Callable) -> Callable:
+        conversation_steps[state] = handler
+        return handler
+    return register
+
+
+@conversation_step('offer_input')
+def on_offer_input(user: User, chat_id: int, text: str, session: Session) -> Dict[str, Any]:
+    if user.role != 'seller':
+        session_store.clear(user.id)
+        return send_message(chat_id, CHOOSE_ACTION_TEXT, MAIN_MENU_KEYBOARD)
+    
+    lines = [(number, line.split()) for number, line in enumerate(text.splitlines(), 1) if line.strip()]
+    if len(lines) == 1:
+        try:
+            price, min_amt, max_amt, currency = parse_offer_row(lines[0][1])
+            create_offers(user.id, [(price, min_amt, max_amt, currency)])
+        except (ValueError, InvalidOperation, psycopg2.DataError):
+            return send_message(chat_id, OFFER_FORMAT_ERROR_TEXT, CANCEL_KEYBOARD)
+        
+        session_store.clear(user.id)
+        return send_message(chat_id, f"""✅ <b>Объявление создано!</b>
+
+💵 Цена: {price:.2f}₽
+📊 Лимит: {min_amt:.0f}₽ - {max_amt:.0f}₽
+💎 Валюта: {currency}
+
+Ваше объявление теперь видно покупателям.""", MENU_KEYBOARD)
+    
+    return apply_offer_rows(user, chat_id, lines)
+
+
+@conversation_step('deal_amount')
+def on_deal_amount(user: User, chat_id: int, text: str, session: Session) -> Dict[str, Any]:
+    offer_id, min_amount, max_amount = session.data[0], Decimal(session.data[1]), Decimal(session.data[2])
+    try:
+        amount = Decimal(text.strip().replace(',', '.').replace(' ', ''))
+    except InvalidOperation:
+        amount = None
+    if amount is None or not amount.is_finite():
+        return send_message(chat_id, DEAL_AMOUNT_ERROR_TEXT, CANCEL_KEYBOARD)
+    # Округление до копеек до проверки лимитов: 99.995 при min 100 — это 100.00
+    amount = quantize_money(amount, OFFER_AMOUNT_LIMIT)
+    if amount is None or not min_amount <= amount <= max_amount:
+        return send_message(
+            chat_id, f"❌ Сумма должна быть от {min_amount:.0f}₽ до {max_amount:.0f}₽", CANCEL_KEYBOARD
+        )
+    
+    session_store.clear(user.id)
+    return initiate_deal(user.id, offer_id, chat_id, amount)
+
+
+@callback_router.route('menu')
+def on_menu(user: User, chat_id: int) -> Dict[str, Any]:
+    session_store.clear(user.id)
+    return send_message(chat_id, MAIN_MENU_TEXTS[user.role], MAIN_MENU_KEYBOARD)
+
+
+@callback_router.route('profile')
+def on_profile(user: User, chat_id: int) -> Dict[str, Any]:
+    return format_profile(user, chat_id)
+
+
+@callback_router.route('buy', role='buyer')
+def on_buy(user: User, chat_id: int) -> Dict[str, Any]:
+    return format_offers(chat_id)
+
+
+@callback_router.route('sell', role='seller')
+def on_sell(user: User, chat_id: int) -> Dict[str, Any]:
+    session_store.set(user.id, 'offer_input')
+    return format_sell_form(chat_id)
+
+
+@callback_router.route('deals')
+def on_deals(user: User, chat_id: int) -> Dict[str, Any]:
+    return format_deals(user.id, chat_id)
+
+
+@callback_router.route('balance')
+def on_balance(user: User, chat_id: int) -> Dict[str, Any]:
+    return format_balance(user, chat_id)
+
+
+@callback_router.prefix('dl:', optional(str), optional(str), optional(int))
+def on_deals_page(user: User, chat_id: int, status: Optional[str], direction: Optional[str], deal_id: Optional[int]) -> Dict[str, Any]:
+    if direction is not None and deal_id is None:
+        raise RouteError('deal cursor without deal id')
+    return format_deals(user.id, chat_id, status=status, cursor=deal_id if direction else None, backward=direction == 'p')
+
+
+@callback_router.prefix('of:', decode_offers_cursor, role='buyer')
+def on_offers_page(user: User, chat_id: int, filters: Dict[str, Any]) -> Dict[str, Any]:
+    return format_offers(chat_id, **filters)
+
+
+@callback_router.route('switch_buyer')
+def on_switch_buyer(user: User, chat_id: int) -> Dict[str, Any]:
+    return format_profile(update_user_role(user.id, 'buyer'), chat_id)
+
+
+@callback_router.route('switch_seller')
+def on_switch_seller(user: User, chat_id: int) -> Dict[str, Any]:
+    return format_profile(update_user_role(user.id, 'seller'), chat_id)
+
+
+@callback_router.prefix('buy_', int)
+def on_buy_offer(user: User, chat_id: int, offer_id: int) -> Dict[str, Any]:
+    return format_deal_amount_prompt(user, chat_id, offer_id)
+
+
+@callback_router.prefix('deal_', int, Decimal)
+def on_deal_amount_button(user: User, chat_id: int, offer_id: int, amount: Decimal) -> Dict[str, Any]:
+    if quantize_money(amount, OFFER_AMOUNT_LIMIT) != amount:
+        raise RouteError('deal amount is not a valid sum in cents')
+    session_store.clear(user.id)
+    return initiate_deal(user.id, offer_id, chat_id, amount)
+
+
+@callback_router.prefix('mk:', str, Decimal, Decimal, role='buyer')
+def on_market_confirm(user: User, chat_id: int, currency: str, amount: Decimal, max_price: Decimal) -> Dict[str, Any]:
+    return execute_market_order(user, chat_id, currency, amount, max_price)
+
+
+@callback_router.prefix('complete_', int)
+def on_complete_deal(user: User, chat_id: int, deal_id: int) -> Dict[str, Any]:
+    return complete_deal(deal_id, user.id, chat_id)
+
+
+@callback_router.prefix('dispute_', int)
+def on_open_dispute(user: User, chat_id: int, deal_id: int) -> Dict[str, Any]:
+    return open_dispute(deal_id, user.id, chat_id)
+
+
+@callback_router.prefix('cancel_', int)
+def on_cancel_deal(user: User, chat_id: int, deal_id: int) -> Dict[str, Any]:
+    return cancel_deal(deal_id, user.id, chat_id)
+
+
+@callback_router.route('disputes', role='admin')
+def on_disputes(user: User, chat_id: int) -> Dict[str, Any]:
+    return format_disputes(chat_id)
+
+
+@callback_router.prefix('rd:', int, dispute_resolution, role='admin')
+def on_resolve_dispute(user: User, chat_id: int, deal_id: int, resolution: str) -> Dict[str, Any]:
+    return resolve_dispute(deal_id, resolution, chat_id)
+
+
+def get_role_text(role: str) -> str:
+    return ROLE_TEXTS.get(role, ROLE_TEXTS['seller'])
+
+
+def format_profile(user: User, chat_id: int) -> Dict[str, Any]:
+    return send_message(chat_id, f"""👤 <b>Ваш профиль</b>
+
+<b>Режим:</b> {get_role_text(user.role)}
+
+💰 <b>Баланс:</b> {user.balance:.2f}₽
+
+📊 <b>Статистика:</b>
+• Куплено: {user.total_bought:.2f}₽
+• Продано: {user.total_sold:.2f}₽
+• Сделок завершено: {user.completed_deals}
+• Рейтинг: {'⭐' * int(user.rating)} ({user.rating:.1f})""", PROFILE_KEYBOARDS[user.role])
+
+
+def format_balance(user: User, chat_id: int) -> Dict[str, Any]:
+    return send_message(chat_id, f"""💰 <b>Ваш баланс</b>
+
+Доступно: <b>{user.balance:.2f}₽</b>
+
+Выберите действие:""", BALANCE_KEYBOARD)
+
+
+def format_offers(
+    chat_id: int,
+    currency: Optional[str] = None,
+    amount: Optional[Decimal] = None,
+    min_rating: Optional[Decimal] = None,
+    cursor: Optional[Tuple[Decimal, int]] = None,
+    backward: bool = False
+) -> Dict[str, Any]:
+    offers = get_best_offers(currency, amount, min_rating, cursor, backward, OFFERS_PAGE_SIZE + 1)
+    has_more = len(offers) > OFFERS_PAGE_SIZE
+    offers = offers[:OFFERS_PAGE_SIZE]
+    if backward:
+        offers = offers[::-1]
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = cursor is not None, has_more
+    
+    currency_buttons = [
+        {'text': f"{'• ' if code == currency else ''}{code}", 'callback_data': encode_offers_cursor(code, amount, min_rating)}
+        for code in BROWSE_CURRENCIES
+    ]
+    currency_buttons.append({'text': 'Все', 'callback_data': encode_offers_cursor(None, amount, min_rating)})
+    
+    if not offers:
+        keyboard = create_keyboard([currency_buttons, [{'text': '🏠 Главное меню', 'callback_data': 'menu'}]])
+        return send_message(chat_id, NO_OFFERS_TEXT, keyboard)
+    
+    text = "💎 <b>Лучшие предложения</b>\n"
+    filters = []
+    if currency:
+        filters.append(f"💎 {currency}")
+    if amount is not None:
+        filters.append(f"📊 {amount:.0f}₽")
+    if min_rating is not None:
+        filters.append(f"⭐ от {min_rating:.1f}")
+    if filters:
+        text += ' • '.join(filters) + "\n"
+    text += "\n"
+    buttons = []
+    
+    for offer in offers:
+        text += f"""━━━━━━━━━━━━━━━
+👤 {offer.username}
+⭐ {offer.rating:.1f} • {offer.completed_deals} сделок
+💵 Цена: {offer.price:.2f}₽
+📊 Лимит: {offer.min_amount:.0f}₽ - {offer.max_amount:.0f}₽
+💎 {offer.currency}
+
+"""
+        buttons.append([{'text': f"Купить у {offer.username}", 'callback_data': f"buy_{offer.id}"}])
+    
+    text += "🔎 Фильтр: <code>/buy валюта сумма рейтинг</code>"
+    
+    navigation = []
+    if has_prev:
+        first = offers[0]
+        navigation.append({'text': '◀️ Назад', 'callback_data': encode_offers_cursor(currency, amount, min_rating, 'p', (first.price, first.id))})
+    if has_next:
+        last = offers[-1]
+        navigation.append({'text': 'Далее ▶️', 'callback_data': encode_offers_cursor(currency, amount, min_rating, 'n', (last.price, last.id))})
+    if navigation:
+        buttons.append(navigation)
+    buttons.append(currency_buttons)
+    buttons.append([{'text': '🏠 Главное меню', 'callback_data': 'menu'}])
+    keyboard = create_keyboard(buttons)
+    
+    return send_message(chat_id, text, keyboard)
+
+
+def format_sell_form(chat_id: int) -> Dict[str, Any]:
+    return send_message(chat_id, SELL_FORM_TEXT, MENU_KEYBOARD)
+
+
+def format_deal_amount_prompt(user: User, chat_id: int, offer_id: int) -> Dict[str, Any]:
+    with db_cursor(tuples=True, read=True) as cursor:
+        statements.execute(cursor, 'offer_by_id', f"SELECT {OFFER_READ_COLUMNS} FROM offer_book b WHERE b.offer_id = %s", (offer_id,))
+        row = cursor.fetchone()
+    
+    if row is None:
+        return format_deal_error('offer_unavailable', chat_id)
+    offer = Offer._make(row)
+    if offer.seller_id == user.id:
+        return format_deal_error('own_offer', chat_id)
+    if offer.min_amount == offer.max_amount:
+        return initiate_deal(user.id, offer_id, chat_id, offer.min_amount)
+    
+    session_store.set(user.id, 'deal_amount', [offer_id, str(offer.min_amount), str(offer.max_amount)])
+    keyboard = create_keyboard([
+        [{'text': f"Минимум ({offer.min_amount:.0f}₽)", 'callback_data': f"deal_{offer_id}:{offer.min_amount}"}],
+        [{'text': '✖️ Отмена', 'callback_data': 'menu'}]
+    ])
+    return send_message(chat_id, f"""💰 <b>Покупка по объявлению #{offer_id}</b>
+
+💵 Цена: {offer.price:.2f}₽
+💎 {offer.currency}
+📊 Лимит: {offer.min_amount:.0f}₽ - {offer.max_amount:.0f}₽
+
+Отправьте сумму сделки в рублях.""", keyboard)
+
+
+def get_deals_page(
+    user_id: int,
+    status: Optional[str] = None,
+    cursor: Optional[int] = None,
+    backward: bool = False,
+    limit: int = DEALS_PAGE_SIZE
+) -> List[DealSummary]:
+    conditions = ["user_id = %s"]
+    params: List[Any] = [user_id]
+    if status is not None:
+        conditions.append("status = %s")
+        params.append(status)
+    if cursor is not None:
+        conditions.append(
+            "(created_at, deal_id) > (SELECT created_at, deal_id FROM deal_feed WHERE deal_id = %s AND user_id = %s)" if backward
+            else "(created_at, deal_id) < (SELECT created_at, deal_id FROM deal_feed WHERE deal_id = %s AND user_id = %s)"
+        )
+        params.extend([cursor, user_id])
+    order = "ASC" if backward else "DESC"
+    params.append(limit)
+    
+    with db_cursor(tuples=True, read=True) as cursor_:
+        statements.execute(cursor_, 'deals_page', f"""
+            SELECT deal_id AS id, buyer_id, seller_id, buyer_name, seller_name,
+                   amount, currency, status, created_at
+            FROM deal_feed
+            WHERE {' AND '.join(conditions)}
+            ORDER BY created_at {order}, deal_id {order}
+            LIMIT %s
+        """, params)
+        return list(map(DealSummary._make, cursor_.fetchall()))
+
+
+def format_deals(
+    user_id: int,
+    chat_id: int,
+    status: Optional[str] = None,
+    cursor: Optional[int] = None,
+    backward: bool = False
+) -> Dict[str, Any]:
+    deals = get_deals_page(user_id, status, cursor, backward, DEALS_PAGE_SIZE + 1)
+    has_more = len(deals) > DEALS_PAGE_SIZE
+    deals = deals[:DEALS_PAGE_SIZE]
+    if backward:
+        deals = deals[::-1]
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = cursor is not None, has_more
+    
+    status_buttons = [{'text': f"{'• ' if status is None else ''}Все", 'callback_data': 'dl:::'}]
+    status_buttons.extend(
+        {'text': f"{'• ' if code == status else ''}{emoji}", 'callback_data': f"dl:{code}::"}
+        for code, emoji in DEAL_STATUS_FILTERS
+    )
+    
+    if not deals:
+        keyboard = create_keyboard([status_buttons, [{'text': '🏠 Главное меню', 'callback_data': 'menu'}]])
+        return send_message(chat_id, NO_DEALS_TEXT if status is None else NO_FILTERED_DEALS_TEXT, keyboard)
+    
+    text = "📋 <b>Ваши сделки</b>\n\n"
+    buttons = []
+    
+    for deal in deals:
+        text += f"""━━━━━━━━━━━━━━━
+{DEAL_STATUS_EMOJI.get(deal.status, '•')} Сделка #{deal.id}
+💵 {deal.amount:.0f}₽ • {deal.currency}
+👤 {deal.buyer_name} ↔ {deal.seller_name}
+📅 {deal.created_at.strftime('%d.%m.%Y %H:%M')}
+Статус: {get_status_text(deal.status)}
+
+"""
+        
+        if deal.status == 'escrow' and deal.buyer_id == user_id:
+            buttons.append([
+                {'text': f"✅ Завершить #{deal.id}", 'callback_data': f"complete_{deal.id}"},
+                {'text': f"⚠️ Спор #{deal.id}", 'callback_data': f"dispute_{deal.id}"}
+            ])
+        elif deal.status == 'escrow':
+            buttons.append([
+                {'text': f"❌ Отменить #{deal.id}", 'callback_data': f"cancel_{deal.id}"},
+                {'text': f"⚠️ Спор #{deal.id}", 'callback_data': f"dispute_{deal.id}"}
+            ])
+    
+    navigation = []
+    if has_prev:
+        navigation.append({'text': '◀️ Назад', 'callback_data': f"dl:{status or ''}:p:{deals[0].id}"})
+    if has_next:
+        navigation.append({'text': 'Далее ▶️', 'callback_data': f"dl:{status or ''}:n:{deals[-1].id}"})
+    if navigation:
+        buttons.append(navigation)
+    buttons.append(status_buttons)
+    buttons.append([{'text': '🏠 Главное меню', 'callback_data': 'menu'}])
+    keyboard = create_keyboard(buttons)
+    
+    return send_message(chat_id, text, keyboard)
+
+
+def get_status_text(status: str) -> str:
+    return DEAL_STATUS_TEXTS.get(status, status)
+
+
+def update_user_role(user_id: int, role: str) -> User:
+    with db_cursor(tuples=True) as cursor:
+        statements.execute(
+            cursor,
+            'update_role',
+            f"UPDATE users SET role = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s RETURNING {USER_COLUMNS}",
+            (role, user_id)
+        )
+        user = User._make(cursor.fetchone())
+        cursor.connection.commit()
+    
+    user_cache.put(user)
+    return user
+
+
+def fits_money_column(value: Decimal, limit: Decimal) -> bool:
+    # DECIMAL(p, 2) округляет до копеек при записи: 99999999.999 в DECIMAL(10, 2)
+    # превращается в 100000000.00 и вызывает переполнение.
+    return value < limit and value.quantize(MONEY_QUANTUM, ROUND_HALF_UP) < limit
+
+
+def quantize_money(value: Decimal, limit: Decimal) -> Optional[Decimal]:
+    # Положительная сумма, округлённая до копеек и помещающаяся в DECIMAL(p, 2);
+    # None для всего остального, включая суммы, которые округляются в ноль.
+    if not value.is_finite() or value <= 0 or not fits_money_column(value, limit):
+        return None
+    value = value.quantize(MONEY_QUANTUM, ROUND_HALF_UP)
+    return value if value > 0 else None
+
+
+def parse_offer_id(value: str) -> int:
+    offer_id = int(value)
+    if not 0 < offer_id <= DB_INT_MAX:
+        raise ValueError('offer id out of range')
+    return offer_id
+
+
+def parse_offer_row(fields: List[str]) -> Tuple[Decimal, Decimal, Decimal, str]:
+    if len(fields) != 4:
+        raise ValueError('expected four fields')
+    price, min_amt, max_amt = (Decimal(value.strip()) for value in fields[:3])
+    currency = fields[3].strip().upper()
+    if not (price.is_finite() and min_amt.is_finite() and max_amt.is_finite()) or not currency:
+        raise ValueError('invalid number')
+    if not (price > 0 and 0 < min_amt <= max_amt):
+        raise ValueError('invalid offer limits')
+    if not (fits_money_column(price, OFFER_PRICE_LIMIT) and fits_money_column(max_amt, OFFER_AMOUNT_LIMIT)):
+        raise ValueError('value does not fit the column')
+    if len(currency) > OFFER_CURRENCY_MAX_LENGTH:
+        raise ValueError('currency code is too long')
+    return price, min_amt, max_amt, currency
+
+
+def parse_reprice_row(fields: List[str]) -> Tuple[int, Decimal]:
+    if len(fields) != 2:
+        raise ValueError('expected two fields')
+    offer_id, price = parse_offer_id(fields[0]), Decimal(fields[1].strip())
+    if not price.is_finite() or price <= 0:
+        raise ValueError('invalid price')
+    if not fits_money_column(price, OFFER_PRICE_LIMIT):
+        raise ValueError('price does not fit the column')
+    return offer_id, price
+
+
+def parse_bulk_rows(rows: List[Tuple[int, List[str]]], parse: Callable) -> Tuple[List[Tuple], List[int]]:
+    parsed, invalid = [], []
+    for number, fields in rows:
+        try:
+            parsed.append(parse(fields))
+        except (ValueError, InvalidOperation):
+            invalid.append(number)
+    return parsed, invalid
+
+
+def format_bulk_errors(chat_id: int, title: str, invalid: List[int], total: int) -> Dict[str, Any]:
+    shown = ', '.join(map(str, invalid[:BULK_ERRORS_SHOWN]))
+    more = f" и ещё {len(invalid) - BULK_ERRORS_SHOWN}" if len(invalid) > BULK_ERRORS_SHOWN else ''
+    return send_message(chat_id, f"""❌ <b>{title}</b>
+
+Ошибки в строках: {shown}{more} (всего строк: {total})
+Исправьте их и отправьте данные снова — ничего не было сохранено.""", CANCEL_KEYBOARD)
+
+
+def apply_offer_rows(user: User, chat_id: int, rows: List[Tuple[int, List[str]]]) -> Dict[str, Any]:
+    if not rows or len(rows) > BULK_MAX_ROWS:
+        return send_message(chat_id, f"❌ За один раз можно загрузить от 1 до {BULK_MAX_ROWS} объявлений", CANCEL_KEYBOARD)
+    parsed, invalid = parse_bulk_rows(rows, parse_offer_row)
+    if invalid:
+        return format_bulk_errors(chat_id, 'Объявления не созданы', invalid, len(rows))
+    
+    try:
+        offers = create_offers(user.id, parsed)
+    except psycopg2.DataError:
+        return send_message(chat_id, OFFER_LIMITS_ERROR_TEXT, CANCEL_KEYBOARD)
+    session_store.clear(user.id)
+    by_currency: Dict[str, int] = {}
+    for offer in offers:
+        by_currency[offer.currency] = by_currency.get(offer.currency, 0) + 1
+    summary = '\n'.join(f"💎 {currency}: {count}" for currency, count in sorted(by_currency.items()))
+    return send_message(chat_id, f"""✅ <b>Создано объявлений: {len(offers)}</b>
+
+{summary}""", MENU_KEYBOARD)
+
+
+def apply_reprice(user: User, chat_id: int, rows: List[Tuple[int, List[str]]]) -> Dict[str, Any]:
+    if not rows or len(rows) > BULK_MAX_ROWS:
+        return send_message(chat_id, f"❌ За один раз можно обновить от 1 до {BULK_MAX_ROWS} цен", MENU_KEYBOARD)
+    parsed, invalid = parse_bulk_rows(rows, parse_reprice_row)
+    if invalid:
+        return format_bulk_errors(chat_id, 'Цены не обновлены', invalid, len(rows))
+    
+    try:
+        updated = reprice_offers(user.id, dict(parsed))
+    except psycopg2.DataError:
+        return send_message(chat_id, OFFER_LIMITS_ERROR_TEXT, MENU_KEYBOARD)
+    return send_message(chat_id, f"✅ Обновлено цен: {len(updated)} из {len(rows)}", MENU_KEYBOARD)
+
+
+def create_offers(seller_id: int, rows: List[Tuple[Decimal, Decimal, Decimal, str]]) -> List[Offer]:
+    with db_cursor(tuples=True) as cursor:
+        offers = psycopg2.extras.execute_values(
+            cursor,
+            f"""WITH o AS (
+                   INSERT INTO offers (seller_id, price, min_amount, max_amount, currency)
+                   VALUES %s
+                   RETURNING *
+               )
+               SELECT {OFFER_BOOK_COLUMNS}
+               FROM o
+               JOIN users u ON o.seller_id = u.id""",
+            [(seller_id, *row) for row in rows],
+            page_size=len(rows),
+            fetch=True
+        )
+        cursor.connection.commit()
+    
+    offers = list(map(Offer._make, offers))
+    if ORDER_BOOK_SNAPSHOT:
+        for offer in offers:
+            order_book.add(offer)
+    return offers
+
+
+def reprice_offers(seller_id: int, prices: Dict[int, Decimal]) -> List[Offer]:
+    with db_cursor(tuples=True) as cursor:
+        offers = psycopg2.extras.execute_values(
+            cursor,
+            f"""UPDATE offers o
+                SET price = v.price, updated_at = CURRENT_TIMESTAMP
+                FROM (VALUES %s) AS v (id, seller_id, price), users u
+                WHERE o.id = v.id AND o.seller_id = v.seller_id AND o.is_active AND u.id = o.seller_id
+                RETURNING {OFFER_BOOK_COLUMNS}""",
+            [(offer_id, seller_id, price) for offer_id, price in prices.items()],
+            template='(%s::int, %s::int, %s::numeric)',
+            page_size=len(prices),
+            fetch=True
+        )
+        cursor.connection.commit()
+    
+    offers = list(map(Offer._make, offers))
+    if ORDER_BOOK_SNAPSHOT:
+        for offer in offers:
+            order_book.add(offer)
+    return offers
+
+
+def deactivate_offers(seller_id: int, offer_ids: Optional[List[int]] = None, currency: Optional[str] = None) -> List[int]:
+    with db_cursor() as cursor:
+        cursor.execute(
+            """UPDATE offers SET is_active = FALSE, withdrawn_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+               WHERE seller_id = %s AND withdrawn_at IS NULL
+                 AND (%s::int[] IS NULL OR id = ANY(%s::int[]))
+                 AND (%s::text IS NULL OR currency = %s)
+               RETURNING id""",
+            (seller_id, offer_ids, offer_ids, currency, currency)
+        )
+        removed = [row['id'] for row in cursor.fetchall()]
+        cursor.connection.commit()
+    
+    if ORDER_BOOK_SNAPSHOT:
+        for offer_id in removed:
+            order_book.remove(offer_id)
+    return removed
+
+
+def format_deal_error(result: str, chat_id: int) -> Dict[str, Any]:
+    return send_message(chat_id, DEAL_ERROR_TEXTS.get(result, "❌ Действие недоступно"), DEALS_MENU_KEYBOARD)
+
+
+def format_new_deal_notification(deal_id: int, amount: Decimal, price: Decimal, currency: str) -> str:
+    return f"""🔔 <b>Новая сделка #{deal_id}</b>
+
+💰 Сумма: {amount:.0f}₽
+💵 Цена: {price:.2f}₽
+💎 {currency}
+🔒 Средства в эскроу"""
+
+
+def initiate_deal(buyer_id: int, offer_id: int, chat_id: int, amount: Optional[Decimal] = None) -> Dict[str, Any]:
+    with db_cursor() as cursor:
+        statements.execute(cursor, 'open_deal', "SELECT * FROM escrow_open_deal(%s, %s, %s)", (buyer_id, offer_id, amount))
+        deal = cursor.fetchone()
+        
+        if deal['result'] == 'created':
+            enqueue_notification(
+                cursor,
+                deal['seller_id'],
+                format_new_deal_notification(deal['deal_id'], deal['amount'], deal['price'], deal['currency']),
+                DEAL_NOTIFICATION_KEYBOARD
+            )
+        cursor.connection.commit()
+    
+    if deal['result'] == 'created':
+        user_cache.invalidate_user_id(buyer_id)
+    
+    if ORDER_BOOK_SNAPSHOT:
+        if deal['offer_is_active']:
+            order_book.update_limit(offer_id, deal['offer_max_amount'])
+        else:
+            order_book.remove(offer_id)
+    
+    if deal['result'] not in ('created', 'exists'):
+        return format_deal_error(deal['result'], chat_id)
+    
+    return send_message(chat_id, f"""{'✅ <b>Сделка создана!</b>' if deal['result'] == 'created' else f"ℹ️ <b>Сделка #{deal['deal_id']} уже открыта</b>"}
+
+💰 Сумма: {deal['amount']:.0f}₽
+💵 Цена: {deal['price']:.2f}₽
+🔒 Средства в эскроу
+
+Ожидайте подтверждения продавца.""", DEALS_MENU_KEYBOARD)
+
+
+def quote_order(currency: str, amount: Decimal, buyer_id: int, max_price: Optional[Decimal] = None) -> List[Tuple[Offer, Decimal]]:
+    if ORDER_BOOK_SNAPSHOT:
+        if order_book.is_stale():
+            refresh_order_book()
+        return order_book.match(currency, amount, buyer_id, max_price)
+    
+    params: List[Any] = [currency, buyer_id]
+    if max_price is not None:
+        params.append(max_price)
+    params.append(MATCH_QUOTE_DEPTH)
+    with db_cursor(tuples=True, read=True) as cursor:
+        statements.execute(cursor, 'quote_order', f"""
+            SELECT {OFFER_READ_COLUMNS}
+            FROM offer_book b
+            WHERE b.currency = %s AND b.seller_id <> %s{' AND b.price <= %s' if max_price is not None else ''}
+            ORDER BY b.price, b.offer_id
+            LIMIT %s
+        """, params)
+        return plan_fills(map(Offer._make, cursor.fetchall()), amount, buyer_id, max_price)
+
+
+def format_market_quote(user: User, chat_id: int, currency: str, amount: Decimal, price_cap: Optional[Decimal] = None) -> Dict[str, Any]:
+    fills = quote_order(currency, amount, user.id, price_cap)
+    if not fills:
+        return send_message(chat_id, NO_OFFERS_TEXT, MENU_KEYBOARD)
+    
+    filled = sum(take for _, take in fills)
+    max_price = max(offer.price for offer, _ in fills)
+    average = sum(offer.price * take for offer, take in fills) / filled
+    lines = '\n'.join(f"• {offer.price:.2f}₽ × {take:.0f}₽ — {offer.username}" for offer, take in fills)
+    text = f"""🎯 <b>Заявка {amount:.0f}₽ • {currency}{f' • до {price_cap:.2f}₽' if price_cap is not None else ''}</b>
+
+{lines}
+
+📊 Исполнится: {filled:.0f}₽ в {len(fills)} сделках
+💵 Средняя цена: {average:.2f}₽, не выше {max_price:.2f}₽"""
+    if filled < amount:
+        text += f"\n⚠️ Не хватает предложений на {amount - filled:.0f}₽"
+    
+    keyboard = create_keyboard([
+        [{'text': '✅ Подтвердить', 'callback_data': f"mk:{currency}:{filled}:{max_price}"}],
+        [{'text': '✖️ Отмена', 'callback_data': 'menu'}]
+    ])
+    return send_message(chat_id, text, keyboard)
+
+
+def execute_market_order(user: User, chat_id: int, currency: str, amount: Decimal, max_price: Decimal) -> Dict[str, Any]:
+    if quantize_money(amount, OFFER_AMOUNT_LIMIT) != amount or quantize_money(max_price, OFFER_PRICE_LIMIT) != max_price:
+        raise RouteError('invalid market order')
+    with db_cursor() as cursor:
+        cursor.execute(
+            "SELECT * FROM escrow_match_order(%s, %s, %s, %s, %s)",
+            (user.id, currency, amount, max_price, MATCH_MAX_FILLS)
+        )
+        fills = cursor.fetchall()
+        if fills:
+            enqueue_notifications(cursor, [
+                (fill['seller_id'], format_new_deal_notification(fill['deal_id'], fill['amount'], fill['price'], currency), DEAL_NOTIFICATION_KEYBOARD)
+                for fill in fills
+            ])
+        cursor.connection.commit()
+    
+    if not fills:
+        return send_message(chat_id, "❌ Не удалось исполнить заявку: предложения изменились или недостаточно средств", DEALS_MENU_KEYBOARD)
+    
+    user_cache.invalidate_user_id(user.id)
+    if ORDER_BOOK_SNAPSHOT:
+        for fill in fills:
+            if fill['offer_is_active']:
+                order_book.update_limit(fill['offer_id'], fill['offer_max_amount'])
+            else:
+                order_book.remove(fill['offer_id'])
+    
+    filled = sum(fill['amount'] for fill in fills)
+    deals = ', '.join(f"#{fill['deal_id']}" for fill in fills)
+    return send_message(chat_id, f"""✅ <b>Заявка исполнена: {filled:.0f}₽ из {amount:.0f}₽</b>
+
+📋 Сделки: {deals}
+🔒 Средства в эскроу
+
+Ожидайте подтверждения продавцов.""", DEALS_MENU_KEYBOARD)
+
+
+def transition_deal(deal_id: int, user_id: int, status: str) -> Dict[str, Any]:
+    with db_cursor() as cursor:
+        statements.execute(cursor, 'transition_deal', "SELECT * FROM escrow_transition(%s, %s, %s)", (deal_id, user_id, status))
+        deal = cursor.fetchone()
+        
+        if deal['result'] == 'ok':
+            counterparty_id = deal['seller_id'] if deal['buyer_id'] == user_id else deal['buyer_id']
+            enqueue_notification(
+                cursor,
+                counterparty_id,
+                DEAL_TRANSITION_NOTIFICATIONS[status].format(deal_id=deal_id),
+                DEAL_NOTIFICATION_KEYBOARD
+            )
+            if status == 'dispute' and ADMIN_TELEGRAM_IDS:
+                enqueue_admin_notification(
+                    cursor,
+                    DISPUTE_ADMIN_NOTIFICATION.format(deal_id=deal_id, amount=deal['amount'], currency=deal['currency']),
+                    DISPUTES_KEYBOARD
+                )
+        cursor.connection.commit()
+    
+    if deal['result'] == 'ok':
+        user_cache.invalidate_user_id(deal['buyer_id'])
+        user_cache.invalidate_user_id(deal['seller_id'])
+        if ORDER_BOOK_SNAPSHOT and status == 'cancelled':
+            order_book.mark_stale()
+    return deal
+
+
+def complete_deal(deal_id: int, user_id: int, chat_id: int) -> Dict[str, Any]:
+    deal = transition_deal(deal_id, user_id, 'completed')
+    if deal['result'] not in ('ok', 'unchanged'):
+        return format_deal_error(deal['result'], chat_id)
+    
+    return send_message(chat_id, DEAL_COMPLETED_TEXT, DEALS_MENU_KEYBOARD)
+
+
+def cancel_deal(deal_id: int, user_id: int, chat_id: int) -> Dict[str, Any]:
+    deal = transition_deal(deal_id, user_id, 'cancelled')
+    if deal['result'] not in ('ok', 'unchanged'):
+        return format_deal_error(deal['result'], chat_id)
+    
+    return send_message(chat_id, DEAL_CANCELLED_TEXT, DEALS_MENU_KEYBOARD)
+
+
+def open_dispute(deal_id: int, user_id: int, chat_id: int) -> Dict[str, Any]:
+    deal = transition_deal(deal_id, user_id, 'dispute')
+    if deal['result'] not in ('ok', 'unchanged'):
+        return format_deal_error(deal['result'], chat_id)
+    
+    return send_message(chat_id, DISPUTE_OPENED_TEXT, DEALS_MENU_KEYBOARD)
+
+
+def get_open_disputes(limit: int = DISPUTES_PAGE_SIZE) -> Tuple[List[DealSummary], int]:
+    with db_cursor(tuples=True, read=True) as cursor:
+        statements.execute(cursor, 'open_disputes', """
+            SELECT d.id, d.buyer_id, d.seller_id, buyer.username, seller.username,
+                   d.amount, d.currency, d.status, d.created_at, count(*) OVER ()
+            FROM deals d
+            JOIN users buyer ON buyer.id = d.buyer_id
+            JOIN users seller ON seller.id = d.seller_id
+            WHERE d.status = 'dispute'
+            ORDER BY d.updated_at, d.id
+            LIMIT %s
+        """, (limit,))
+        rows = cursor.fetchall()
+    return [DealSummary._make(row[:-1]) for row in rows], rows[0][-1] if rows else 0
+
+
+def format_disputes(chat_id: int, notice: str = '') -> Dict[str, Any]:
+    disputes, total = get_open_disputes()
+    if not disputes:
+        return send_message(chat_id, notice + NO_DISPUTES_TEXT, MENU_KEYBOARD)
+    
+    text = f"{notice}⚖️ <b>Открытые споры: {total}</b>\n\n"
+    buttons = []
+    for deal in disputes:
+        text += f"""━━━━━━━━━━━━━━━
+⚠️ Сделка #{deal.id}
+💵 {deal.amount:.0f}₽ • {deal.currency}
+👤 {deal.buyer_name} ↔ {deal.seller_name}
+📅 {deal.created_at.strftime('%d.%m.%Y %H:%M')}
+
+"""
+        buttons.append([
+            {'text': f"✅ Продавцу #{deal.id}", 'callback_data': f"rd:{deal.id}:completed"},
+            {'text': f"↩️ Покупателю #{deal.id}", 'callback_data': f"rd:{deal.id}:cancelled"}
+        ])
+    buttons.append([{'text': '🔄 Обновить', 'callback_data': 'disputes'}])
+    buttons.append([{'text': '🏠 Главное меню', 'callback_data': 'menu'}])
+    return send_message(chat_id, text, create_keyboard(buttons))
+
+
+def resolve_dispute(deal_id: int, resolution: str, chat_id: int) -> Dict[str, Any]:
+    with db_cursor() as cursor:
+        cursor.execute("SELECT * FROM escrow_resolve_dispute(%s, %s)", (deal_id, resolution))
+        deal = cursor.fetchone()
+        if deal['result'] == 'ok':
+            enqueue_notifications(cursor, [
+                (user_id, DISPUTE_RESOLVED_NOTIFICATIONS[resolution].format(deal_id=deal_id), DEAL_NOTIFICATION_KEYBOARD)
+                for user_id in (deal['buyer_id'], deal['seller_id'])
+            ])
+        cursor.connection.commit()
+    
+    if deal['result'] != 'ok':
+        return format_deal_error(deal['result'], chat_id)
+    
+    DISPUTES_RESOLVED.inc(resolution)
+    user_cache.invalidate_user_id(deal['buyer_id'])
+    user_cache.invalidate_user_id(deal['seller_id'])
+    if ORDER_BOOK_SNAPSHOT and resolution == 'cancelled':
+        order_book.mark_stale()
+    return format_disputes(chat_id, DISPUTE_RESOLVED_TEXTS[resolution].format(deal_id=deal_id) + "\n\n")
+
+
+def expire_stale_deals(limit: int) -> int:
+    with db_cursor() as cursor:
+        cursor.execute(
+            "SELECT * FROM escrow_expire_deals(make_interval(hours => %s), %s)",
+            (DEAL_ESCROW_TTL_HOURS, limit)
+        )
+        deals = cursor.fetchall()
+        if deals:
+            enqueue_notifications(cursor, [
+                (user_id, DEAL_EXPIRED_NOTIFICATION.format(deal_id=deal['deal_id']), DEAL_NOTIFICATION_KEYBOARD)
+                for deal in deals
+                for user_id in (deal['buyer_id'], deal['seller_id'])
+            ])
+        cursor.connection.commit()
+    
+    for deal in deals:
+        user_cache.invalidate_user_id(deal['buyer_id'])
+    return len(deals)
+
+
+def deactivate_stale_offers(limit: int) -> int:
+    with db_cursor() as cursor:
+        cursor.execute(
+            """UPDATE offers SET is_active = FALSE, withdrawn_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+               WHERE id IN (
+                   SELECT id FROM offers
+                   WHERE withdrawn_at IS NULL
+                     AND updated_at < CURRENT_TIMESTAMP - make_interval(days => %s)
+                   ORDER BY updated_at
+                   LIMIT %s
+                   FOR UPDATE SKIP LOCKED
+               )
+               RETURNING id, seller_id""",
+            (OFFER_STALE_DAYS, limit)
+        )
+        offers = cursor.fetchall()
+        by_seller: Dict[int, List[int]] = {}
+        for offer in offers:
+            by_seller.setdefault(offer['seller_id'], []).append(offer['id'])
+        if by_seller:
+            enqueue_notifications(cursor, [
+                (
+                    seller_id,
+                    OFFERS_EXPIRED_NOTIFICATION.format(days=OFFER_STALE_DAYS, offer_ids=', '.join(f"#{offer_id}" for offer_id in offer_ids)),
+                    MENU_KEYBOARD
+                )
+                for seller_id, offer_ids in by_seller.items()
+            ])
+        cursor.connection.commit()
+    
+    if ORDER_BOOK_SNAPSHOT:
+        for offer in offers:
+            order_book.remove(offer['id'])
+    return len(offers)
+
+
+def archive_closed_deals(limit: int) -> int:
+    with db_cursor() as cursor:
+        cursor.execute(
+            "SELECT deals_archive_batch(make_interval(days => %s), %s) AS moved",
+            (DEAL_ARCHIVE_AFTER_DAYS, limit)
+        )
+        moved = cursor.fetchone()['moved']
+        cursor.connection.commit()
+    return moved
+
+
+class MaintenanceScheduler:
+    jobs: Tuple[Tuple[str, Callable[[int], int]], ...] = (
+        ('expire_deals', expire_stale_deals),
+        ('deactivate_offers', deactivate_stale_offers),
+        ('archive_deals', archive_closed_deals)
+    )
+    
+    def __init__(self, interval: float, batch_size: int, max_batches: int):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+    
+    def run_once(self) -> Dict[str, int]:
+        totals = {}
+        for name, job in self.jobs:
+            total = 0
+            for _ in range(self.max_batches):
+                try:
+                    processed = job(self.batch_size)
+                except Exception as e:
+                    print(f"maintenance job {name} failed: {e}")
+                    break
+                total += processed
+                if processed < self.batch_size:
+                    break
+            totals[name] = total
+            if total:
+                MAINTENANCE_ROWS.inc(name, amount=total)
+        
+        if totals['expire_deals'] or totals['deactivate_offers']:
+            outbox_sender.wake()
+            if ORDER_BOOK_SNAPSHOT:
+                order_book.mark_stale()
+        return totals
+    
+    def start(self):
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='maintenance', daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+
+maintenance = MaintenanceScheduler(MAINTENANCE_INTERVAL, MAINTENANCE_BATCH_SIZE, MAINTENANCE_MAX_BATCHES)
+
+
+EXPORT_COLUMNS = {
+    'deals': ('id', 'offer_id', 'buyer_id', 'seller_id', 'amount', 'price', 'currency', 'status', 'escrow_amount', 'created_at', 'updated_at'),
+    'offers': ('id', 'seller_id', 'price', 'min_amount', 'max_amount', 'currency', 'is_active', 'created_at', 'updated_at')
+}
+REPORT_DEALS_SOURCE = """(
+    SELECT buyer_id, seller_id, amount, currency, status, created_at FROM deals
+    UNION ALL
+    SELECT buyer_id, seller_id, amount, currency, status, created_at FROM deals_archive
+) d"""
+
+
+@contextmanager
+def report_connection() -> Iterator[Any]:
+    # Отчёты и выгрузки идут по отдельному соединению (по умолчанию к реплике)
+    # в одном снимке REPEATABLE READ: долгие запросы не занимают слоты пула вебхука.
+    conn = psycopg2.connect(DATABASE_REPORT_URL, cursor_factory=timed_cursor_class(False))
+    try:
+        conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        yield conn
+    finally:
+        conn.close()
+
+
+def query_volume_report(cursor, days: int, top: int) -> Dict[str, List[Dict[str, Any]]]:
+    cursor.execute(f"""
+        SELECT currency,
+               count(*) AS deals,
+               count(*) FILTER (WHERE status = 'completed') AS completed,
+               count(*) FILTER (WHERE status = 'dispute') AS disputes,
+               coalesce(sum(amount) FILTER (WHERE status = 'completed'), 0) AS volume
+        FROM {REPORT_DEALS_SOURCE}
+        WHERE created_at >= CURRENT_TIMESTAMP - make_interval(days => %s)
+        GROUP BY currency
+        ORDER BY volume DESC, currency
+    """, (days,))
+    by_currency = cursor.fetchall()
+    
+    cursor.execute(f"""
+        SELECT u.id AS user_id, u.username,
+               count(*) AS deals,
+               coalesce(sum(d.amount) FILTER (WHERE d.buyer_id = u.id), 0) AS bought,
+               coalesce(sum(d.amount) FILTER (WHERE d.seller_id = u.id), 0) AS sold,
+               sum(d.amount) AS volume
+        FROM {REPORT_DEALS_SOURCE}
+        CROSS JOIN LATERAL (VALUES (d.buyer_id), (d.seller_id)) AS participant (user_id)
+        JOIN users u ON u.id = participant.user_id
+        WHERE d.status = 'completed' AND d.created_at >= CURRENT_TIMESTAMP - make_interval(days => %s)
+        GROUP BY u.id, u.username
+        ORDER BY volume DESC, u.id
+        LIMIT %s
+    """, (days, top))
+    return {'by_currency': by_currency, 'by_user': cursor.fetchall()}
+
+
+def format_volume_report(chat_id: int, days: int) -> Dict[str, Any]:
+    try:
+        with report_connection() as conn, conn.cursor() as cursor:
+            report = query_volume_report(cursor, days, REPORT_TOP_USERS)
+    except psycopg2.Error as e:
+        print(f"volume report failed: {e}")
+        return send_message(chat_id, "❌ Не удалось построить отчёт", MENU_KEYBOARD)
+    
+    if not report['by_currency']:
+        return send_message(chat_id, f"📭 Сделок за {days} дн. нет", MENU_KEYBOARD)
+    
+    text = f"📊 <b>Объёмы за {days} дн.</b>\n\n<b>По валютам</b>\n"
+    for row in report['by_currency']:
+        text += f"💎 {row['currency']}: {row['volume']:.0f}₽ • сделок {row['deals']} (✅ {row['completed']}, ⚠️ {row['disputes']})\n"
+    if report['by_user']:
+        text += "\n<b>Пользователи по объёму</b>\n"
+        for place, row in enumerate(report['by_user'], 1):
+            text += f"{place}. @{row['username']}: {row['volume']:.0f}₽ (🛒 {row['bought']:.0f}₽, 💼 {row['sold']:.0f}₽) • сделок {row['deals']}\n"
+    return send_message(chat_id, text, MENU_KEYBOARD)
+
+
+def export_batches(conn, table: str, since: Optional[str] = None, include_archive: bool = False) -> Iterator[List[Tuple]]:
+    # Именованный (серверный) курсор: строки приходят пачками по EXPORT_BATCH_SIZE,
+    # память процесса не зависит от размера таблицы.
+    columns = ', '.join(EXPORT_COLUMNS[table])
+    source = table
+    if include_archive and table == 'deals':
+        source = f"(SELECT {columns} FROM deals UNION ALL SELECT {columns} FROM deals_archive) exported"
+    query = f"SELECT {columns} FROM {source}"
+    params: Tuple = ()
+    if since is not None:
+        query += " WHERE created_at >= %s"
+        params = (since,)
+    
+    with conn.cursor(name=f"export_{table}", cursor_factory=timed_cursor_class(True)) as cursor:
+        cursor.itersize = EXPORT_BATCH_SIZE
+        cursor.execute(query + " ORDER BY id", params)
+        while True:
+            batch = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not batch:
+                return
+            yield batch
+
+
+def export_value(value: Any) -> str:
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+
+def write_export(out, columns: Tuple[str, ...], batches: Iterator[List[Tuple]], fmt: str) -> int:
+    written = 0
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        for batch in batches:
+            writer.writerows(batch)
+            written += len(batch)
+        return written
+    
+    for batch in batches:
+        out.writelines(json.dumps(dict(zip(columns, row)), default=export_value, ensure_ascii=False) + '\n' for row in batch)
+        written += len(batch)
+    return written
+
+
+class QueueFull(Exception):
+    pass
+
+
+class UpdateDispatcher:
+    def __init__(self, workers: int, max_pending: int = DISPATCH_MAX_PENDING, max_lane_depth: int = DISPATCH_MAX_LANE_DEPTH):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='update')
+        self.max_pending = max_pending
+        self.max_lane_depth = max_lane_depth
+        self._lanes: Dict[Any, deque] = {}
+        self._pending = 0
+        self._cond = threading.Condition()
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.peak_lane_depth = 0
+        self.wait_seconds_total = 0.0
+        metrics.register(Gauge('bot_dispatch_pending', 'Updates queued or running in the dispatcher.', lambda: self._pending))
+        metrics.register(Gauge('bot_dispatch_lanes', 'Chats with queued or running updates.', lambda: len(self._lanes)))
+        metrics.register(Gauge('bot_dispatch_rejected_total', 'Updates rejected by dispatcher backpressure.', lambda: self.rejected, 'counter'))
+    
+    def submit(self, key: Any, fn: Callable, *args: Any, timeout: Optional[float] = None) -> Future:
+        future: Future = Future()
+        with self._cond:
+            lane = self._lanes.get(key)
+            if lane is not None and len(lane) >= self.max_lane_depth:
+                self.rejected += 1
+                raise QueueFull(f"lane {key!r} is full")
+            if not self._cond.wait_for(lambda: self._pending < self.max_pending, timeout):
+                self.rejected += 1
+                raise QueueFull('dispatcher is full')
+            
+            self._pending += 1
+            self.submitted += 1
+            item = (future, fn, args, time.monotonic())
+            lane = self._lanes.get(key)
+            if lane is not None:
+                lane.append(item)
+                self.peak_lane_depth = max(self.peak_lane_depth, len(lane))
+                return future
+            self._lanes[key] = deque([item])
+        self.executor.submit(self._drain, key)
+        return future
+    
+    def _drain(self, key: Any):
+        while True:
+            with self._cond:
+                lane = self._lanes[key]
+                if not lane:
+                    del self._lanes[key]
+                    return
+                future, fn, args, queued_at = lane.popleft()
+                self.wait_seconds_total += time.monotonic() - queued_at
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+            with self._cond:
+                self._pending -= 1
+                self.completed += 1
+                self._cond.notify()
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                'pending': self._pending,
+                'lanes': len(self._lanes),
+                'max_lane_depth': max((len(lane) for lane in self._lanes.values()), default=0),
+                'peak_lane_depth': self.peak_lane_depth,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'avg_wait_seconds': self.wait_seconds_total / self.completed if self.completed else 0.0
+            }
+    
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+def get_lane_key(update: Dict[str, Any]) -> Any:
+    chat_id = get_update_chat_id(update)
+    return chat_id if chat_id is not None else ('update', update.get('update_id'))
+
+
+def reply_via_api(response_data: Optional[Dict[str, Any]]):
+    if response_data is None:
+        return
+    payload = {key: value for key, value in response_data.items() if key != 'method'}
+    outbox_sender.limiter.wait(payload['chat_id'])
+    call_telegram(response_data['method'], payload)
+
+
+def process_polled_update(update: Dict[str, Any]):
+    try:
+        reply_via_api(process_update(update))
+    except Exception as e:
+        print(f"update {update.get('update_id')} failed: {e}")
+
+
+async def run_polling(workers: int = SERVER_WORKERS):
+    dispatcher = UpdateDispatcher(workers)
+    maintenance.start()
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, call_telegram, 'deleteWebhook', {})
+    offset: Optional[int] = None
+    try:
+        while True:
+            payload = {'offset': offset, 'timeout': POLL_TIMEOUT, 'allowed_updates': ['message', 'callback_query']}
+            try:
+                result = await loop.run_in_executor(
+                    None, functools.partial(call_telegram, 'getUpdates', payload, POLL_TIMEOUT + 10)
+                )
+            except TelegramError as e:
+                print(f"getUpdates failed: {e}")
+                await asyncio.sleep(e.retry_after or 1)
+                continue
+            except (urllib.error.URLError, OSError) as e:
+                print(f"getUpdates failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            
+            for update in result.get('result', []):
+                submit = functools.partial(dispatcher.submit, get_lane_key(update), process_polled_update, update)
+                while True:
+                    try:
+                        await loop.run_in_executor(None, submit)
+                        break
+                    except QueueFull:
+                        await asyncio.sleep(0.1)
+                offset = update['update_id'] + 1
+    finally:
+        maintenance.stop()
+        dispatcher.shutdown()
+
+
+def create_asgi_app(workers: int = SERVER_WORKERS) -> Callable:
+    dispatcher = UpdateDispatcher(workers)
+    
+    async def app(scope: Dict[str, Any], receive: Callable, send: Callable):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    maintenance.start()
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    maintenance.stop()
+                    dispatcher.shutdown()
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+        
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        event = {'httpMethod': scope['method'], 'body': body.decode('utf-8') or '{}'}
+        
+        if scope['method'] == 'GET' and scope.get('path') == '/metrics':
+            response = {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'text/plain; version=0.0.4'},
+                'body': metrics.render()
+            }
+        elif scope['method'] == 'GET' and scope.get('path') == '/stats':
+            response = {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json'},
+                'body': json_dumps(dispatcher.stats())
+            }
+        elif scope['method'] == 'POST':
+            try:
+                update = json.loads(event['body'])
+            except ValueError:
+                update = {}
+            key = get_lane_key(update) if isinstance(update, dict) else None
+            loop = asyncio.get_running_loop()
+            try:
+                future = await loop.run_in_executor(
+                    None, functools.partial(dispatcher.submit, key, handler, event, None, timeout=DISPATCH_SUBMIT_TIMEOUT)
+                )
+                response = await asyncio.wrap_future(future)
+            except QueueFull:
+                response = {
+                    'statusCode': 503,
+                    'headers': {'Content-Type': 'application/json', 'Retry-After': '1'},
+                    'body': json_dumps({'error': 'Too busy'})
+                }
+        else:
+            response = handler(event, None)
+        
+        await send({
+            'type': 'http.response.start',
+            'status': response['statusCode'],
+            'headers': [(key.lower().encode(), value.encode()) for key, value in response['headers'].items()]
+        })
+        await send({'type': 'http.response.body', 'body': response['body'].encode('utf-8')})
+    
+    return app
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='P2P Exchange Bot как постоянный процесс')
+    modes = parser.add_subparsers(dest='mode', required=True)
+    poll = modes.add_parser('poll', help='long polling через getUpdates')
+    poll.add_argument('--workers', type=int, default=SERVER_WORKERS)
+    serve = modes.add_parser('serve', help='ASGI-вебхук (нужен uvicorn)')
+    serve.add_argument('--host', default='0.0.0.0')
+    serve.add_argument('--port', type=int, default=8080)
+    serve.add_argument('--workers', type=int, default=SERVER_WORKERS)
+    maintain = modes.add_parser('maintain', help='обслуживание БД: один проход (для cron) или цикл')
+    maintain.add_argument('--loop', action='store_true')
+    export = modes.add_parser('export', help='выгрузка deals/offers в CSV или JSONL серверным курсором')
+    export.add_argument('table', choices=sorted(EXPORT_COLUMNS))
+    export.add_argument('--format', choices=('csv', 'jsonl'), default='csv')
+    export.add_argument('--output', default='-', help='файл или - для stdout')
+    export.add_argument('--since', help='только строки с created_at не раньше даты (YYYY-MM-DD)')
+    export.add_argument('--archive', action='store_true', help='для deals: добавить deals_archive')
+    report = modes.add_parser('report', help='объёмы сделок по валютам и пользователям (JSON)')
+    report.add_argument('--days', type=int, default=REPORT_DAYS)
+    report.add_argument('--top', type=int, default=REPORT_TOP_USERS)
+    args = parser.parse_args(argv)
+    
+    if args.mode == 'export':
+        out = sys.stdout if args.output == '-' else open(args.output, 'w', newline='', encoding='utf-8')
+        try:
+            with report_connection() as conn:
+                batches = export_batches(conn, args.table, args.since, args.archive)
+                written = write_export(out, EXPORT_COLUMNS[args.table], batches, args.format)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        print(f"exported {written} {args.table} rows", file=sys.stderr)
+        return
+    
+    if args.mode == 'report':
+        with report_connection() as conn, conn.cursor() as cursor:
+            volumes = query_volume_report(cursor, args.days, args.top)
+        print(json.dumps(volumes, default=export_value, ensure_ascii=False, indent=2))
+        return
+    
+    if args.mode == 'maintain':
+        while True:
+            print(json.dumps(maintenance.run_once()))
+            if not args.loop:
+                return
+            time.sleep(MAINTENANCE_INTERVAL)
+    
+    if args.workers > DB_POOL_MAX_SIZE:
+        print(f"warning: {args.workers} workers share {DB_POOL_MAX_SIZE} pooled connections (DB_POOL_MAX_SIZE)")
+    enable_read_replicas()
+    
+    if args.mode == 'poll':
+        asyncio.run(run_polling(args.workers))
+    else:
+        import uvicorn
+        uvicorn.run(create_asgi_app(args.workers), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
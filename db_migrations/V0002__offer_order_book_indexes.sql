@@ -0,0 +1,11 @@
+-- Индексы для стакана предложений
+
+-- Лучшие цены по валюте среди активных предложений
+CREATE INDEX IF NOT EXISTS idx_offers_active_currency_price
+    ON offers(currency, price, id)
+    WHERE is_active = true;
+
+-- Лучшие цены по всем валютам
+CREATE INDEX IF NOT EXISTS idx_offers_active_price
+    ON offers(price, id)
+    WHERE is_active = true;
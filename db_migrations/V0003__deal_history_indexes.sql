@@ -0,0 +1,7 @@
+-- Индексы для истории сделок с keyset-пагинацией
+
+CREATE INDEX IF NOT EXISTS idx_deals_buyer_created
+    ON deals(buyer_id, created_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_deals_seller_created
+    ON deals(seller_id, created_at DESC, id DESC);
@@ -0,0 +1,153 @@
+-- Эскроу-движок: атомарное открытие сделок и переходы статусов
+
+ALTER TABLE users ADD CONSTRAINT users_balance_non_negative CHECK (balance >= 0);
+
+CREATE INDEX IF NOT EXISTS idx_deals_offer_buyer_open
+    ON deals(offer_id, buyer_id)
+    WHERE status IN ('pending', 'escrow');
+
+-- Открытие сделки: блокирует объявление, списывает средства покупателя в эскроу
+-- и уменьшает доступный лимит объявления. Повторный вызов возвращает открытую сделку.
+CREATE OR REPLACE FUNCTION escrow_open_deal(p_buyer_id INT, p_offer_id INT, p_amount DECIMAL)
+RETURNS TABLE (
+    result TEXT,
+    deal_id INT,
+    seller_id INT,
+    amount DECIMAL,
+    price DECIMAL,
+    currency VARCHAR,
+    offer_max_amount DECIMAL,
+    offer_is_active BOOLEAN
+) AS $$
+DECLARE
+    v_offer offers%ROWTYPE;
+    v_amount DECIMAL;
+    v_deal_id INT;
+BEGIN
+    SELECT * INTO v_offer FROM offers WHERE id = p_offer_id FOR UPDATE;
+    
+    IF NOT FOUND OR NOT v_offer.is_active THEN
+        RETURN QUERY SELECT 'offer_unavailable'::TEXT, NULL::INT, NULL::INT, NULL::DECIMAL,
+            NULL::DECIMAL, NULL::VARCHAR, NULL::DECIMAL, FALSE;
+        RETURN;
+    END IF;
+    
+    v_amount := COALESCE(p_amount, v_offer.min_amount);
+    
+    IF v_offer.seller_id = p_buyer_id THEN
+        result := 'own_offer';
+    ELSIF v_amount < v_offer.min_amount OR v_amount > v_offer.max_amount THEN
+        result := 'invalid_amount';
+    END IF;
+    
+    IF result IS NOT NULL THEN
+        RETURN QUERY SELECT result, NULL::INT, v_offer.seller_id, v_amount, v_offer.price,
+            v_offer.currency, v_offer.max_amount, v_offer.is_active;
+        RETURN;
+    END IF;
+    
+    SELECT d.id INTO v_deal_id FROM deals d
+    WHERE d.offer_id = p_offer_id AND d.buyer_id = p_buyer_id AND d.status IN ('pending', 'escrow')
+    LIMIT 1;
+    
+    IF FOUND THEN
+        RETURN QUERY SELECT 'exists'::TEXT, d.id, d.seller_id, d.amount, d.price, d.currency,
+            v_offer.max_amount, v_offer.is_active
+        FROM deals d WHERE d.id = v_deal_id;
+        RETURN;
+    END IF;
+    
+    UPDATE users SET balance = balance - v_amount, updated_at = CURRENT_TIMESTAMP
+    WHERE id = p_buyer_id AND balance >= v_amount;
+    
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'insufficient_funds'::TEXT, NULL::INT, v_offer.seller_id, v_amount,
+            v_offer.price, v_offer.currency, v_offer.max_amount, v_offer.is_active;
+        RETURN;
+    END IF;
+    
+    INSERT INTO deals (offer_id, buyer_id, seller_id, amount, price, currency, status, escrow_amount)
+    VALUES (p_offer_id, p_buyer_id, v_offer.seller_id, v_amount, v_offer.price, v_offer.currency, 'escrow', v_amount)
+    RETURNING id INTO v_deal_id;
+    
+    UPDATE offers
+    SET max_amount = offers.max_amount - v_amount,
+        is_active = offers.max_amount - v_amount >= offers.min_amount,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE id = p_offer_id
+    RETURNING offers.max_amount, offers.is_active INTO v_offer.max_amount, v_offer.is_active;
+    
+    RETURN QUERY SELECT 'created'::TEXT, v_deal_id, v_offer.seller_id, v_amount, v_offer.price,
+        v_offer.currency, v_offer.max_amount, v_offer.is_active;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Переход статуса сделки: completed (подтверждает покупатель), cancelled (продавец),
+-- dispute (любая сторона). Повторный переход в тот же статус ничего не меняет.
+CREATE OR REPLACE FUNCTION escrow_transition(p_deal_id INT, p_user_id INT, p_status VARCHAR)
+RETURNS TABLE (
+    result TEXT,
+    buyer_id INT,
+    seller_id INT,
+    amount DECIMAL,
+    currency VARCHAR
+) AS $$
+DECLARE
+    v_deal deals%ROWTYPE;
+BEGIN
+    SELECT * INTO v_deal FROM deals WHERE id = p_deal_id FOR UPDATE;
+    
+    IF NOT FOUND OR p_user_id NOT IN (v_deal.buyer_id, v_deal.seller_id) THEN
+        RETURN QUERY SELECT 'not_found'::TEXT, NULL::INT, NULL::INT, NULL::DECIMAL, NULL::VARCHAR;
+        RETURN;
+    END IF;
+    
+    IF v_deal.status = p_status THEN
+        result := 'unchanged';
+    ELSIF NOT (
+        (p_status = 'escrow' AND v_deal.status = 'pending')
+        OR (p_status = 'cancelled' AND v_deal.status IN ('pending', 'escrow') AND p_user_id = v_deal.seller_id)
+        OR (p_status = 'completed' AND v_deal.status = 'escrow' AND p_user_id = v_deal.buyer_id)
+        OR (p_status = 'dispute' AND v_deal.status = 'escrow')
+    ) THEN
+        result := 'invalid_transition';
+    END IF;
+    
+    IF result IS NOT NULL THEN
+        RETURN QUERY SELECT result, v_deal.buyer_id, v_deal.seller_id, v_deal.amount, v_deal.currency;
+        RETURN;
+    END IF;
+    
+    IF p_status = 'completed' THEN
+        UPDATE users SET
+            balance = balance + v_deal.escrow_amount,
+            total_sold = total_sold + v_deal.amount,
+            completed_deals = completed_deals + 1,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = v_deal.seller_id;
+        
+        UPDATE users SET
+            total_bought = total_bought + v_deal.amount,
+            completed_deals = completed_deals + 1,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = v_deal.buyer_id;
+    ELSIF p_status = 'cancelled' THEN
+        UPDATE users SET balance = balance + v_deal.escrow_amount, updated_at = CURRENT_TIMESTAMP
+        WHERE id = v_deal.buyer_id;
+        
+        UPDATE offers SET
+            max_amount = max_amount + v_deal.amount,
+            is_active = max_amount + v_deal.amount >= min_amount,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = v_deal.offer_id;
+    END IF;
+    
+    UPDATE deals SET
+        status = p_status,
+        escrow_amount = CASE WHEN p_status IN ('completed', 'cancelled') THEN 0 ELSE escrow_amount END,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE id = p_deal_id;
+    
+    RETURN QUERY SELECT 'ok'::TEXT, v_deal.buyer_id, v_deal.seller_id, v_deal.amount, v_deal.currency;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,9 @@
+-- Журнал обработанных Telegram update_id для защиты от повторной доставки вебхука
+
+CREATE TABLE IF NOT EXISTS processed_updates (
+    update_id BIGINT PRIMARY KEY,
+    processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_processed_updates_processed_at
+    ON processed_updates USING BRIN (processed_at);
@@ -0,0 +1,10 @@
+-- Состояние диалога пользователя (ввод объявления, ввод суммы сделки) для SESSION_STORE=postgres
+
+CREATE TABLE IF NOT EXISTS sessions (
+    user_id INT PRIMARY KEY REFERENCES users(id),
+    state VARCHAR(32) NOT NULL,
+    data JSONB,
+    expires_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions (expires_at);
@@ -0,0 +1,137 @@
+-- Денормализованная модель чтения: активные объявления со статистикой продавца
+-- и лента сделок по пользователям. Поддерживается триггерами в той же транзакции.
+
+CREATE TABLE IF NOT EXISTS offer_book (
+    offer_id INT PRIMARY KEY,
+    seller_id INT NOT NULL,
+    price DECIMAL(10, 2) NOT NULL,
+    min_amount DECIMAL(15, 2) NOT NULL,
+    max_amount DECIMAL(15, 2) NOT NULL,
+    currency VARCHAR(10) NOT NULL,
+    username VARCHAR(255),
+    rating DECIMAL(3, 2),
+    completed_deals INT
+);
+
+CREATE INDEX IF NOT EXISTS idx_offer_book_currency_price ON offer_book (currency, price, offer_id);
+CREATE INDEX IF NOT EXISTS idx_offer_book_price ON offer_book (price, offer_id);
+CREATE INDEX IF NOT EXISTS idx_offer_book_seller ON offer_book (seller_id);
+
+CREATE TABLE IF NOT EXISTS deal_feed (
+    deal_id INT NOT NULL REFERENCES deals(id) ON DELETE CASCADE,
+    user_id INT NOT NULL,
+    buyer_id INT NOT NULL,
+    seller_id INT NOT NULL,
+    buyer_name VARCHAR(255),
+    seller_name VARCHAR(255),
+    amount DECIMAL(15, 2) NOT NULL,
+    currency VARCHAR(10),
+    status VARCHAR(20) NOT NULL,
+    created_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (deal_id, user_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_deal_feed_user_created
+    ON deal_feed (user_id, created_at DESC, deal_id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_deal_feed_user_status_created
+    ON deal_feed (user_id, status, created_at DESC, deal_id DESC);
+
+CREATE OR REPLACE FUNCTION offer_book_sync() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        DELETE FROM offer_book WHERE offer_id = OLD.id;
+        RETURN NULL;
+    END IF;
+
+    IF NOT NEW.is_active THEN
+        DELETE FROM offer_book WHERE offer_id = NEW.id;
+        RETURN NULL;
+    END IF;
+
+    INSERT INTO offer_book (offer_id, seller_id, price, min_amount, max_amount, currency, username, rating, completed_deals)
+    SELECT NEW.id, NEW.seller_id, NEW.price, NEW.min_amount, NEW.max_amount, NEW.currency,
+           u.username, u.rating, u.completed_deals
+    FROM users u
+    WHERE u.id = NEW.seller_id
+    ON CONFLICT (offer_id) DO UPDATE
+    SET price = EXCLUDED.price,
+        min_amount = EXCLUDED.min_amount,
+        max_amount = EXCLUDED.max_amount,
+        currency = EXCLUDED.currency;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_offer_book_sync ON offers;
+CREATE TRIGGER trg_offer_book_sync
+    AFTER INSERT OR DELETE OR UPDATE OF price, min_amount, max_amount, currency, is_active ON offers
+    FOR EACH ROW EXECUTE FUNCTION offer_book_sync();
+
+CREATE OR REPLACE FUNCTION deal_feed_sync() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO deal_feed (deal_id, user_id, buyer_id, seller_id, buyer_name, seller_name, amount, currency, status, created_at)
+        SELECT NEW.id, participant.id, NEW.buyer_id, NEW.seller_id, buyer.username, seller.username,
+               NEW.amount, NEW.currency, NEW.status, NEW.created_at
+        FROM users buyer, users seller, (VALUES (NEW.buyer_id), (NEW.seller_id)) AS participant (id)
+        WHERE buyer.id = NEW.buyer_id AND seller.id = NEW.seller_id
+        ON CONFLICT (deal_id, user_id) DO NOTHING;
+        RETURN NULL;
+    END IF;
+
+    UPDATE deal_feed
+    SET status = NEW.status, amount = NEW.amount
+    WHERE deal_id = NEW.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_deal_feed_sync ON deals;
+CREATE TRIGGER trg_deal_feed_sync
+    AFTER INSERT OR UPDATE OF status, amount ON deals
+    FOR EACH ROW EXECUTE FUNCTION deal_feed_sync();
+
+CREATE OR REPLACE FUNCTION user_read_model_sync() RETURNS trigger AS $$
+BEGIN
+    UPDATE offer_book
+    SET username = NEW.username, rating = NEW.rating, completed_deals = NEW.completed_deals
+    WHERE seller_id = NEW.id;
+
+    IF OLD.username IS DISTINCT FROM NEW.username THEN
+        UPDATE deal_feed f SET buyer_name = NEW.username
+        FROM deals d
+        WHERE d.buyer_id = NEW.id AND f.deal_id = d.id;
+
+        UPDATE deal_feed f SET seller_name = NEW.username
+        FROM deals d
+        WHERE d.seller_id = NEW.id AND f.deal_id = d.id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_user_read_model_sync ON users;
+CREATE TRIGGER trg_user_read_model_sync
+    AFTER UPDATE OF username, rating, completed_deals ON users
+    FOR EACH ROW
+    WHEN (OLD.username IS DISTINCT FROM NEW.username
+          OR OLD.rating IS DISTINCT FROM NEW.rating
+          OR OLD.completed_deals IS DISTINCT FROM NEW.completed_deals)
+    EXECUTE FUNCTION user_read_model_sync();
+
+INSERT INTO offer_book (offer_id, seller_id, price, min_amount, max_amount, currency, username, rating, completed_deals)
+SELECT o.id, o.seller_id, o.price, o.min_amount, o.max_amount, o.currency, u.username, u.rating, u.completed_deals
+FROM offers o
+JOIN users u ON o.seller_id = u.id
+WHERE o.is_active
+ON CONFLICT (offer_id) DO NOTHING;
+
+INSERT INTO deal_feed (deal_id, user_id, buyer_id, seller_id, buyer_name, seller_name, amount, currency, status, created_at)
+SELECT d.id, participant.id, d.buyer_id, d.seller_id, buyer.username, seller.username,
+       d.amount, d.currency, d.status, d.created_at
+FROM deals d
+JOIN users buyer ON d.buyer_id = buyer.id
+JOIN users seller ON d.seller_id = seller.id
+CROSS JOIN LATERAL (VALUES (d.buyer_id), (d.seller_id)) AS participant (id)
+ON CONFLICT (deal_id, user_id) DO NOTHING;
@@ -0,0 +1,117 @@
+-- Фоновое обслуживание: истечение эскроу, снятие устаревших объявлений,
+-- перенос закрытых сделок в секционированный архив. Все операции идут пачками
+-- с FOR UPDATE SKIP LOCKED и не ждут строк, занятых живым трафиком.
+
+CREATE INDEX IF NOT EXISTS idx_deals_open_created
+    ON deals (created_at)
+    WHERE status IN ('pending', 'escrow');
+
+CREATE INDEX IF NOT EXISTS idx_deals_closed_updated
+    ON deals (updated_at)
+    WHERE status IN ('completed', 'cancelled');
+
+CREATE INDEX IF NOT EXISTS idx_offers_active_updated
+    ON offers (updated_at)
+    WHERE is_active;
+
+-- Лента сделок хранит историю сама и не должна терять строки при архивации.
+ALTER TABLE deal_feed DROP CONSTRAINT IF EXISTS deal_feed_deal_id_fkey;
+
+CREATE TABLE IF NOT EXISTS deals_archive (LIKE deals INCLUDING DEFAULTS)
+    PARTITION BY RANGE (created_at);
+
+CREATE INDEX IF NOT EXISTS idx_deals_archive_buyer_created ON deals_archive (buyer_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_deals_archive_seller_created ON deals_archive (seller_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_deals_archive_id ON deals_archive (id);
+
+-- Истечение эскроу: сделки pending/escrow старше p_older_than отменяются,
+-- средства возвращаются покупателю, лимит объявления восстанавливается.
+CREATE OR REPLACE FUNCTION escrow_expire_deals(p_older_than INTERVAL, p_limit INT)
+RETURNS TABLE (
+    deal_id INT,
+    buyer_id INT,
+    seller_id INT,
+    amount DECIMAL,
+    currency VARCHAR
+) AS $$
+#variable_conflict use_column
+BEGIN
+    RETURN QUERY
+    WITH expired AS (
+        SELECT d.id, d.offer_id, d.buyer_id, d.seller_id, d.amount, d.escrow_amount, d.currency
+        FROM deals d
+        WHERE d.status IN ('pending', 'escrow') AND d.created_at < CURRENT_TIMESTAMP - p_older_than
+        ORDER BY d.created_at
+        LIMIT p_limit
+        FOR UPDATE SKIP LOCKED
+    ), closed AS (
+        UPDATE deals d
+        SET status = 'cancelled', escrow_amount = 0, updated_at = CURRENT_TIMESTAMP
+        FROM expired e
+        WHERE d.id = e.id
+        RETURNING e.id, e.offer_id, e.buyer_id, e.seller_id, e.amount, e.escrow_amount, e.currency
+    ), refunds AS (
+        UPDATE users u
+        SET balance = u.balance + r.total, updated_at = CURRENT_TIMESTAMP
+        FROM (SELECT c.buyer_id, SUM(c.escrow_amount) AS total FROM closed c GROUP BY c.buyer_id) r
+        WHERE u.id = r.buyer_id
+    ), restored AS (
+        UPDATE offers o
+        SET max_amount = o.max_amount + r.total,
+            is_active = o.max_amount + r.total >= o.min_amount,
+            updated_at = CURRENT_TIMESTAMP
+        FROM (SELECT c.offer_id, SUM(c.amount) AS total FROM closed c GROUP BY c.offer_id) r
+        WHERE o.id = r.offer_id
+    )
+    SELECT c.id, c.buyer_id, c.seller_id, c.amount, c.currency FROM closed c;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION deals_archive_ensure_partition(p_month DATE) RETURNS VOID AS $$
+DECLARE
+    v_name TEXT := format('deals_archive_%s', to_char(p_month, 'YYYYMM'));
+BEGIN
+    IF to_regclass(v_name) IS NULL THEN
+        PERFORM pg_advisory_xact_lock(hashtext('deals_archive_partitions'));
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF deals_archive FOR VALUES FROM (%L) TO (%L)',
+            v_name, p_month, (p_month + INTERVAL '1 month')::DATE
+        );
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Перенос закрытых сделок старше p_older_than в помесячные секции deals_archive.
+CREATE OR REPLACE FUNCTION deals_archive_batch(p_older_than INTERVAL, p_limit INT) RETURNS INT AS $$
+DECLARE
+    v_ids INT[];
+    v_month DATE;
+    v_moved INT;
+BEGIN
+    SELECT array_agg(batch.id) INTO v_ids FROM (
+        SELECT d.id FROM deals d
+        WHERE d.status IN ('completed', 'cancelled')
+          AND d.updated_at < CURRENT_TIMESTAMP - p_older_than
+          AND d.created_at IS NOT NULL
+        ORDER BY d.updated_at
+        LIMIT p_limit
+        FOR UPDATE SKIP LOCKED
+    ) batch;
+
+    IF v_ids IS NULL THEN
+        RETURN 0;
+    END IF;
+
+    FOR v_month IN SELECT DISTINCT date_trunc('month', d.created_at)::DATE FROM deals d WHERE d.id = ANY(v_ids) LOOP
+        PERFORM deals_archive_ensure_partition(v_month);
+    END LOOP;
+
+    WITH moved AS (
+        DELETE FROM deals WHERE id = ANY(v_ids) RETURNING *
+    )
+    INSERT INTO deals_archive SELECT * FROM moved;
+
+    GET DIAGNOSTICS v_moved = ROW_COUNT;
+    RETURN v_moved;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,55 @@
+-- Исполнение рыночной заявки покупателя: обход активных объявлений валюты по цене
+-- и открытие сделок через escrow_open_deal в одной транзакции.
+-- Объявления, занятые другими транзакциями, пропускаются (SKIP LOCKED).
+CREATE OR REPLACE FUNCTION escrow_match_order(
+    p_buyer_id INT,
+    p_currency VARCHAR,
+    p_amount DECIMAL,
+    p_max_price DECIMAL,
+    p_max_fills INT
+)
+RETURNS TABLE (
+    deal_id INT,
+    offer_id INT,
+    seller_id INT,
+    amount DECIMAL,
+    price DECIMAL,
+    offer_max_amount DECIMAL,
+    offer_is_active BOOLEAN
+) AS $$
+DECLARE
+    v_offer RECORD;
+    v_fill RECORD;
+    v_remaining DECIMAL := p_amount;
+    v_take DECIMAL;
+    v_fills INT := 0;
+BEGIN
+    FOR v_offer IN
+        SELECT o.id, o.min_amount, o.max_amount
+        FROM offers o
+        WHERE o.is_active AND o.currency = p_currency AND o.price <= p_max_price AND o.seller_id <> p_buyer_id
+        ORDER BY o.price, o.id
+        FOR UPDATE SKIP LOCKED
+    LOOP
+        EXIT WHEN v_remaining <= 0 OR v_fills >= p_max_fills;
+
+        v_take := LEAST(v_remaining, v_offer.max_amount);
+        CONTINUE WHEN v_take < v_offer.min_amount;
+
+        SELECT * INTO v_fill FROM escrow_open_deal(p_buyer_id, v_offer.id, v_take);
+        EXIT WHEN v_fill.result = 'insufficient_funds';
+        CONTINUE WHEN v_fill.result <> 'created';
+
+        v_remaining := v_remaining - v_take;
+        v_fills := v_fills + 1;
+        deal_id := v_fill.deal_id;
+        offer_id := v_offer.id;
+        seller_id := v_fill.seller_id;
+        amount := v_take;
+        price := v_fill.price;
+        offer_max_amount := v_fill.offer_max_amount;
+        offer_is_active := v_fill.offer_is_active;
+        RETURN NEXT;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,41 @@
+-- Разбор споров администратором: очередь открытых споров и решение в пользу
+-- продавца (сделка завершается) или покупателя (средства возвращаются).
+
+CREATE INDEX IF NOT EXISTS idx_deals_dispute_updated
+    ON deals (updated_at, id)
+    WHERE status = 'dispute';
+
+-- Решение спора переиспользует escrow_transition: сделка возвращается в escrow
+-- и закрывается от имени той стороны, которой разрешён нужный переход.
+CREATE OR REPLACE FUNCTION escrow_resolve_dispute(p_deal_id INT, p_resolution VARCHAR)
+RETURNS TABLE (
+    result TEXT,
+    buyer_id INT,
+    seller_id INT,
+    amount DECIMAL,
+    currency VARCHAR
+) AS $$
+DECLARE
+    v_deal deals%ROWTYPE;
+BEGIN
+    SELECT * INTO v_deal FROM deals WHERE id = p_deal_id FOR UPDATE;
+
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'not_found'::TEXT, NULL::INT, NULL::INT, NULL::DECIMAL, NULL::VARCHAR;
+        RETURN;
+    END IF;
+
+    IF v_deal.status <> 'dispute' OR p_resolution NOT IN ('completed', 'cancelled') THEN
+        RETURN QUERY SELECT 'invalid_transition'::TEXT, v_deal.buyer_id, v_deal.seller_id, v_deal.amount, v_deal.currency;
+        RETURN;
+    END IF;
+
+    UPDATE deals SET status = 'escrow' WHERE id = p_deal_id;
+
+    RETURN QUERY SELECT * FROM escrow_transition(
+        p_deal_id,
+        CASE WHEN p_resolution = 'completed' THEN v_deal.buyer_id ELSE v_deal.seller_id END,
+        p_resolution
+    );
+END;
+$$ LANGUAGE plpgsql;
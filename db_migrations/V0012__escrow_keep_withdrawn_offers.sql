@@ -0,0 +1,73 @@
+-- Отмена сделки возвращает лимит объявлению, но включает его обратно, только если
+-- оно было выключено из-за исчерпанного лимита. Объявление, снятое продавцом
+-- (/deactivate) или фоновой задачей, остаётся снятым.
+
+-- Переход статуса сделки: completed (подтверждает покупатель), cancelled (продавец),
+-- dispute (любая сторона). Повторный переход в тот же статус ничего не меняет.
+CREATE OR REPLACE FUNCTION escrow_transition(p_deal_id INT, p_user_id INT, p_status VARCHAR)
+RETURNS TABLE (
+    result TEXT,
+    buyer_id INT,
+    seller_id INT,
+    amount DECIMAL,
+    currency VARCHAR
+) AS $$
+DECLARE
+    v_deal deals%ROWTYPE;
+BEGIN
+    SELECT * INTO v_deal FROM deals WHERE id = p_deal_id FOR UPDATE;
+    
+    IF NOT FOUND OR p_user_id NOT IN (v_deal.buyer_id, v_deal.seller_id) THEN
+        RETURN QUERY SELECT 'not_found'::TEXT, NULL::INT, NULL::INT, NULL::DECIMAL, NULL::VARCHAR;
+        RETURN;
+    END IF;
+    
+    IF v_deal.status = p_status THEN
+        result := 'unchanged';
+    ELSIF NOT (
+        (p_status = 'escrow' AND v_deal.status = 'pending')
+        OR (p_status = 'cancelled' AND v_deal.status IN ('pending', 'escrow') AND p_user_id = v_deal.seller_id)
+        OR (p_status = 'completed' AND v_deal.status = 'escrow' AND p_user_id = v_deal.buyer_id)
+        OR (p_status = 'dispute' AND v_deal.status = 'escrow')
+    ) THEN
+        result := 'invalid_transition';
+    END IF;
+    
+    IF result IS NOT NULL THEN
+        RETURN QUERY SELECT result, v_deal.buyer_id, v_deal.seller_id, v_deal.amount, v_deal.currency;
+        RETURN;
+    END IF;
+    
+    IF p_status = 'completed' THEN
+        UPDATE users SET
+            balance = balance + v_deal.escrow_amount,
+            total_sold = total_sold + v_deal.amount,
+            completed_deals = completed_deals + 1,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = v_deal.seller_id;
+        
+        UPDATE users SET
+            total_bought = total_bought + v_deal.amount,
+            completed_deals = completed_deals + 1,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = v_deal.buyer_id;
+    ELSIF p_status = 'cancelled' THEN
+        UPDATE users SET balance = balance + v_deal.escrow_amount, updated_at = CURRENT_TIMESTAMP
+        WHERE id = v_deal.buyer_id;
+        
+        UPDATE offers SET
+            max_amount = max_amount + v_deal.amount,
+            is_active = is_active OR (max_amount < min_amount AND max_amount + v_deal.amount >= min_amount),
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id = v_deal.offer_id;
+    END IF;
+    
+    UPDATE deals SET
+        status = p_status,
+        escrow_amount = CASE WHEN p_status IN ('completed', 'cancelled') THEN 0 ELSE escrow_amount END,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE id = p_deal_id;
+    
+    RETURN QUERY SELECT 'ok'::TEXT, v_deal.buyer_id, v_deal.seller_id, v_deal.amount, v_deal.currency;
+END;
+$$ LANGUAGE plpgsql;
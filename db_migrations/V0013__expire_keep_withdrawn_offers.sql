@@ -0,0 +1,46 @@
+-- Истечение эскроу включает объявление обратно, только если оно было выключено
+-- из-за исчерпанного лимита: снятое продавцом или фоновой задачей остаётся снятым.
+-- updated_at не трогается: истечение сделки не активность продавца и не должно
+-- продлевать публикацию ещё на OFFER_STALE_DAYS.
+
+-- Истечение эскроу: сделки pending/escrow старше p_older_than отменяются,
+-- средства возвращаются покупателю, лимит объявления восстанавливается.
+CREATE OR REPLACE FUNCTION escrow_expire_deals(p_older_than INTERVAL, p_limit INT)
+RETURNS TABLE (
+    deal_id INT,
+    buyer_id INT,
+    seller_id INT,
+    amount DECIMAL,
+    currency VARCHAR
+) AS $$
+#variable_conflict use_column
+BEGIN
+    RETURN QUERY
+    WITH expired AS (
+        SELECT d.id, d.offer_id, d.buyer_id, d.seller_id, d.amount, d.escrow_amount, d.currency
+        FROM deals d
+        WHERE d.status IN ('pending', 'escrow') AND d.created_at < CURRENT_TIMESTAMP - p_older_than
+        ORDER BY d.created_at
+        LIMIT p_limit
+        FOR UPDATE SKIP LOCKED
+    ), closed AS (
+        UPDATE deals d
+        SET status = 'cancelled', escrow_amount = 0, updated_at = CURRENT_TIMESTAMP
+        FROM expired e
+        WHERE d.id = e.id
+        RETURNING e.id, e.offer_id, e.buyer_id, e.seller_id, e.amount, e.escrow_amount, e.currency
+    ), refunds AS (
+        UPDATE users u
+        SET balance = u.balance + r.total, updated_at = CURRENT_TIMESTAMP
+        FROM (SELECT c.buyer_id, SUM(c.escrow_amount) AS total FROM closed c GROUP BY c.buyer_id) r
+        WHERE u.id = r.buyer_id
+    ), restored AS (
+        UPDATE offers o
+        SET max_amount = o.max_amount + r.total,
+            is_active = o.is_active OR (o.max_amount < o.min_amount AND o.max_amount + r.total >= o.min_amount)
+        FROM (SELECT c.offer_id, SUM(c.amount) AS total FROM closed c GROUP BY c.offer_id) r
+        WHERE o.id = r.offer_id
+    )
+    SELECT c.id, c.buyer_id, c.seller_id, c.amount, c.currency FROM closed c;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,79 @@
+-- Сумма сделки округляется до копеек до всех проверок: колонки balance, amount и
+-- max_amount хранят DECIMAL(15,2), и неокруглённая сумма списывалась бы, бронировалась
+-- и вычиталась из лимита с разным округлением, создавая или теряя копейки.
+
+-- Открытие сделки: блокирует объявление, списывает средства покупателя в эскроу
+-- и уменьшает доступный лимит объявления. Повторный вызов возвращает открытую сделку.
+CREATE OR REPLACE FUNCTION escrow_open_deal(p_buyer_id INT, p_offer_id INT, p_amount DECIMAL)
+RETURNS TABLE (
+    result TEXT,
+    deal_id INT,
+    seller_id INT,
+    amount DECIMAL,
+    price DECIMAL,
+    currency VARCHAR,
+    offer_max_amount DECIMAL,
+    offer_is_active BOOLEAN
+) AS $$
+DECLARE
+    v_offer offers%ROWTYPE;
+    v_amount DECIMAL;
+    v_deal_id INT;
+BEGIN
+    SELECT * INTO v_offer FROM offers WHERE id = p_offer_id FOR UPDATE;
+    
+    IF NOT FOUND OR NOT v_offer.is_active THEN
+        RETURN QUERY SELECT 'offer_unavailable'::TEXT, NULL::INT, NULL::INT, NULL::DECIMAL,
+            NULL::DECIMAL, NULL::VARCHAR, NULL::DECIMAL, FALSE;
+        RETURN;
+    END IF;
+    
+    v_amount := round(COALESCE(p_amount, v_offer.min_amount), 2);
+    
+    IF v_offer.seller_id = p_buyer_id THEN
+        result := 'own_offer';
+    ELSIF v_amount < v_offer.min_amount OR v_amount > v_offer.max_amount THEN
+        result := 'invalid_amount';
+    END IF;
+    
+    IF result IS NOT NULL THEN
+        RETURN QUERY SELECT result, NULL::INT, v_offer.seller_id, v_amount, v_offer.price,
+            v_offer.currency, v_offer.max_amount, v_offer.is_active;
+        RETURN;
+    END IF;
+    
+    SELECT d.id INTO v_deal_id FROM deals d
+    WHERE d.offer_id = p_offer_id AND d.buyer_id = p_buyer_id AND d.status IN ('pending', 'escrow')
+    LIMIT 1;
+    
+    IF FOUND THEN
+        RETURN QUERY SELECT 'exists'::TEXT, d.id, d.seller_id, d.amount, d.price, d.currency,
+            v_offer.max_amount, v_offer.is_active
+        FROM deals d WHERE d.id = v_deal_id;
+        RETURN;
+    END IF;
+    
+    UPDATE users SET balance = balance - v_amount, updated_at = CURRENT_TIMESTAMP
+    WHERE id = p_buyer_id AND balance >= v_amount;
+    
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'insufficient_funds'::TEXT, NULL::INT, v_offer.seller_id, v_amount,
+            v_offer.price, v_offer.currency, v_offer.max_amount, v_offer.is_active;
+        RETURN;
+    END IF;
+    
+    INSERT INTO deals (offer_id, buyer_id, seller_id, amount, price, currency, status, escrow_amount)
+    VALUES (p_offer_id, p_buyer_id, v_offer.seller_id, v_amount, v_offer.price, v_offer.currency, 'escrow', v_amount)
+    RETURNING id INTO v_deal_id;
+    
+    UPDATE offers
+    SET max_amount = offers.max_amount - v_amount,
+        is_active = offers.max_amount - v_amount >= offers.min_amount,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE id = p_offer_id
+    RETURNING offers.max_amount, offers.is_active INTO v_offer.max_amount, v_offer.is_active;
+    
+    RETURN QUERY SELECT 'created'::TEXT, v_deal_id, v_offer.seller_id, v_amount, v_offer.price,
+        v_offer.currency, v_offer.max_amount, v_offer.is_active;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,6 @@
+-- История сделок читается из deal_feed (V0008), индексы V0003 по deals больше
+-- никто не использует, а каждая вставка и смена статуса сделки их обновляет.
+
+DROP INDEX IF EXISTS idx_deals_buyer_created;
+
+DROP INDEX IF EXISTS idx_deals_seller_created;